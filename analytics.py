@@ -0,0 +1,131 @@
+"""Trend data for GET /analytics, read from the summary tables of
+migrations/009_analytics.up.sql.
+
+Dates are the 'YYYY-MM-DD' strings the client stores; weeks start on
+Monday.
+
+Triggers keep the summaries current; the weekly ``rebuild_analytics`` job
+recomputes them from the base tables in case a write bypassed those.
+"""
+from datetime import date, timedelta
+
+import events
+import jobs
+
+DEFAULT_DAYS = 365
+DEFAULT_WINDOW = 7
+
+
+def date_range(date_from=None, date_to=None):
+    """Validate the bounds and fill in missing ones: ``date_to`` defaults to today, ``date_from`` to a year before it.
+
+    Raises ValueError for a bound that is not YYYY-MM-DD.
+    """
+    date_to = date.fromisoformat(date_to) if date_to else date.today()
+    date_from = date.fromisoformat(date_from) if date_from else date_to - timedelta(days=DEFAULT_DAYS - 1)
+    return date_from.isoformat(), date_to.isoformat()
+
+
+def food_totals(cur, date_from, date_to):
+    cur.execute("""
+        SELECT date, calories, protein, items FROM food_daily
+        WHERE date BETWEEN %s AND %s ORDER BY date
+    """, (date_from, date_to))
+    daily = [{'date': r[0], 'calories': r[1], 'protein': r[2], 'items': r[3]} for r in cur.fetchall()]
+
+    cur.execute("""
+        SELECT to_char(date_trunc('week', date::date), 'YYYY-MM-DD') AS week,
+               SUM(calories)::bigint, SUM(protein)::bigint, COUNT(*)
+        FROM food_daily WHERE date BETWEEN %s AND %s
+        GROUP BY week ORDER BY week
+    """, (date_from, date_to))
+    weekly = [{'week': r[0], 'calories': r[1], 'protein': r[2], 'days': r[3]} for r in cur.fetchall()]
+    return {'daily': daily, 'weekly': weekly}
+
+
+def score_averages(cur, date_from, date_to, window=DEFAULT_WINDOW):
+    """Per category and day, the day's score and its average over the ``window`` days ending there."""
+    # Read back far enough that the first days in range get a full window.
+    read_from = (date.fromisoformat(date_from) - timedelta(days=window - 1)).isoformat()
+    cur.execute("""
+        SELECT category, date, score, average FROM (
+            SELECT category, date, score,
+                   AVG(score) OVER (
+                       PARTITION BY category ORDER BY date::date
+                       RANGE BETWEEN %s * interval '1 day' PRECEDING AND CURRENT ROW
+                   ) AS average
+            FROM green_note_day_scores WHERE date BETWEEN %s AND %s
+        ) AS w
+        WHERE date >= %s
+        ORDER BY category, date
+    """, (window - 1, read_from, date_to, date_from))
+    categories = {}
+    for category, day, score, average in cur.fetchall():
+        categories.setdefault(category, []).append({'date': day, 'score': score, 'average': round(average, 3)})
+    return categories
+
+
+def tracking_streaks(cur, today=None):
+    """For each tracking item: the current run of completed days, the longest run and the total.
+
+    A day counts as completed when ``done`` reached ``amount``. The current
+    run may end yesterday, as today is not over yet.
+    """
+    today = today or date.today()
+    cur.execute("""
+        WITH done_days AS (
+            SELECT name, date::date AS day FROM tracking_days WHERE amount > 0 AND done >= amount
+        ), runs AS (
+            SELECT name, MAX(day) AS last_day, COUNT(*) AS length
+            FROM (
+                SELECT name, day, day - (ROW_NUMBER() OVER (PARTITION BY name ORDER BY day))::integer AS run
+                FROM done_days
+            ) AS d
+            GROUP BY name, run
+        )
+        SELECT t.name,
+               COALESCE(MAX(r.length) FILTER (WHERE r.last_day >= %s::date - 1), 0),
+               COALESCE(MAX(r.length), 0),
+               COALESCE(SUM(r.length), 0)::integer
+        FROM tracking t LEFT JOIN runs r ON r.name = t.name
+        GROUP BY t.name ORDER BY t.name
+    """, (today.isoformat(),))
+    return [
+        {'name': r[0], 'current_streak': r[1], 'longest_streak': r[2], 'completed_days': r[3]}
+        for r in cur.fetchall()
+    ]
+
+
+def rebuild(cur):
+    """Recompute the current tenant's summary tables from food, green_notes and tracking.
+
+    tracking only holds today's counts, so earlier days of tracking_days are
+    kept, except those of deleted items.
+    """
+    cur.execute('DELETE FROM food_daily')
+    cur.execute("""
+        INSERT INTO food_daily (date, calories, protein, items)
+        SELECT date, COALESCE(SUM(calories), 0), COALESCE(SUM(protein), 0), COUNT(*) FROM food GROUP BY date
+    """)
+    cur.execute('DELETE FROM green_note_day_scores')
+    cur.execute("""
+        SELECT analytics_refresh_green_day(app_tenant_id(), date)
+        FROM (SELECT DISTINCT date FROM green_notes WHERE date IS NOT NULL) AS d
+    """)
+    cur.execute('DELETE FROM tracking_days d WHERE NOT EXISTS (SELECT 1 FROM tracking t WHERE t.name = d.name)')
+    cur.execute("""
+        INSERT INTO tracking_days (name, date, done, amount)
+        SELECT name, time, COALESCE(done, 0), COALESCE(amount, 0) FROM tracking WHERE time IS NOT NULL
+        ON CONFLICT (tenant_id, name, date) DO UPDATE SET done = EXCLUDED.done, amount = EXCLUDED.amount
+    """)
+
+
+@jobs.handler('rebuild_analytics')
+def rebuild_job(conn, args):
+    with conn.cursor() as cur:
+        rebuild(cur)
+        # GET /analytics is cached under the base tables.
+        events.publish_change(cur, 'food', 'green_notes', 'green_note_scores', 'tracking')
+
+
+jobs.schedule('rebuild_analytics', '30 3 * * 0', 'rebuild_analytics')
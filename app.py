@@ -1,66 +1,265 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import psycopg2
-import os
 from flask import jsonify, json
 from datetime import datetime, date
+import psycopg2.errors
+from psycopg2.extras import Json
+
+import analytics
+import batch
+import cache
+import cascade
+import compression
+import events
+import jobs
+import jsonprovider
+import metrics
+import ordering
+import pagination
+import replicas
+import search
+import sync
+import tenants
+import writebehind
+from db import PoolTimeout, Query, begin_snapshot, get_db_connection, get_pool, release_db_connection
+from pagination import KeysetList
+
+
+api = Blueprint('api', __name__)
+
+# Operational endpoints: they read no tenant's rows, so they need no token.
+UNSCOPED_ENDPOINTS = {'api.' + name for name in (
+    'ping', 'pool_stats', 'replica_stats', 'prometheus_metrics', 'cache_stats', 'write_behind_stats')}
+# Orphans left by a delete are looked for this many seconds later (see cascade.py).
+ORPHAN_PURGE_DELAY = 60
+# GET endpoints that write, so never read from a replica (see replicas.py).
+PRIMARY_ENDPOINTS = {'api.' + name for name in ('get_window_args', 'reset_tracking_daily')}
+
+
+def create_app():
+    """Build the application; servers load it as ``app:create_app()`` (see gunicorn.conf.py)."""
+    app = Flask(__name__)
+    # Cross-origin clients keep their read-your-writes position from the header.
+    CORS(app, expose_headers=[replicas.LSN_HEADER])
+    # Every route borrows one pooled connection per request; it goes back here.
+    app.teardown_appcontext(release_db_connection)
+    # Cached reads of the tables a request wrote are dropped once it has committed.
+    app.teardown_request(cache.invalidate_changed)
+    # Per-endpoint latency, database time and query counts for /metrics.
+    metrics.init_app(app, pool_gauges)
+    # Every other request runs as the tenant its bearer token names (see tenants.py).
+    tenants.init_app(app, UNSCOPED_ENDPOINTS)
+    # GET requests read from a healthy replica when DB_REPLICA_HOSTS is set.
+    replicas.init_app(app, PRIMARY_ENDPOINTS)
+    # Background jobs (see jobs.py) run on threads started with the first request.
+    jobs.init_app(app)
+    jsonprovider.init_app(app)
+    # Registered after metrics so /metrics counts the compressed bytes.
+    app.after_request(compression.compress)
+    app.register_blueprint(api)
+    return app
+
+
+@api.app_errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    return jsonify({'error': 'Database busy, try again'}), 503
+
+@api.route('/ping')
+def ping():
+    return 'pong', 200
 
+@api.route('/pool_stats')
+def pool_stats():
+    return jsonify(get_pool().stats())
 
-app = Flask(__name__)
-CORS(app)
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.environ['DB_HOST'],
-        database=os.environ['DB_NAME'],
-        user=os.environ['DB_USER'],
-        password=os.environ['DB_PASSWORD']
-    )
+@api.route('/replica_stats')
+def replica_stats():
+    return jsonify(replicas.stats())
 
-@app.route('/ping')
-def ping():
-    return 'pong', 200
+def pool_gauges():
+    pool = get_pool().stats()
+    return {k: pool[k] for k in ('open', 'in_use', 'idle', 'max_size')}
 
-# ---------- PAGES ----------
+@api.route('/metrics')
+def prometheus_metrics():
+    # Summed over all workers when METRICS_DIR is set (see metrics.py).
+    return Response(metrics.render(replicas.stats()), mimetype='text/plain; version=0.0.4')
+
+@api.route('/cache_stats')
+def cache_stats():
+    return jsonify(cache.response_cache.stats())
+
+@api.route('/write_behind_stats')
+def write_behind_stats():
+    return jsonify(writebehind.buffer.stats())
 
-current_window_args = {}
-should_open_window = False
+# The tenant's own jobs only: the jobs table has no row-level policy.
+@api.route('/job_stats')
+def job_stats():
+    cur = get_db_connection().cursor()
+    return jsonify(jobs.counts(cur, tenants.current()))
+
+# ---------- PAGES ----------
+# Window hand-off state lives in the tenant's single window_state row so
+# every worker sees it; changes are also pushed to /events subscribers.
 
 # Set the window arguments
-@app.route('/window_args', methods=['POST'])
+@api.route('/window_args', methods=['POST'])
 def set_window_args():
-    global current_window_args
-    current_window_args = request.json
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO window_state (id, args) VALUES (1, %s)
+        ON CONFLICT (tenant_id, id) DO UPDATE SET args = EXCLUDED.args
+    """, (Json(request.json or {}),))
+    events.publish(cur, 'window_args', request.json or {})
+    conn.commit()
+    cur.close()
     return jsonify({'status': 'ok'})
 
 # Get the window arguments (and clear them after use)
-@app.route('/window_args', methods=['GET'])
+@api.route('/window_args', methods=['GET'])
 def get_window_args():
-    global current_window_args
-    args = current_window_args
-    current_window_args = {}  # Clear after fetch
-    return jsonify(args)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE window_state w SET args = '{}'
+        FROM (SELECT args FROM window_state WHERE id = 1 FOR UPDATE) old
+        WHERE w.id = 1
+        RETURNING old.args
+    """)
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return jsonify(row[0] if row else {})
 
 # Trigger a window open (from child window)
-@app.route('/window_request', methods=['POST'])
+@api.route('/window_request', methods=['POST'])
 def trigger_window_open():
-    global should_open_window
-    should_open_window = True
+    set_window_request(True)
     return jsonify({'status': 'triggered'})
 
-# Polling route (main window checks this)
-@app.route('/window_request', methods=['GET'])
+# Polling route (main window checks this); /events pushes the same flag
+@api.route('/window_request', methods=['GET'])
 def check_window_request():
-    return jsonify({'open': should_open_window})
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT open FROM window_state WHERE id = 1")
+    row = cur.fetchone()
+    cur.close()
+    return jsonify({'open': bool(row and row[0])})
 
 # Reset the flag after opening
-@app.route('/reset_window_request', methods=['POST'])
+@api.route('/reset_window_request', methods=['POST'])
 def reset_window_request():
-    global should_open_window
-    should_open_window = False
+    set_window_request(False)
     return jsonify({'status': 'reset'})
 
+
+def set_window_request(open_):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO window_state (id, open) VALUES (1, %s)
+        ON CONFLICT (tenant_id, id) DO UPDATE SET open = EXCLUDED.open
+    """, (open_,))
+    events.publish(cur, 'window_request', {'open': open_})
+    conn.commit()
+    cur.close()
+
+
+# ---------- EVENTS ----------
+# Server-Sent Events stream of window requests and data changes. Resume with
+# the Last-Event-ID header (sent automatically by EventSource) or ?since=.
+
+# Both hold a server thread while open, so each worker serves at most
+# EVENTS_MAX_WAITERS of them at a time and answers 503 past that.
+
+def events_busy():
+    return jsonify({'error': 'Too many event subscribers, try again'}), 503, {'Retry-After': '5'}
+
+@api.route('/events')
+def stream_events():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    slots = events.waiter_slots
+    if not slots.acquire(blocking=False):
+        return events_busy()
+    response = Response(
+        stream_with_context(events.sse_stream(int(since) if since else None, tenants.current())),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    response.call_on_close(slots.release)
+    return response
+
+# Long-poll fallback: returns as soon as there are events after ?since=, or
+# an empty list after ?timeout= seconds.
+@api.route('/events/poll')
+def poll_events():
+    since = request.args.get('since', type=int)
+    timeout = min(request.args.get('timeout', 25, type=float), 60)
+    slots = events.waiter_slots
+    if not slots.acquire(blocking=False):
+        return events_busy()
+    try:
+        last_id, new_events = events.get_listener().wait(since, timeout, tenants.current())
+    finally:
+        slots.release()
+    return jsonify({'events': new_events, 'last_id': last_id})
+
+# ---------- SYNC ----------
+# Incremental fetch: /sync returns every synced table in full plus a
+# version; /sync?since=<version> returns only rows written and keys deleted
+# after it. ?tables=topics,tasks limits the tables.
+
+# Synced tables whose writes may sit in the write-behind buffer (keyed by table name).
+SYNC_BUFFERED = ('files', 'tracking', 'control')
+
+@api.route('/sync')
+def get_sync():
+    since = request.args.get('since', type=int)
+    tables = request.args.get('tables')
+    tables = tables.split(',') if tables else None
+    # The delta must include autosaves this process has accepted but not written.
+    for table in SYNC_BUFFERED:
+        if tables is None or table in tables:
+            writebehind.buffer.flush_prefix((table,))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    result = sync.fetch_changes(cur, since, tables)
+    cur.close()
+    return jsonify(result)
+
+# ---------- SEARCH ----------
+# /search?q=...&kinds=file,topic&limit=20&offset=0 over file contents, topic
+# names, unclassified tasks and green notes. next_offset is null on the
+# last page.
+
+@api.route('/search')
+def search_all():
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q'}), 400
+    kinds = request.args.get('kinds')
+    kinds = kinds.split(',') if kinds else None
+    if kinds and not set(kinds) <= set(search.KINDS):
+        return jsonify({'error': 'Unknown kinds: %s' % ', '.join(sorted(set(kinds) - set(search.KINDS)))}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    # Buffered autosaves must be searchable too.
+    writebehind.buffer.flush_prefix(('files',))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    hits = search.search(cur, query, kinds, limit, offset)
+    cur.close()
+    return jsonify({
+        'hits': hits[:limit],
+        'next_offset': offset + limit if len(hits) > limit else None,
+    })
+
 # ---------- HOUSES ----------
-@app.route('/add_house', methods=['POST'])
+@api.route('/add_house', methods=['POST'])
 def add_house():
     data = request.get_json()
     house_name = data['name']
@@ -68,54 +267,44 @@ def add_house():
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("INSERT INTO houses (name) VALUES (%s) ON CONFLICT DO NOTHING", (house_name,))
+    events.publish_change(cur, 'houses')
     conn.commit()
     cur.close()
-    conn.close()
 
     return '', 200
 
-@app.route('/delete_house', methods=['POST'])
+@api.route('/delete_house', methods=['POST'])
 def delete_house():
     data = request.get_json()
     house_name = data['name']
 
-    if house_name == 'כללי':
+    if house_name == cascade.GENERAL_HOUSE:
         return jsonify({'error': 'Cannot delete the general house'}), 400
 
     conn = get_db_connection()
     cur = conn.cursor()
-
-    # 1. Move topics to 'כללי'
-    cur.execute(
-        "UPDATE topics SET house = %s WHERE house = %s",
-        ('כללי', house_name)
-    )
-
-    # 2. Delete the house
-    cur.execute(
-        "DELETE FROM houses WHERE name = %s",
-        (house_name,)
-    )
-
+    # Its topics move to the general house in the same transaction.
+    cascade.delete_house(cur, house_name)
+    events.publish_change(cur, *cascade.TOUCHES['house'])
+    jobs.enqueue(cur, 'purge_orphans', dedupe='purge_orphans', delay=ORPHAN_PURGE_DELAY)
     conn.commit()
     cur.close()
-    conn.close()
 
     return '', 200
 
-@app.route('/houses', methods=['GET'])
+@api.route('/houses', methods=['GET'])
+@cache.cached('houses')
 def get_houses():
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT name FROM houses")
-    rows = cur.fetchall()
+    house_list = load_houses(cur)
     cur.close()
-    conn.close()
-
-    house_list = [row[0] for row in rows]
     return jsonify(house_list)
 
-@app.route('/edit_house', methods=['POST'])
+
+load_houses = Query("SELECT name FROM houses", lambda rows: [row[0] for row in rows])
+
+@api.route('/edit_house', methods=['POST'])
 def edit_house():
     data = request.get_json()
     old_name = data['old_name']
@@ -123,13 +312,14 @@ def edit_house():
 
     conn = get_db_connection()
     cur = conn.cursor()
-    # Update house name in houses table
-    cur.execute("UPDATE houses SET name = %s WHERE name = %s", (new_name, old_name))
-    # Also update house field in topics
-    cur.execute("UPDATE topics SET house = %s WHERE house = %s", (new_name, old_name))
+    try:
+        cascade.rename_house(cur, old_name, new_name)
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({'error': 'A house with this name already exists'}), 409
+    events.publish_change(cur, *cascade.TOUCHES['house'])
     conn.commit()
     cur.close()
-    conn.close()
 
     return '', 200
 
@@ -137,15 +327,17 @@ def edit_house():
 # ---------- TOPICS ----------
 # GET all topics organized by houses
 
-@app.route('/directories', methods=['GET'])
+@api.route('/directories', methods=['GET'])
+@cache.cached('topics')
 def get_directories():
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT id, house, name, color, \"order\" FROM topics ORDER BY house, \"order\" ASC")
-    rows = cur.fetchall()
+    houses = load_directories(cur)
     cur.close()
-    conn.close()
+    return jsonify(houses)
 
+
+def group_topics_by_house(rows):
     houses = {}
     for topic_id, house, name, color, order in rows:
         houses.setdefault(house, []).append({
@@ -154,10 +346,14 @@ def get_directories():
             'color': color,
             'order': order
         })
-    return jsonify(houses)
+    return houses
 
 
-@app.route('/edit_topic', methods=['POST'])
+load_directories = Query(
+    "SELECT id, house, name, color, \"order\" FROM topics ORDER BY house, \"order\" ASC", group_topics_by_house)
+
+
+@api.route('/edit_topic', methods=['POST'])
 def edit_topic():
     data = request.get_json()
     topic_id = data['id']
@@ -169,14 +365,14 @@ def edit_topic():
     cur.execute("""
         UPDATE topics SET name = %s, color = %s WHERE id = %s
     """, (name, color, topic_id))
+    events.publish_change(cur, 'topics')
     conn.commit()
     cur.close()
-    conn.close()
 
     return '', 200
 
 
-@app.route('/add_topic', methods=['POST'])
+@api.route('/add_topic', methods=['POST'])
 def add_topic():
     data = request.get_json()
     name = data['name']
@@ -185,33 +381,36 @@ def add_topic():
 
     conn = get_db_connection()
     cur = conn.cursor()
+    # New topics go to the top of their house.
     cur.execute("""
         INSERT INTO topics (name, color, house, "order")
-        VALUES (%s, %s, %s, %s)
-    """, (name, color, house, 0))  # default new topic at order=0
+        VALUES (%%s, %%s, %%s, %s)
+    """ % ordering.next_key_sql('topics', first=True), (name, color, house, house))
+    events.publish_change(cur, 'topics')
     conn.commit()
     cur.close()
-    conn.close()
 
     return '', 200
 
 
-@app.route('/delete_topic', methods=['POST'])
+@api.route('/delete_topic', methods=['POST'])
 def delete_topic():
     data = request.get_json()
     topic_id = data['id']
 
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM topics WHERE id = %s", (topic_id,))
+    # Its files, tasks and control rows go with it.
+    cascade.delete_topic(cur, topic_id)
+    events.publish_change(cur, *cascade.TOUCHES['topic'])
+    jobs.enqueue(cur, 'purge_orphans', dedupe='purge_orphans', delay=ORPHAN_PURGE_DELAY)
     conn.commit()
     cur.close()
-    conn.close()
 
     return '', 200
 
 
-@app.route('/move_topic', methods=['POST'])
+@api.route('/move_topic', methods=['POST'])
 def move_topic():
     data = request.get_json()
     topic_id = data['topic_id']
@@ -220,45 +419,24 @@ def move_topic():
 
     conn = get_db_connection()
     cur = conn.cursor()
-
-    # 1. Update the moved topic to the new house (temporarily give it a special order)
     cur.execute("""
-        UPDATE topics SET house = %s, "order" = -1 WHERE id = %s
+        SELECT id FROM topics WHERE house = %s AND id != %s ORDER BY "order", id
     """, (new_house, topic_id))
-    conn.commit()
-
-    # 2. Fetch all topics in the new house, ordered by "order"
-    cur.execute("""
-        SELECT id FROM topics WHERE house = %s AND id != %s ORDER BY "order"
-    """, (new_house, topic_id))
-    other_topics = cur.fetchall()
-
-    # 3. Insert the moved topic at the right place
-    all_topics_ordered = []
-    inserted = False
-    for index, (other_id,) in enumerate(other_topics):
-        if index == new_order:
-            all_topics_ordered.append(topic_id)  # Insert moved topic here
-            inserted = True
-        all_topics_ordered.append(other_id)
-
-    if not inserted:
-        all_topics_ordered.append(topic_id)  # If new_order > length, add at the end
-
-    # 4. Update the order numbers correctly
-    for new_index, tid in enumerate(all_topics_ordered):
-        cur.execute("""
-            UPDATE topics SET "order" = %s WHERE id = %s
-        """, (new_index, tid))
-
+    ids = [(row[0],) for row in cur.fetchall()]
+    ids.insert(min(new_order, len(ids)), (topic_id,))
+
+    # Only the moved topic gets a new key; its neighbours keep theirs.
+    _, crowded, new_ordering = ordering.reorder(cur, 'topics', [new_house], ids)
+    if crowded:
+        ordering.schedule_rebalance(cur, 'topics', [new_house])
+    events.publish_change(cur, 'topics')
     conn.commit()
     cur.close()
-    conn.close()
 
-    return '', 200
+    return jsonify([{'id': key[0], 'order': order} for key, order in new_ordering])
 
 
-@app.route('/toggle_flat', methods=['POST'])
+@api.route('/toggle_flat', methods=['POST'])
 def toggle_flat():
     data = request.get_json()
     topic_id = data['topic_id']
@@ -266,19 +444,19 @@ def toggle_flat():
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("UPDATE topics SET flat = %s WHERE id = %s", (flat, topic_id))
+    events.publish_change(cur, 'topics')
     conn.commit()
     cur.close()
-    conn.close()
     return '', 200
 
-@app.route('/topic_details/<int:topic_id>', methods=['GET'])
+@api.route('/topic_details/<int:topic_id>', methods=['GET'])
+@cache.cached('topics')
 def topic_details(topic_id):
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("SELECT name, color, flat FROM topics WHERE id = %s", (topic_id,))
     row = cur.fetchone()
     cur.close()
-    conn.close()
 
     if row:
         return jsonify({'name': row[0], 'color': row[1], 'flat': row[2]})
@@ -287,14 +465,14 @@ def topic_details(topic_id):
 
 # ---------- FILES ----------
 
-@app.route('/files/<int:topic_id>', methods=['GET'])
+@api.route('/files/<int:topic_id>', methods=['GET'])
+@cache.cached('files')
 def get_files(topic_id):
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("SELECT name, section FROM files WHERE topic_id = %s", (topic_id,))
     rows = cur.fetchall()
     cur.close()
-    conn.close()
 
     grouped = {'plans': [], 'tasks': [], 'docs': []}
     for name, section in rows:
@@ -303,32 +481,44 @@ def get_files(topic_id):
     return jsonify(grouped)
 
 
-@app.route('/files/delete', methods=['POST'])
+@api.route('/files/delete', methods=['POST'])
 def delete_file():
     data = request.get_json()
     topic_id = data['topic_id']
     name = data['name']
-    section = data['section']
 
     conn = get_db_connection()
     cur = conn.cursor()
+    # Removes its task or control row too.
+    cascade.delete_file(cur, topic_id, name)
+    events.publish_change(cur, *cascade.TOUCHES['file'])
+    conn.commit()
+    cur.close()
+    return '', 200
 
-    # Delete from files table
-    cur.execute("DELETE FROM files WHERE topic_id = %s AND name = %s", (topic_id, name))
-
-    # Delete from tasks or control table
-    if section == 'tasks':
-        cur.execute("DELETE FROM tasks WHERE topic_id = %s AND file_name = %s", (topic_id, name))
-    elif section in ['plans', 'docs']:
-        cur.execute("DELETE FROM control WHERE topic_id = %s AND name_file = %s", (topic_id, name))
 
+# Body: {topic_id, section, old_name, new_name}; the file's task or control
+# row is renamed with it.
+@api.route('/files/rename', methods=['POST'])
+def rename_file():
+    data = request.get_json()
+    writebehind.buffer.flush_key(('files', data['topic_id'], data['old_name']))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        found = cascade.rename_file(cur, data['topic_id'], data['old_name'], data['new_name'])
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({'error': 'A file with this name already exists'}), 409
+    if not found:
+        return jsonify({'error': 'File not found'}), 404
+    events.publish_change(cur, *cascade.TOUCHES['file'])
     conn.commit()
     cur.close()
-    conn.close()
     return '', 200
 
 
-@app.route('/files/add', methods=['POST'])
+@api.route('/files/add', methods=['POST'])
 def add_file():
     data = request.get_json()
     section = data['section']
@@ -346,50 +536,93 @@ def add_file():
 
     # If this is a task section, add to tasks table
     if section == 'tasks':
-        task_cur = conn.cursor()
-        task_cur.execute("SELECT COUNT(*) FROM tasks WHERE section = 'בהמשך'")
-        order = task_cur.fetchone()[0]
-        task_cur.execute("""
+        cur.execute("""
             INSERT INTO tasks (topic_id, file_name, section, "order")
-            VALUES (%s, %s, 'בהמשך', %s)
-        """, (topic_id, name, order))
-        task_cur.close()
+            VALUES (%%s, %%s, %%s, %s)
+        """ % ordering.next_key_sql('tasks'), (topic_id, name, 'בהמשך', 'בהמשך'))
 
     # If plans/docs, add to control table
     elif section in ['plans', 'docs']:
         is_plan = (section == 'plans')
-        control_cur = conn.cursor()
-        control_cur.execute("SELECT COUNT(*) FROM control WHERE is_plan = %s AND modification_alert = FALSE", (is_plan,))
-        order_index = control_cur.fetchone()[0]
-        control_cur.execute("""
+        cur.execute("""
             INSERT INTO control (name_file, topic_id, is_plan, order_index, modification_alert)
-            VALUES (%s, %s, %s, %s, FALSE)
-        """, (name, topic_id, is_plan, order_index))
-        control_cur.close()
+            VALUES (%%s, %%s, %%s, %s, FALSE)
+        """ % ordering.next_key_sql('control'), (name, topic_id, is_plan, is_plan))
 
+    events.publish_change(cur, 'files', 'tasks' if section == 'tasks' else 'control')
     conn.commit()
     cur.close()
-    conn.close()
     return '', 200
 
 
 # ----------FILES CONTENT ----------
-@app.route('/file_content', methods=['POST'])
+@api.route('/file_content', methods=['POST'])
 def save_file_content():
     data = request.get_json()
+    value = (data['topic_id'], data['name'], data['content'])
+    if writebehind.buffer.enabled and writebehind.buffer.submit(
+            ('files', data['topic_id'], data['name']), value,
+            writebehind.last_wins, write_file_content, ['files']):
+        return jsonify({'revision': None, 'queued': True}), 200
+
     conn = get_db_connection()
     cur = conn.cursor()
+    revision = write_file_content(cur, value)
+    events.publish_change(cur, 'files')
+    conn.commit()
+    cur.close()
+    return jsonify({'revision': revision}), 200
+
+
+def write_file_content(cur, value):
+    topic_id, name, content = value
     cur.execute("""
         UPDATE files
-        SET content = %s
+        SET content = %s, revision = revision + 1
         WHERE topic_id = %s AND name = %s
-    """, (json.dumps(data['content']), data['topic_id'], data['name']))
+        RETURNING revision
+    """, (json.dumps(content), topic_id, name))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+# Apply block-level edits instead of resending the whole document:
+# {topic_id, name, base_revision, ops: [...]} (op format in
+# migrations/004_file_revisions.up.sql). With base_revision set, the patch
+# is rejected with 409 if the file changed since that revision.
+@api.route('/file_content/patch', methods=['POST'])
+def patch_file_content():
+    data = request.get_json()
+    base_revision = data.get('base_revision')
+    writebehind.buffer.flush_key(('files', data['topic_id'], data['name']))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE files
+            SET content = files_apply_patch(content, %s), revision = revision + 1
+            WHERE topic_id = %s AND name = %s AND (%s::integer IS NULL OR revision = %s)
+            RETURNING revision
+        """, (Json(data['ops']), data['topic_id'], data['name'], base_revision, base_revision))
+    except psycopg2.errors.InvalidParameterValue as e:
+        conn.rollback()
+        return jsonify({'error': e.diag.message_primary}), 400
+    row = cur.fetchone()
+
+    if row is None:
+        cur.execute("SELECT revision FROM files WHERE topic_id = %s AND name = %s",
+                    (data['topic_id'], data['name']))
+        current = cur.fetchone()
+        cur.close()
+        if current is None:
+            return jsonify({'error': 'File not found'}), 404
+        return jsonify({'error': 'Revision conflict', 'revision': current[0]}), 409
+
+    events.publish_change(cur, 'files')
     conn.commit()
     cur.close()
-    conn.close()
-    return '', 200
+    return jsonify({'revision': row[0]})
 
-@app.route('/file_link/toggle', methods=['POST'])
+@api.route('/file_link/toggle', methods=['POST'])
 def toggle_file_link():
     data = request.get_json()
     conn = get_db_connection()
@@ -399,112 +632,140 @@ def toggle_file_link():
         SET linked = NOT linked
         WHERE topic_id = %s AND name = %s
     """, (data['topic_id'], data['name']))
+    events.publish_change(cur, 'files')
     conn.commit()
     cur.close()
-    conn.close()
     return '', 200
 
 
-@app.route('/file_info', methods=['GET'])
+@api.route('/file_info', methods=['GET'])
+@cache.cached('files')
 def get_file_info():
     topic_id = request.args.get('topic_id')
     file_name = request.args.get('file_name')
+    writebehind.buffer.flush_key(('files', request.args.get('topic_id', type=int), file_name))
 
     conn = get_db_connection()
     cur = conn.cursor()
+    # content is read as JSON text and spliced in as is: no parse and
+    # re-encode of what can be a large document.
     cur.execute("""
-        SELECT content, linked FROM files
+        SELECT content::text, linked, revision FROM files
         WHERE topic_id = %s AND name = %s
     """, (topic_id, file_name))
     row = cur.fetchone()
     cur.close()
-    conn.close()
 
     if row:
-        return jsonify({'content': row[0], 'linked': row[1]})
+        return Response('{"content": %s, "linked": %s, "revision": %d}' % (row[0], json.dumps(row[1]), row[2]),
+                        mimetype='application/json')
     else:
         return jsonify({'error': 'File not found'}), 404
 
 
 # ---------- LISTS OF FILES ----------
 
-@app.route('/linked_files', methods=['GET'])
+# The list routes below also take ?limit=&cursor= for keyset pages and
+# ?stream=ndjson|json for a streamed export (see pagination.py).
+
+LINKED_FILES = KeysetList(
+    'files f JOIN topics t ON f.topic_id = t.id',
+    ['f.topic_id', 'f.name', 'f.section'], ['f.topic_id', 'f.name'],
+    lambda row: {
+        'topic_id': row[0],
+        'file_name': row[1],
+        'section': row[2]
+    },
+    where='f.linked = TRUE', key_types=(int, str),
+)
+
+@api.route('/linked_files', methods=['GET'])
 def get_linked_files():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT f.topic_id, f.name, f.section
-        FROM files f
-        JOIN topics t ON f.topic_id = t.id
-        WHERE f.linked = TRUE
-    """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    return pagination.respond(LINKED_FILES)
 
-    result = [
-        {
-            'topic_id': row[0],
-            'file_name': row[1],
-            'section': row[2]
-        }
-        for row in rows
-    ]
-    return jsonify(result)
+
+load_linked_files = LINKED_FILES.query()
 
 # ---------- TASKS ----------
 
-@app.route('/unclassified_tasks')
+UNCLASSIFIED_TASKS = KeysetList(
+    'unclassified_tasks', ['"order"', 'content'], ['"order"', 'content'],
+    lambda r: {'order': r[0], 'content': r[1], 'topic_id': 1},  # Use dummy topic_id=1 for coloring
+    key_types=(float, str),
+)
+
+@api.route('/unclassified_tasks')
 def get_unclassified():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT \"order\", content FROM unclassified_tasks ORDER BY \"order\"")
-    rows = cur.fetchall()
-    return jsonify([{'order': r[0], 'content': r[1], 'topic_id': 1} for r in rows])  # Use dummy topic_id=1 for coloring
+    return pagination.respond(UNCLASSIFIED_TASKS)
 
-@app.route('/tasks')
+
+load_unclassified = UNCLASSIFIED_TASKS.query()
+
+
+TASKS = KeysetList(
+    'tasks', ['topic_id', 'file_name', 'section', '"order"'], ['section', '"order"', 'topic_id', 'file_name'],
+    lambda r: {'topic_id': r[0], 'file_name': r[1], 'section': r[2], 'order': r[3]},
+    key_types=(str, float, int, str),
+)
+
+@api.route('/tasks')
 def get_tasks():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT topic_id, file_name, section, \"order\" FROM tasks")
-    rows = cur.fetchall()
-    return jsonify([{'topic_id': r[0], 'file_name': r[1], 'section': r[2], 'order': r[3]} for r in rows])
+    return pagination.respond(TASKS)
 
-@app.route('/reorder_task', methods=['POST'])
+
+load_tasks = TASKS.query()
+
+# The reorder endpoints take each row's position in the client's list
+# (any increasing numbers, the client sends dense indices) and answer with
+# the stored keys; see ordering.py.
+@api.route('/reorder_task', methods=['POST'])
 def reorder_task():
     conn = get_db_connection()
     cur = conn.cursor()
     data = request.json
     tasks = data['tasks']  # list of {topic_id, file_name, order, section}
 
-    for task in tasks:
-        cur.execute("""
-            UPDATE tasks
-            SET section = %s, \"order\" = %s
-            WHERE topic_id = %s AND file_name = %s
-        """, (task['section'], task['order'], task['topic_id'], task['file_name']))
+    sections = {}
+    for task in sorted(tasks, key=lambda t: t['order']):
+        sections.setdefault(task['section'], []).append((task['topic_id'], task['file_name']))
 
+    result = []
+    written = 0
+    crowded_sections = []
+    for section, keys in sections.items():
+        count, crowded, new_ordering = ordering.reorder(cur, 'tasks', [section], keys)
+        written += count
+        if crowded:
+            crowded_sections.append(section)
+        result.extend({'topic_id': key[0], 'file_name': key[1], 'section': section, 'order': order}
+                      for key, order in new_ordering)
+
+    for section in crowded_sections:
+        ordering.schedule_rebalance(cur, 'tasks', [section])
+    events.publish_change(cur, 'tasks')
     conn.commit()
-    return jsonify({'status': 'success'})
+    cur.close()
+    return jsonify({'status': 'success', 'updated': written, 'tasks': result})
 
-@app.route('/reorder_unclassified', methods=['POST'])
+@api.route('/reorder_unclassified', methods=['POST'])
 def reorder_unclassified():
     conn = get_db_connection()
     cur = conn.cursor()
     data = request.json
     tasks = data['tasks']
 
-    for task in tasks:
-        cur.execute("""
-            UPDATE unclassified_tasks
-            SET \"order\" = %s
-            WHERE content = %s
-        """, (task['order'], task['content']))
+    keys = [(t['content'],) for t in sorted(tasks, key=lambda t: t['order'])]
+    written, crowded, new_ordering = ordering.reorder(cur, 'unclassified_tasks', [], keys)
 
+    if crowded:
+        ordering.schedule_rebalance(cur, 'unclassified_tasks')
+    events.publish_change(cur, 'unclassified_tasks')
     conn.commit()
-    return jsonify({'status': 'success'})
+    cur.close()
+    result = [{'content': key[0], 'order': order} for key, order in new_ordering]
+    return jsonify({'status': 'success', 'updated': written, 'tasks': result})
 
-@app.route('/add_task', methods=['POST'])
+@api.route('/add_task', methods=['POST'])
 def add_task():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -512,27 +773,26 @@ def add_task():
     topic_id = data['topic_id']
     file_name = data['file_name']
 
-    cur.execute("SELECT COUNT(*) FROM tasks WHERE section = 'בהמשך'")
-    order = cur.fetchone()[0]
-    cur.execute("INSERT INTO tasks (topic_id, file_name, section, \"order\") VALUES (%s, %s, %s, %s)",
-                   (topic_id, file_name, 'בהמשך', order))
+    cur.execute("INSERT INTO tasks (topic_id, file_name, section, \"order\") VALUES (%%s, %%s, %%s, %s)"
+                % ordering.next_key_sql('tasks'), (topic_id, file_name, 'בהמשך', 'בהמשך'))
+    events.publish_change(cur, 'tasks')
     conn.commit()
     return jsonify({'status': 'task added'})
 
-@app.route('/add_unclassified', methods=['POST'])
+@api.route('/add_unclassified', methods=['POST'])
 def add_unclassified():
     conn = get_db_connection()
     cur = conn.cursor()
     data = request.json
     content = data['content']
 
-    cur.execute("SELECT COUNT(*) FROM unclassified_tasks")
-    order = cur.fetchone()[0]
-    cur.execute("INSERT INTO unclassified_tasks (\"order\", content) VALUES (%s, %s)", (order, content))
+    cur.execute("INSERT INTO unclassified_tasks (\"order\", content) VALUES (%s, %%s)"
+                % ordering.next_key_sql('unclassified_tasks'), (content,))
+    events.publish_change(cur, 'unclassified_tasks')
     conn.commit()
     return jsonify({'status': 'unclassified task added'})
 
-@app.route('/delete_unclassified', methods=['POST'])
+@api.route('/delete_unclassified', methods=['POST'])
 def delete_unclassified():
     data = request.json
     conn = get_db_connection()
@@ -546,34 +806,33 @@ def delete_unclassified():
     if cur.rowcount == 0:
         return jsonify({'error': 'Task not found'}), 404
 
+    events.publish_change(cur, 'unclassified_tasks')
     conn.commit()
     return jsonify({'status': 'deleted'})
 
 
-@app.route('/delete_task_and_file', methods=['POST'])
+@api.route('/delete_task_and_file', methods=['POST'])
 def delete_task_and_file():
     data = request.json
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM tasks WHERE topic_id = %s AND file_name = %s",
-                (data['topic_id'], data['file_name']))
-    cur.execute("DELETE FROM files WHERE topic_id = %s AND name = %s",
-                (data['topic_id'], data['file_name']))
+    cascade.delete_file(cur, data['topic_id'], data['file_name'])
+    events.publish_change(cur, *cascade.TOUCHES['file'])
     conn.commit()
     return jsonify({'status': 'deleted'})
 
 # ---------------- TRACKING ----------------
-@app.route('/get_food')
+FOOD = KeysetList(
+    'food', ['name', 'calories', 'protein', 'id'], ['id'],
+    lambda r: {'name': r[0], 'calories': r[1], 'protein': r[2]},
+    where='date = %s', key_types=(int,),
+)
+
+@api.route('/get_food')
 def get_food():
-    date = request.args.get('date')
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name, calories, protein FROM food WHERE date = %s", (date,))
-    rows = cur.fetchall()
-    result = [{'name': r[0], 'calories': r[1], 'protein': r[2]} for r in rows]
-    return jsonify(result)
+    return pagination.respond(FOOD, (request.args.get('date'),))
 
-@app.route('/add_food', methods=['POST'])
+@api.route('/add_food', methods=['POST'])
 def add_food():
     data = request.json
     conn = get_db_connection()
@@ -582,16 +841,26 @@ def add_food():
         "INSERT INTO food (date, name, calories, protein) VALUES (%s, %s, %s, %s)",
         (data['date'], data['name'], data['calories'], data['protein'])
     )
+    events.publish_change(cur, 'food')
     conn.commit()
     return jsonify({'status': 'success'})
 
-@app.route('/get_tracking')
+@api.route('/get_tracking')
 def get_tracking():
-    reset_tracking_daily()  # call it here automatically
+    writebehind.buffer.flush_prefix(('tracking',))
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT name, time, amount, done, content FROM tracking")
-    rows = cur.fetchall()
+    result = load_tracking(cur)
+    cur.close()
+    return jsonify(result)
+
+
+def today_twice():
+    today_str = date.today().strftime('%Y-%m-%d')
+    return today_str, today_str
+
+
+def tracking_items(rows):
     result = []
     for r in rows:
         result.append({
@@ -601,47 +870,118 @@ def get_tracking():
             'done': r[3],
             'content': r[4]
         })
-    return jsonify(result)
+    return result
 
-@app.route('/reset_tracking_daily')
+
+# Read-only: rows not yet reset today read as reset, so the daily reset
+# never has to run on this path.
+load_tracking = Query("""
+    SELECT name, %s, amount, CASE WHEN time = %s THEN done ELSE 0 END, content
+    FROM tracking
+""", tracking_items, today_twice)
+
+@api.route('/reset_tracking_daily')
 def reset_tracking_daily():
-    today_str = date.today().strftime('%Y-%m-%d')
+    # The reset itself runs as a job; reads already see unreset rows as reset.
     conn = get_db_connection()
     cur = conn.cursor()
+    jobs.enqueue(cur, 'tracking_reset', dedupe='tracking_reset')
+    conn.commit()
+    cur.close()
+    return jsonify({'status': 'reset queued'})
 
-    # Get all items where time < today
-    cur.execute("SELECT name, time FROM tracking")
-    rows = cur.fetchall()
 
-    for name, t in rows:
-        if t != today_str:
-            cur.execute("UPDATE tracking SET done = 0, time = %s WHERE name = %s", (today_str, name))
+@jobs.handler('tracking_reset')
+def tracking_reset_job(conn, args):
+    with conn.cursor() as cur:
+        if ensure_tracking_reset(cur):
+            events.publish_change(cur, 'tracking')
 
-    conn.commit()
-    return jsonify({'status': 'reset done where needed'})
 
+# Right after midnight, so the day's first tracking write does not pay for it.
+jobs.schedule('tracking_reset', '0 0 * * *', 'tracking_reset')
 
-@app.route('/update_tracking_done', methods=['POST'])
+
+def reset_tracking(cur):
+    """Zero every item not yet reset today, in one statement. Returns the number of rows reset."""
+    today_str = date.today().strftime('%Y-%m-%d')
+    cur.execute("""
+        UPDATE tracking SET done = 0, time = %s WHERE time IS DISTINCT FROM %s
+    """, (today_str, today_str))
+    return cur.rowcount
+
+
+_tracking_reset_dates = {}  # tenant id -> date of its last reset seen by this process
+
+def ensure_tracking_reset(cur):
+    """Run reset_tracking once per day for the current tenant, before its first tracking write.
+
+    The first worker to claim the tenant's maintenance_runs row for today
+    does the reset; the others (and later calls in this process) skip it.
+    Usually the tracking_reset job has claimed it by then. Returns the
+    number of rows reset.
+    """
+    tenant = tenants.current()
+    today = date.today()
+    if _tracking_reset_dates.get(tenant) == today:
+        return 0
+    cur.execute("""
+        INSERT INTO maintenance_runs (name, last_run) VALUES ('tracking_reset', %s)
+        ON CONFLICT (tenant_id, name) DO UPDATE SET last_run = EXCLUDED.last_run
+        WHERE maintenance_runs.last_run < EXCLUDED.last_run
+        RETURNING last_run
+    """, (today,))
+    count = reset_tracking(cur) if cur.fetchone() else 0
+    _tracking_reset_dates[tenant] = today
+    return count
+
+
+@api.route('/update_tracking_done', methods=['POST'])
 def update_tracking_done():
     data = request.json
     name = data['name']
     index = data['index']
     checked = data['checked']
 
+    # Buffered taps on one item are replayed in order when flushed.
+    value = (name, [checked])
+    if writebehind.buffer.enabled and writebehind.buffer.submit(
+            ('tracking', name), value, merge_tracking_taps, apply_tracking_taps, ['tracking']):
+        return jsonify({'status': 'queued'})
+
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT done FROM tracking WHERE name = %s", (name,))
-    current_done = cur.fetchone()[0] or 0
-
-    new_done = current_done + 1 if checked else current_done - 1
-    new_done = max(0, new_done)  # prevent negative
-
-    cur.execute("UPDATE tracking SET done = %s WHERE name = %s", (new_done, name))
+    apply_tracking_taps(cur, value)
+    events.publish_change(cur, 'tracking')
     conn.commit()
     return jsonify({'status': 'updated'})
 
 
-@app.route('/add_tracking_item', methods=['POST'])
+def merge_tracking_taps(old, new):
+    return old[0], old[1] + new[1]
+
+
+def apply_tracking_taps(cur, value):
+    name, taps = value
+    today_str = date.today().strftime('%Y-%m-%d')
+    ensure_tracking_reset(cur)
+    # Count from zero if the row still holds an earlier day, in case this
+    # process skipped the reset that another worker claimed but rolled back.
+    cur.execute("""
+        SELECT CASE WHEN time = %s THEN done ELSE 0 END FROM tracking WHERE name = %s FOR UPDATE
+    """, (today_str, name))
+    row = cur.fetchone()
+    if row is None:
+        return
+    new_done = row[0] or 0
+    for checked in taps:
+        new_done = new_done + 1 if checked else new_done - 1
+        new_done = max(0, new_done)  # prevent negative
+
+    cur.execute("UPDATE tracking SET done = %s, time = %s WHERE name = %s", (new_done, today_str, name))
+
+
+@api.route('/add_tracking_item', methods=['POST'])
 def add_tracking_item():
     data = request.json
     name = data['name']
@@ -649,15 +989,17 @@ def add_tracking_item():
     content = data['content']
     conn = get_db_connection()
     cur = conn.cursor()
+    ensure_tracking_reset(cur)
     cur.execute(
         "INSERT INTO tracking (name, time, amount, done, content) VALUES (%s, %s, %s, %s, %s)",
         (name, datetime.now().strftime('%Y-%m-%d'), amount, 0, content)
     )
+    events.publish_change(cur, 'tracking')
     conn.commit()
     return jsonify({'status': 'added'})
 
 
-@app.route('/delete_food', methods=['POST'])
+@api.route('/delete_food', methods=['POST'])
 def delete_food():
     data = request.json
     name = data['name']
@@ -665,43 +1007,47 @@ def delete_food():
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("DELETE FROM food WHERE name = %s AND date = %s", (name, date_))
+    events.publish_change(cur, 'food')
     conn.commit()
     return jsonify({'status': 'deleted'})
 
 
-@app.route('/delete_tracking_item', methods=['POST'])
+@api.route('/delete_tracking_item', methods=['POST'])
 def delete_tracking_item():
     data = request.json
     name = data['name']
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("DELETE FROM tracking WHERE name = %s", (name,))
+    events.publish_change(cur, 'tracking')
     conn.commit()
     return jsonify({'status': 'deleted'})
 
 
 # ---------- CONTROL ----------
 
-@app.route('/get_control_files')
+CONTROL_FILES = KeysetList(
+    'control', ['name_file', 'topic_id', 'is_plan', 'order_index', 'modification_alert'], ['topic_id', 'name_file'],
+    lambda r: {
+        'name_file': r[0],
+        'topic_id': r[1],
+        'is_plan': r[2],
+        'order_index': r[3],
+        'modification_alert': r[4]
+    },
+    key_types=(int, str),
+)
+
+@api.route('/get_control_files')
 def get_control_files():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name_file, topic_id, is_plan, order_index, modification_alert FROM control")
-    rows = cur.fetchall()
-    result = [
-        {
-            'name_file': r[0],
-            'topic_id': r[1],
-            'is_plan': r[2],
-            'order_index': r[3],
-            'modification_alert': r[4]
-        }
-        for r in rows
-    ]
-    return jsonify(result)
+    writebehind.buffer.flush_prefix(('control',))
+    return pagination.respond(CONTROL_FILES)
+
+
+load_control_files = CONTROL_FILES.query()
 
 
-@app.route('/update_control_file', methods=['POST'])
+@api.route('/update_control_file', methods=['POST'])
 def update_control_file():
     data = request.json
     name_file = data['name_file']
@@ -710,22 +1056,32 @@ def update_control_file():
     modification_alert = data['modification_alert']
     order_index = data['order_index']
 
+    value = (is_plan, modification_alert, order_index, name_file, topic_id)
+    if writebehind.buffer.enabled and writebehind.buffer.submit(
+            ('control', topic_id, name_file), value, writebehind.last_wins, write_control_file, ['control']):
+        return jsonify({'status': 'queued'})
+
     conn = get_db_connection()
     cur = conn.cursor()
+    write_control_file(cur, value)
+    events.publish_change(cur, 'control')
+    conn.commit()
+    return jsonify({'status': 'updated'})
+
+
+def write_control_file(cur, value):
     cur.execute(
         """UPDATE control
            SET is_plan = %s, modification_alert = %s, order_index = %s
            WHERE name_file = %s AND topic_id = %s""",
-        (is_plan, modification_alert, order_index, name_file, topic_id)
+        value
     )
-    conn.commit()
-    return jsonify({'status': 'updated'})
 
 
 # ---------------- GREEN NOTE SYSTEM ----------------
 
 # Save or update list of topics
-@app.route('/green_note_topics', methods=['POST'])
+@api.route('/green_note_topics', methods=['POST'])
 def save_green_note_topics():
     data = request.get_json()
     topics = data.get('topics', [])
@@ -734,103 +1090,272 @@ def save_green_note_topics():
     cur.execute("DELETE FROM green_note_topics")
     for topic in topics:
         cur.execute("INSERT INTO green_note_topics (name) VALUES (%s)", (topic,))
+    events.publish_change(cur, 'green_note_topics')
     conn.commit()
     cur.close()
-    conn.close()
     return jsonify({'status': 'topics saved'})
 
 # Get current topic list
-@app.route('/green_note_topics', methods=['GET'])
+@api.route('/green_note_topics', methods=['GET'])
+@cache.cached('green_note_topics')
 def get_green_note_topics():
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT name FROM green_note_topics")
-    topics = [row[0] for row in cur.fetchall()]
+    topics = load_green_note_topics(cur)
     cur.close()
-    conn.close()
     return jsonify(topics)
 
+
+load_green_note_topics = Query("SELECT name FROM green_note_topics", lambda rows: [row[0] for row in rows])
+
 # Save or overwrite a green note version
-@app.route('/green_notes', methods=['POST'])
+@api.route('/green_notes', methods=['POST'])
 def save_green_note():
     data = request.get_json()
     signature = data['signature']
     conn = get_db_connection()
     cur = conn.cursor()
 
-    cur.execute("DELETE FROM green_notes WHERE signature = %s", (signature,))
+    # Upsert the note and replace its scores in one statement.
     cur.execute("""
-        INSERT INTO green_notes (signature, date, good_1, good_2, good_3, improve)
-        VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+        WITH note AS (
+            INSERT INTO green_notes (signature, date, good_1, good_2, good_3, improve)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (tenant_id, signature) DO UPDATE
+            SET date = EXCLUDED.date, good_1 = EXCLUDED.good_1, good_2 = EXCLUDED.good_2,
+                good_3 = EXCLUDED.good_3, improve = EXCLUDED.improve
+            RETURNING id
+        ), old_scores AS (
+            DELETE FROM green_note_scores WHERE note_id = (SELECT id FROM note)
+        )
+        INSERT INTO green_note_scores (note_id, category, score)
+        SELECT note.id, s.category, s.score
+        FROM note, jsonb_to_recordset(%s) AS s (category text, score integer)
     """, (
         signature, data['date'], data['good_1'], data['good_2'],
-        data['good_3'], data['improve']
+        data['good_3'], data['improve'], Json(data['scores'])
     ))
-    note_id = cur.fetchone()[0]
-
-    cur.execute("DELETE FROM green_note_scores WHERE note_id = %s", (note_id,))
-    for score in data['scores']:
-        cur.execute("""
-            INSERT INTO green_note_scores (note_id, category, score)
-            VALUES (%s, %s, %s)
-        """, (note_id, score['category'], score['score']))
 
+    events.publish_change(cur, 'green_notes', 'green_note_scores')
     conn.commit()
     cur.close()
-    conn.close()
     return jsonify({'status': 'note saved'})
 
 # Get all note signatures (for determining latest version per day)
-@app.route('/green_notes/signatures', methods=['GET'])
+GREEN_NOTE_SIGNATURES = KeysetList(
+    'green_notes', ['signature', 'date'], ['date', 'signature'], lambda row: row[0], key_types=(str, str),
+)
+
+@api.route('/green_notes/signatures', methods=['GET'])
+@cache.cached('green_notes')
 def get_all_green_note_signatures():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT signature FROM green_notes ORDER BY date, signature")
-    signatures = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return jsonify(signatures)
+    return pagination.respond(GREEN_NOTE_SIGNATURES)
 
-# Get a note by its signature
-@app.route('/green_notes/version/<signature>', methods=['GET'])
-def get_green_note_by_signature(signature):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, date, good_1, good_2, good_3, improve
-        FROM green_notes WHERE signature = %s
-    """, (signature,))
-    row = cur.fetchone()
-    if not row:
-        return jsonify(None)
 
-    note_id = row[0]
-    cur.execute("SELECT category, score FROM green_note_scores WHERE note_id = %s", (note_id,))
-    scores = [{'category': r[0], 'score': r[1]} for r in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return jsonify({
-        'signature': signature,
+load_green_note_signatures = GREEN_NOTE_SIGNATURES.query()
+
+# A note with its scores, read in one query.
+GREEN_NOTE_COLUMNS = [
+    'n.signature', 'n.date', 'n.good_1', 'n.good_2', 'n.good_3', 'n.improve',
+    """(SELECT COALESCE(json_agg(json_build_object('category', s.category, 'score', s.score)), '[]')
+        FROM green_note_scores s WHERE s.note_id = n.id)""",
+]
+
+
+def green_note_item(row):
+    return {
+        'signature': row[0],
         'date': row[1],
         'good_1': row[2],
         'good_2': row[3],
         'good_3': row[4],
         'improve': row[5],
-        'scores': scores
-    })
+        'scores': row[6]
+    }
 
+# Get a note by its signature
+@api.route('/green_notes/version/<signature>', methods=['GET'])
+def get_green_note_by_signature(signature):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT %s FROM green_notes n WHERE n.signature = %%s" % ', '.join(GREEN_NOTE_COLUMNS),
+                (signature,))
+    row = cur.fetchone()
+    cur.close()
+    return jsonify(green_note_item(row) if row else None)
+
+
+# Every version dated within ?from=&to= (both optional, inclusive), oldest
+# first, each shaped like /green_notes/version/<signature>. Also pages and
+# streams like the other lists.
+GREEN_NOTES = KeysetList(
+    'green_notes n', GREEN_NOTE_COLUMNS, ['n.date', 'n.signature'], green_note_item,
+    where='(%s::text IS NULL OR n.date >= %s) AND (%s::text IS NULL OR n.date <= %s)', key_types=(str, str),
+)
+
+@api.route('/green_notes', methods=['GET'])
+@cache.cached('green_notes', 'green_note_scores')
+def get_green_notes():
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    return pagination.respond(GREEN_NOTES, (date_from, date_from, date_to, date_to))
 
-@app.route('/green_notes/<signature>', methods=['DELETE'])
+
+@api.route('/green_notes/<signature>', methods=['DELETE'])
 def delete_green_note(signature):
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("DELETE FROM green_note_scores WHERE note_id = (SELECT id FROM green_notes WHERE signature = %s)", (signature,))
     cur.execute("DELETE FROM green_notes WHERE signature = %s", (signature,))
+    events.publish_change(cur, 'green_notes', 'green_note_scores')
     conn.commit()
     cur.close()
-    conn.close()
     return jsonify({'status': 'deleted'})
 
 
+# ---------- ANALYTICS ----------
+# Dashboard data in one call, from one snapshot:
+# /analytics?from=YYYY-MM-DD&to=YYYY-MM-DD&window=7&sections=food,scores,tracking
+# (default: the year up to today, every section).
+
+ANALYTICS_SECTIONS = {
+    'food': lambda cur, args: analytics.food_totals(cur, args['from'], args['to']),
+    'scores': lambda cur, args: analytics.score_averages(cur, args['from'], args['to'], args['window']),
+    'tracking': lambda cur, args: analytics.tracking_streaks(cur),
+}
+
+def analytics_cache_vary():
+    # The default range and the streaks end today: a cached answer from
+    # yesterday must not be served for the same URL.
+    try:
+        return analytics.date_range(request.args.get('from'), request.args.get('to')), date.today()
+    except ValueError:
+        return None
+
+@api.route('/analytics')
+@cache.cached('food', 'green_notes', 'green_note_scores', 'tracking', vary=analytics_cache_vary)
+def get_analytics():
+    sections = request.args.get('sections')
+    names = sections.split(',') if sections else list(ANALYTICS_SECTIONS)
+    unknown = [name for name in names if name not in ANALYTICS_SECTIONS]
+    if unknown:
+        return jsonify({'error': 'Unknown sections: %s' % ', '.join(unknown)}), 400
+    try:
+        date_from, date_to = analytics.date_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM-DD'}), 400
+    args = {'from': date_from, 'to': date_to,
+            'window': max(1, min(request.args.get('window', analytics.DEFAULT_WINDOW, type=int), 365))}
+
+    writebehind.buffer.flush_prefix(('tracking',))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    begin_snapshot(cur)
+    result = {name: ANALYTICS_SECTIONS[name](cur, args) for name in names}
+    conn.commit()
+    cur.close()
+    result.update({'from': date_from, 'to': date_to})
+    return jsonify(result)
+
+
+# ---------- BATCH ----------
+# {ops: [{path, method, body}, ...], atomic: false} runs queued edits in one
+# transaction and answers {results: [{status, body}, ...], committed}; see
+# batch.py. Only the data mutations below may be batched.
+
+BATCH_ENDPOINTS = {'api.' + name for name in (
+    'add_house', 'delete_house', 'edit_house',
+    'add_topic', 'edit_topic', 'delete_topic', 'move_topic', 'toggle_flat',
+    'add_file', 'delete_file', 'rename_file', 'save_file_content', 'patch_file_content', 'toggle_file_link',
+    'add_task', 'reorder_task', 'delete_task_and_file',
+    'add_unclassified', 'reorder_unclassified', 'delete_unclassified',
+    'add_food', 'delete_food', 'add_tracking_item', 'update_tracking_done', 'delete_tracking_item',
+    'update_control_file',
+    'save_green_note_topics', 'save_green_note', 'delete_green_note',
+)}
+
+@api.route('/batch', methods=['POST'])
+def run_batch():
+    data = request.get_json()
+    try:
+        results, committed = batch.run(data.get('ops'), BATCH_ENDPOINTS, bool(data.get('atomic')))
+    except batch.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results, 'committed': committed})
+
+
+# ---------- JOBS ----------
+# The tenant's background jobs (see jobs.py): /jobs?status=failed&kind=rebalance
+# (default: pending, running and failed), newest first.
+
+@api.route('/jobs')
+def list_jobs():
+    statuses = request.args.getlist('status') or ['pending', 'running', 'failed']
+    unknown = [s for s in statuses if s not in jobs.STATUSES]
+    if unknown:
+        return jsonify({'error': 'Unknown statuses: %s' % ', '.join(unknown)}), 400
+    conn = get_db_connection()
+    cur = conn.cursor()
+    result = {
+        'counts': jobs.counts(cur, tenants.current()),
+        'jobs': jobs.listing(cur, statuses=statuses, kind=request.args.get('kind'),
+                             limit=max(1, min(request.args.get('limit', 100, type=int), 1000))),
+    }
+    cur.close()
+    return jsonify(result)
+
+@api.route('/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        found = jobs.retry(cur, job_id)
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({'error': 'The same job is already pending'}), 409
+    if not found:
+        return jsonify({'error': 'No failed job with this id'}), 404
+    conn.commit()
+    cur.close()
+    return jsonify({'status': 'queued'})
+
+
+# ---------- BOOTSTRAP ----------
+# Everything the client loads on startup, read on one connection from one
+# snapshot. ?sections=houses,tasks picks a subset; the body is compressed
+# when the client accepts gzip or brotli.
+
+BOOTSTRAP_SECTIONS = {
+    'houses': load_houses,
+    'directories': load_directories,
+    'tasks': load_tasks,
+    'unclassified_tasks': load_unclassified,
+    'control_files': load_control_files,
+    'linked_files': load_linked_files,
+    'tracking': load_tracking,
+    'green_note_topics': load_green_note_topics,
+    'green_note_signatures': load_green_note_signatures,
+}
+
+@api.route('/bootstrap')
+def bootstrap():
+    sections = request.args.get('sections')
+    names = sections.split(',') if sections else list(BOOTSTRAP_SECTIONS)
+    unknown = [name for name in names if name not in BOOTSTRAP_SECTIONS]
+    if unknown:
+        return jsonify({'error': 'Unknown sections: %s' % ', '.join(unknown)}), 400
+
+    # Only this tenant's buffered writes; other tenants' stay off this request.
+    writebehind.buffer.flush_prefix(())
+    conn = get_db_connection()
+    cur = conn.cursor()
+    begin_snapshot(cur)
+    result = {name: BOOTSTRAP_SECTIONS[name](cur) for name in names}
+    conn.commit()
+    cur.close()
+    return jsonify(result)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    # Development server only; production runs gunicorn.
+    create_app().run(host='0.0.0.0', port=5000)
@@ -0,0 +1,263 @@
+"""ASGI entry point: ``uvicorn asgi:application --workers N``.
+
+The hot reads run natively on the event loop over a psycopg 3 async pool:
+
+* GET /bootstrap reads its sections concurrently over several connections
+  that share one exported snapshot, so the result is still consistent;
+* GET /houses, /directories, /tasks, /unclassified_tasks,
+  /get_control_files and /get_tracking without a query string (the whole
+  list, which is what the client asks for) run their ``db.Query`` on one
+  async connection, behind the same response cache, ETags and write-behind
+  flushes as their Flask views (``NATIVE_READS``).
+
+Every other request, including those lists' pages and streams, and every
+write, is the unchanged Flask view run on asgiref's thread pool. The API
+contract is identical in both modes. The native routes always read the
+primary and do not show up in /metrics.
+"""
+import asyncio
+import os
+from collections import namedtuple
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import jsonify, request
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+import cache
+import compression
+import events
+import tenants
+import writebehind
+from app import (BOOTSTRAP_SECTIONS, create_app, load_control_files, load_directories, load_houses, load_tasks,
+                 load_tracking, load_unclassified)
+from db import dsn
+
+# Connections one /bootstrap spreads its sections over.
+BOOTSTRAP_PARALLELISM = int(os.environ.get('BOOTSTRAP_PARALLELISM', 4))
+
+app = create_app()
+wsgi_application = WsgiToAsgi(app)
+_pool = None
+
+
+async def get_async_pool():
+    global _pool
+    if _pool is None:
+        kwargs = {('dbname' if k == 'database' else k): v for k, v in dsn().items()}
+        _pool = AsyncConnectionPool(
+            kwargs=kwargs,
+            min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+            max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+            timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+            open=False,
+        )
+        await _pool.open()
+    return _pool
+
+
+async def _begin_snapshot(conn, tenant, snapshot=None):
+    """Open a REPEATABLE READ transaction on ``conn`` as ``tenant``, importing ``snapshot`` or exporting a new one."""
+    async with conn.cursor() as cur:
+        await cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        if snapshot is not None:
+            await cur.execute(sql.SQL('SET TRANSACTION SNAPSHOT {}').format(sql.Literal(snapshot)))
+        # Local to the transaction, so the rollback below clears it.
+        await cur.execute("SELECT set_config('app.tenant_id', %s, true)", (str(tenant),))
+        if snapshot is not None:
+            return snapshot
+        await cur.execute('SELECT pg_export_snapshot()')
+        return (await cur.fetchone())[0]
+
+
+async def _read_sections(conn, names):
+    async with conn.cursor() as cur:
+        return {name: await BOOTSTRAP_SECTIONS[name].fetch(cur) for name in names}
+
+
+def _flush_tenant(tenant, prefix=()):
+    with tenants.scope(tenant):
+        writebehind.buffer.flush_prefix(prefix)
+
+
+async def _tenant(headers):
+    """The request's tenant (see tenants.py); raises LookupError for a bad or missing token."""
+    return await asyncio.to_thread(
+        tenants.tenant_for, next((v for k, v in headers if k.lower() == 'authorization'), None))
+
+
+def _request_headers(scope):
+    return [(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']]
+
+
+async def _send(send, response):
+    body = response.get_data()
+    headers = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _error(message, status):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+async def load_bootstrap(names, tenant):
+    pool = await get_async_pool()
+    # Only this tenant's buffered writes; other tenants' stay off this request.
+    await asyncio.to_thread(_flush_tenant, tenant)
+    conns = [await pool.getconn()]
+    try:
+        # Extra connections are only taken if free right now: waiting for
+        # them while holding one could deadlock concurrent requests.
+        while len(conns) < min(BOOTSTRAP_PARALLELISM, len(names)):
+            try:
+                conns.append(await pool.getconn(timeout=0.01))
+            except PoolTimeout:
+                break
+        # The first connection's snapshot stays importable while its
+        # transaction is open, i.e. until the rollback below.
+        snapshot = await _begin_snapshot(conns[0], tenant)
+        await asyncio.gather(*(_begin_snapshot(conn, tenant, snapshot) for conn in conns[1:]))
+        parts = await asyncio.gather(*(
+            _read_sections(conn, names[i::len(conns)]) for i, conn in enumerate(conns)
+        ))
+    finally:
+        for conn in conns:
+            await conn.rollback()
+            await pool.putconn(conn)
+    result = {}
+    for part in parts:
+        result.update(part)
+    return {name: result[name] for name in names}
+
+
+async def bootstrap(scope, receive, send):
+    query = parse_qs(scope['query_string'].decode())
+    sections = query.get('sections', [''])[0]
+    names = sections.split(',') if sections else list(BOOTSTRAP_SECTIONS)
+    unknown = [name for name in names if name not in BOOTSTRAP_SECTIONS]
+    headers = _request_headers(scope)
+    busy = False
+    unauthorized = None
+    result = None
+    try:
+        tenant = await _tenant(headers)
+    except LookupError as e:
+        unauthorized = str(e)
+    if not unknown and unauthorized is None:
+        try:
+            result = await load_bootstrap(names, tenant)
+        except PoolTimeout:
+            busy = True
+
+    # The response is built by Flask so it matches the WSGI route byte for byte.
+    with app.test_request_context(scope['path'], query_string=scope['query_string'], headers=headers):
+        if unauthorized is not None:
+            response = _error(unauthorized, 401)
+        elif unknown:
+            response = _error('Unknown sections: %s' % ', '.join(unknown), 400)
+        elif busy:
+            response = _error('Database busy, try again', 503)
+        else:
+            response = compression.compress(jsonify(result))
+        await _send(send, response)
+
+
+# ---------- native list reads ----------
+
+# ``query``: the whole list as ``endpoint`` returns it; ``cached``: the
+# tables its view is cached under (cache.cached), if any; ``flush``: the
+# write-behind prefix its view flushes first, if any.
+NativeRead = namedtuple('NativeRead', 'endpoint query cached flush')
+
+NATIVE_READS = {
+    '/houses': NativeRead('api.get_houses', load_houses, ('houses',), None),
+    '/directories': NativeRead('api.get_directories', load_directories, ('topics',), None),
+    '/tasks': NativeRead('api.get_tasks', load_tasks, None, None),
+    '/unclassified_tasks': NativeRead('api.get_unclassified', load_unclassified, None, None),
+    '/get_control_files': NativeRead('api.get_control_files', load_control_files, None, ('control',)),
+    '/get_tracking': NativeRead('api.get_tracking', load_tracking, None, ('tracking',)),
+}
+
+
+async def fetch_as(query, tenant):
+    """Run ``query`` as ``tenant`` on a connection of the async pool."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        try:
+            async with conn.cursor() as cur:
+                # Local to the transaction, so the rollback below clears it.
+                await cur.execute("SELECT set_config('app.tenant_id', %s, true)", (str(tenant),))
+                return await query.fetch(cur)
+        finally:
+            await conn.rollback()
+
+
+async def native_read(scope, receive, send):
+    read = NATIVE_READS[scope['path']]
+    headers = _request_headers(scope)
+    error = None
+    entry = result = None
+    try:
+        tenant = await _tenant(headers)
+    except LookupError as e:
+        error = (str(e), 401)
+    if error is None and read.cached:
+        # Other workers' writes reach the cache through the listener.
+        events.get_listener()
+        key = cache.cache_key(tenant, read.endpoint)
+        tags = [(tenant, table) for table in read.cached]
+        entry = cache.response_cache.get(key)
+        generation = cache.response_cache.generation(tags)
+    if error is None and entry is None:
+        try:
+            if read.flush:
+                await asyncio.to_thread(_flush_tenant, tenant, read.flush)
+            result = await fetch_as(read.query, tenant)
+        except PoolTimeout:
+            error = ('Database busy, try again', 503)
+
+    with app.test_request_context(scope['path'], headers=headers):
+        if error is not None:
+            response = _error(*error)
+        else:
+            if entry is None:
+                response = jsonify(result)
+                if read.cached:
+                    entry = cache.make_entry(response, tags)
+                    cache.response_cache.put(key, entry, generation)
+            if entry is not None:
+                response = cache.respond_from(entry, request)
+            response = compression.compress(response)
+        await _send(send, response)
+
+
+ASYNC_ROUTES = {
+    ('GET', '/bootstrap'): bootstrap,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _pool is not None:
+                    await _pool.close()
+                await asyncio.to_thread(writebehind.buffer.flush)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    handler = None
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler is None and scope['method'] == 'GET' and scope['path'] in NATIVE_READS \
+                and not scope['query_string']:
+            handler = native_read
+    if handler is None:
+        handler = wsgi_application
+    await handler(scope, receive, send)
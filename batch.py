@@ -0,0 +1,125 @@
+"""POST /batch: run a list of mutations through the existing views in one transaction.
+
+Each op is ``{"path": "/add_task", "method": "POST", "body": {...}}`` and
+is dispatched to the view its path matches, exactly as a single request
+would be, but on the batch's connection: the view's ``commit()`` only ends
+its op and the batch commits once at the end. By default every op runs in
+a savepoint, so a failing op is undone alone and the others still land;
+with ``"atomic": true`` the first failure rolls back the whole batch.
+
+While a batch runs, the write-behind buffer is bypassed and the ops'
+change events are collected and published once, before the commit.
+"""
+import logging
+
+from flask import current_app, g, request
+from werkzeug.exceptions import HTTPException
+
+import events
+import writebehind
+from db import get_db_connection
+
+MAX_OPS = 500
+
+log = logging.getLogger(__name__)
+
+
+class BatchError(ValueError):
+    pass
+
+
+class _OpConnection:
+    """The batch connection as one op's view sees it."""
+
+    def __init__(self, conn, atomic):
+        self._conn = conn
+        self._atomic = atomic
+        self.rolled_back = False
+        # Events the op publishes itself (db.Connection.before_commit) are undone with its savepoint.
+        self.queued = len(conn.before_commit)
+
+    def cursor(self, *args, **kwargs):
+        return self._conn.cursor(*args, **kwargs)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rolled_back = True
+        if self._atomic:
+            self._conn.rollback()
+        else:
+            with self._conn.cursor() as cur:
+                cur.execute('ROLLBACK TO SAVEPOINT batch_op')
+            del self._conn.before_commit[self.queued:]
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _dispatch(op):
+    """Run one op in a nested request context; returns its response."""
+    with current_app.test_request_context(op['path'], method=op.get('method', 'POST'), json=op.get('body')):
+        if request.routing_exception is not None:
+            raise request.routing_exception
+        if request.endpoint not in g.batch['endpoints']:
+            raise BatchError('%s %s cannot be batched' % (request.method, op['path']))
+        return current_app.make_response(current_app.dispatch_request())
+
+
+def _result(response):
+    body = response.get_json(silent=True) if response.is_json else (response.get_data(as_text=True) or None)
+    return {'status': response.status_code, 'body': body}
+
+
+def run(ops, endpoints, atomic=False):
+    """Run ``ops`` whose views are among ``endpoints``. Returns ``(results, committed)``."""
+    if not isinstance(ops, list) or not all(isinstance(op, dict) and 'path' in op for op in ops):
+        raise BatchError('ops must be a list of {path, method, body}')
+    if len(ops) > MAX_OPS:
+        raise BatchError('At most %d ops per batch' % MAX_OPS)
+
+    # The tenant's buffered writes from earlier requests must land before the ops that follow them.
+    writebehind.buffer.flush_prefix(())
+    conn = get_db_connection()
+    g.batch = {'conn': conn, 'endpoints': endpoints, 'changes': set()}
+    results = []
+    failed = False
+    try:
+        for op in ops:
+            op_conn = g.db_conn = _OpConnection(conn, atomic)
+            if not atomic:
+                with conn.cursor() as cur:
+                    cur.execute('SAVEPOINT batch_op')
+            try:
+                result = _result(_dispatch(op))
+            except BatchError as e:
+                result = {'status': 400, 'body': {'error': str(e)}}
+            except HTTPException as e:
+                result = {'status': e.code, 'body': {'error': e.description}}
+            except Exception:
+                log.exception('Batch op %s failed', op.get('path'))
+                result = {'status': 500, 'body': {'error': 'Internal error'}}
+            results.append(result)
+
+            ok = result['status'] < 400 and not op_conn.rolled_back
+            if atomic and not ok:
+                failed = True
+                break
+            if not atomic:
+                with conn.cursor() as cur:
+                    cur.execute('RELEASE SAVEPOINT batch_op' if ok else 'ROLLBACK TO SAVEPOINT batch_op')
+                if not ok:
+                    del conn.before_commit[op_conn.queued:]
+    finally:
+        g.db_conn = conn
+        changes = g.pop('batch')['changes']
+
+    if failed:
+        conn.rollback()
+        return results, False
+    if changes:
+        with conn.cursor() as cur:
+            events.publish_change(cur, *sorted(changes))
+    conn.commit()
+    return results, True
@@ -0,0 +1,488 @@
+"""Seed a database with realistic volumes and replay the client's traffic mix against the API.
+
+Use a dedicated database: seeding inserts thousands of rows and the
+replay writes (autosaves, drags, taps). Migrate it, seed it once, then
+run and keep the results of each commit:
+
+    python migrate.py apply
+    python benchmarks/bench_api.py seed --scale 1
+    python benchmarks/bench_api.py run --duration 60 --out results/$(git rev-parse --short HEAD).json
+    python benchmarks/bench_api.py compare results/abc123.json results/def456.json
+
+``run`` drives the app in-process through Flask's test client by default,
+or a running server with ``--url``. Statements per request are read from
+/metrics before and after the run; under gunicorn.conf.py every worker
+reports the whole server's totals, so any number of workers works (a
+server started otherwise needs METRICS_DIR set). Requests carry no
+token, so data is seeded into and replayed against DEFAULT_TENANT_ID; a
+server must not run with TENANT_ALLOW_ANONYMOUS=0.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# The replayed requests carry no token (see above).
+os.environ.setdefault('TENANT_ALLOW_ANONYMOUS', '1')
+
+import tenants  # noqa: E402
+from db import get_pool  # noqa: E402
+
+# Rows per unit of --scale: 2,500 topics over 25 houses, 40,000 files of
+# which 25,000 are tasks, and --years of daily food and green notes.
+VOLUMES = {
+    'houses': 25,
+    'topics': 2500,
+    'files_per_topic': 16,
+    'task_files_per_topic': 10,
+    'blocks_per_file': 8,
+    'food_per_day': 6,
+    'note_categories': 6,
+    'tracking_items': 20,
+    'unclassified': 300,
+}
+TASK_SECTIONS = ['בהמשך', 'שבוע הבא', 'השבוע', 'היום']
+
+SEED_STEPS = [
+    ('houses', """
+        INSERT INTO houses (name)
+        SELECT 'bench house ' || h FROM generate_series(1, %(houses)s) h
+        ON CONFLICT DO NOTHING
+    """),
+    ('topics', """
+        INSERT INTO topics (name, color, house, "order", flat)
+        SELECT 'bench topic ' || t, (random() * 16777215)::bigint,
+               'bench house ' || (1 + t %% %(houses)s), t * 1024, random() < 0.1
+        FROM generate_series(1, %(topics)s) t
+    """),
+    ('files', """
+        INSERT INTO files (topic_id, section, name, linked, content)
+        SELECT t.id,
+               CASE WHEN f <= %(task_files_per_topic)s THEN 'tasks' WHEN f %% 2 = 0 THEN 'plans' ELSE 'docs' END,
+               'file ' || f, random() < 0.05,
+               (SELECT jsonb_agg(jsonb_build_object(
+                           'type', 'text',
+                           'text', 'block ' || b || ' of file ' || f || ' ' || md5(t.id::text || '/' || f || '/' || b)))
+                FROM generate_series(1, %(blocks_per_file)s) b)
+        FROM topics t CROSS JOIN generate_series(1, %(files_per_topic)s) f
+        WHERE t.name LIKE 'bench topic %%'
+    """),
+    ('tasks', """
+        INSERT INTO tasks (topic_id, file_name, section, "order")
+        SELECT topic_id, name, (%(task_sections)s::text[])[1 + floor(random() * %(task_section_count)s)::integer],
+               row_number() OVER (ORDER BY topic_id, name) * 1024
+        FROM files
+        WHERE section = 'tasks' AND topic_id IN (SELECT id FROM topics WHERE name LIKE 'bench topic %%')
+    """),
+    ('control', """
+        INSERT INTO control (name_file, topic_id, is_plan, order_index, modification_alert)
+        SELECT name, topic_id, section = 'plans', row_number() OVER (ORDER BY topic_id, name) * 1024, random() < 0.1
+        FROM files
+        WHERE section IN ('plans', 'docs') AND topic_id IN (SELECT id FROM topics WHERE name LIKE 'bench topic %%')
+    """),
+    ('unclassified_tasks', """
+        INSERT INTO unclassified_tasks ("order", content)
+        SELECT u * 1024, 'bench loose task ' || u FROM generate_series(1, %(unclassified)s) u
+    """),
+    ('food', """
+        INSERT INTO food (date, name, calories, protein)
+        SELECT to_char(d, 'YYYY-MM-DD'), 'food ' || (1 + floor(random() * 200)::integer),
+               (50 + random() * 700)::integer, (random() * 50)::integer
+        FROM generate_series(current_date - %(days)s, current_date - 1, interval '1 day') d,
+             generate_series(1, %(food_per_day)s) n
+    """),
+    ('tracking', """
+        INSERT INTO tracking (name, time, amount, done, content)
+        SELECT 'bench habit ' || i, to_char(current_date, 'YYYY-MM-DD'), 1 + i %% 4, 0, ''
+        FROM generate_series(1, %(tracking_items)s) i
+    """),
+    ('green_note_topics', """
+        INSERT INTO green_note_topics (name)
+        SELECT 'bench category ' || c FROM generate_series(1, %(note_categories)s) c
+    """),
+    ('green_notes', """
+        INSERT INTO green_notes (signature, date, good_1, good_2, good_3, improve)
+        SELECT to_char(d, 'YYYY-MM-DD') || '_bench', to_char(d, 'YYYY-MM-DD'),
+               'good ' || md5(random()::text), 'good ' || md5(random()::text),
+               'good ' || md5(random()::text), 'improve ' || md5(random()::text)
+        FROM generate_series(current_date - %(days)s, current_date - 1, interval '1 day') d
+        ON CONFLICT (signature) DO NOTHING
+    """),
+    ('green_note_scores', """
+        INSERT INTO green_note_scores (note_id, category, score)
+        SELECT n.id, 'bench category ' || c, 1 + floor(random() * 10)::integer
+        FROM green_notes n, generate_series(1, %(note_categories)s) c
+        WHERE n.signature LIKE '%%\\_bench'
+    """),
+]
+
+
+def seed(args):
+    params = {k: int(v * args.scale) if k in ('houses', 'topics', 'unclassified') else v
+              for k, v in VOLUMES.items()}
+    params.update(days=int(args.years * 365), task_sections=TASK_SECTIONS, task_section_count=len(TASK_SECTIONS))
+    with get_pool().connection(tenants.DEFAULT_TENANT_ID) as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT count(*) FROM topics')
+        if cur.fetchone()[0] and not args.force:
+            sys.exit('topics is not empty; seed an empty database or pass --force')
+        cur.execute('SELECT setseed(%s)', (args.seed,))
+        for table, sql in SEED_STEPS:
+            started = time.perf_counter()
+            cur.execute(sql, params)
+            print('%-20s %8d rows %8.1f s' % (table, cur.rowcount, time.perf_counter() - started))
+        conn.commit()
+        conn.autocommit = True
+        cur.execute('ANALYZE')
+        conn.autocommit = False
+
+
+# ---------- traffic ----------
+# Each operation builds one request from the sample; weights follow how
+# often the client sends it (autosave and tracking taps dominate).
+
+def load_sample(cur):
+    sample = {}
+    cur.execute('SELECT id, house FROM topics ORDER BY random() LIMIT 500')
+    sample['topics'] = cur.fetchall()
+    cur.execute('SELECT name FROM houses')
+    sample['houses'] = [r[0] for r in cur.fetchall()]
+    cur.execute('SELECT topic_id, name, jsonb_array_length(content) FROM files ORDER BY random() LIMIT 2000')
+    sample['files'] = cur.fetchall()
+    cur.execute('SELECT section, topic_id, file_name FROM tasks ORDER BY section, "order"')
+    sections = {}
+    for section, topic_id, file_name in cur.fetchall():
+        sections.setdefault(section, []).append((topic_id, file_name))
+    sample['task_sections'] = sections
+    cur.execute('SELECT name FROM tracking')
+    sample['tracking'] = [r[0] for r in cur.fetchall()]
+    cur.execute('SELECT DISTINCT date FROM food ORDER BY date DESC LIMIT 400')
+    sample['food_dates'] = [r[0] for r in cur.fetchall()]
+    cur.execute('SELECT signature FROM green_notes ORDER BY random() LIMIT 400')
+    sample['signatures'] = [r[0] for r in cur.fetchall()]
+    return sample
+
+
+def op_bootstrap(rng, sample, args):
+    return 'GET', '/bootstrap', None
+
+
+def op_autosave(rng, sample, args):
+    topic_id, name, _ = rng.choice(sample['files'])
+    content = [{'type': 'text', 'text': 'autosave %d' % rng.randrange(10 ** 9)} for _ in range(args.blocks)]
+    return 'POST', '/file_content', {'topic_id': topic_id, 'name': name, 'content': content}
+
+
+def op_autosave_patch(rng, sample, args):
+    topic_id, name, blocks = rng.choice(sample['files'])
+    text = 'patched %d' % rng.randrange(10 ** 9)
+    if blocks:
+        ops = [{'op': 'set', 'index': rng.randrange(blocks), 'path': ['text'], 'value': text}]
+    else:
+        ops = [{'op': 'insert', 'value': {'type': 'text', 'text': text}}]
+    return 'POST', '/file_content/patch', {'topic_id': topic_id, 'name': name, 'ops': ops}
+
+
+def op_reorder_task(rng, sample, args):
+    # Drag the last task of a window of neighbours to its top.
+    section = rng.choice(list(sample['task_sections']))
+    keys = sample['task_sections'][section]
+    start = rng.randrange(max(len(keys) - args.drag_window, 0) + 1)
+    window = keys[start:start + args.drag_window]
+    window = window[-1:] + window[:-1]
+    tasks = [{'topic_id': t, 'file_name': f, 'section': section, 'order': i} for i, (t, f) in enumerate(window)]
+    return 'POST', '/reorder_task', {'tasks': tasks}
+
+
+def op_move_topic(rng, sample, args):
+    # Mostly within the topic's house, sometimes into another one.
+    topic_id, house = rng.choice(sample['topics'])
+    if rng.random() < 0.2:
+        house = rng.choice(sample['houses'])
+    return 'POST', '/move_topic', {'topic_id': topic_id, 'new_house': house, 'new_order': rng.randrange(50)}
+
+
+def op_tracking_tap(rng, sample, args):
+    return 'POST', '/update_tracking_done', {
+        'name': rng.choice(sample['tracking']), 'index': 0, 'checked': rng.random() < 0.7}
+
+
+def op_files(rng, sample, args):
+    return 'GET', '/files/%d' % rng.choice(sample['topics'])[0], None
+
+
+def op_food(rng, sample, args):
+    return 'GET', '/get_food?date=%s' % rng.choice(sample['food_dates']), None
+
+
+def op_green_note(rng, sample, args):
+    return 'GET', '/green_notes/version/%s' % rng.choice(sample['signatures']), None
+
+
+def op_tracking(rng, sample, args):
+    return 'GET', '/get_tracking', None
+
+
+# name -> (build, weight, Flask endpoint whose statement counts it reports)
+OPERATIONS = {
+    'bootstrap': (op_bootstrap, 4, 'api.bootstrap'),
+    'autosave': (op_autosave, 30, 'api.save_file_content'),
+    'autosave_patch': (op_autosave_patch, 10, 'api.patch_file_content'),
+    'reorder_task': (op_reorder_task, 8, 'api.reorder_task'),
+    'move_topic': (op_move_topic, 3, 'api.move_topic'),
+    'tracking_tap': (op_tracking_tap, 25, 'api.update_tracking_done'),
+    'files': (op_files, 8, 'api.get_files'),
+    'food': (op_food, 5, 'api.get_food'),
+    'green_note': (op_green_note, 4, 'api.get_green_note_by_signature'),
+    'tracking': (op_tracking, 3, 'api.get_tracking'),
+}
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body):
+        response = self.client.open(path, method=method, json=body, headers={'Accept-Encoding': 'gzip'})
+        response.get_data()
+        return response.status_code
+
+    def get_text(self, path):
+        return self.client.get(path).get_data(as_text=True)
+
+    def close(self):
+        pass
+
+
+class HttpClient:
+    def __init__(self, base):
+        url = urlsplit(base)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+
+    def request(self, method, path, body):
+        headers = {'Accept-Encoding': 'gzip'}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, body=data, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            return None
+
+    def get_text(self, path):
+        self.conn.request('GET', path)
+        return self.conn.getresponse().read().decode()
+
+    def close(self):
+        self.conn.close()
+
+
+def statement_counts(client):
+    """Per endpoint, the (sum, count) of the statements-per-request histogram in /metrics."""
+    counts = {}
+    for line in client.get_text('/metrics').splitlines():
+        for suffix, slot in (('_sum{', 0), ('_count{', 1)):
+            prefix = 'db_queries_per_request' + suffix
+            if line.startswith(prefix):
+                labels, value = line[len(prefix):].rsplit('} ', 1)
+                endpoint = labels.split('endpoint="', 1)[1].split('"', 1)[0]
+                counts.setdefault(endpoint, [0.0, 0])[slot] += float(value)
+    return counts
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def worker(make_client, sample, args, seed, deadline, results, lock):
+    rng = random.Random(seed)
+    names = list(OPERATIONS)
+    weights = [OPERATIONS[name][1] for name in names]
+    client = make_client()
+    mine = {name: ([], [0]) for name in names}
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, path, body = OPERATIONS[name][0](rng, sample, args)
+        started = time.perf_counter()
+        status = client.request(method, path, body)
+        elapsed = (time.perf_counter() - started) * 1000
+        if status is None or status >= 400:
+            mine[name][1][0] += 1
+        else:
+            mine[name][0].append(elapsed)
+    client.close()
+    with lock:
+        for name, (latencies, errors) in mine.items():
+            results[name][0].extend(latencies)
+            results[name][1][0] += errors[0]
+
+
+def replay(make_client, sample, args, duration, seed):
+    results = {name: ([], [0]) for name in OPERATIONS}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=worker, args=(make_client, sample, args, seed + i, deadline, results, lock))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run(args):
+    with get_pool().connection(tenants.DEFAULT_TENANT_ID) as conn:
+        sample = load_sample(conn.cursor())
+    if not sample['files'] or not sample['tracking']:
+        sys.exit('the database is empty; run the seed command first')
+
+    if args.url:
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        from app import create_app
+        app = create_app()
+
+        def make_client():
+            return InProcessClient(app)
+
+    if args.warmup:
+        replay(make_client, sample, args, args.warmup, args.seed + 10 ** 6)
+    probe = make_client()
+    before = statement_counts(probe)
+    results = replay(make_client, sample, args, args.duration, args.seed)
+    after = statement_counts(probe)
+    probe.close()
+
+    operations = {}
+    total = 0
+    for name, (latencies, errors) in results.items():
+        endpoint = OPERATIONS[name][2]
+        queries = None
+        if endpoint in after:
+            sums = [a - b for a, b in zip(after[endpoint], before.get(endpoint, [0.0, 0]))]
+            queries = sums[0] / sums[1] if sums[1] else None
+        total += len(latencies)
+        operations[name] = {
+            'requests': len(latencies),
+            'errors': errors[0],
+            'rps': len(latencies) / args.duration,
+            'ms_p50': percentile(latencies, 50),
+            'ms_p95': percentile(latencies, 95),
+            'ms_p99': percentile(latencies, 99),
+            'ms_mean': statistics.mean(latencies) if latencies else None,
+            'queries_per_request': queries,
+        }
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'target': args.url or 'in-process',
+        'config': {'duration': args.duration, 'concurrency': args.concurrency, 'seed': args.seed,
+                   'drag_window': args.drag_window, 'blocks': args.blocks},
+        'requests': total,
+        'rps': total / args.duration,
+        'operations': operations,
+    }
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print('%d requests, %.1f/s over %gs (%s)' % (total, report['rps'], args.duration, report['commit'] or '?'))
+    print('%-16s %9s %8s %9s %9s %9s %8s %7s' % ('operation', 'requests', 'rps', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                  'queries', 'errors'))
+    for name, r in operations.items():
+        print('%-16s %9d %8.1f %9.2f %9.2f %9.2f %8s %7d' % (
+            name, r['requests'], r['rps'], r['ms_p50'] or 0, r['ms_p95'] or 0, r['ms_p99'] or 0,
+            '%.1f' % r['queries_per_request'] if r['queries_per_request'] is not None else '-', r['errors']))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(args):
+    """Print each operation's change from ``base`` to ``new``; exit 1 if a p95 got worse than ``--threshold``."""
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print('%s -> %s' % (base.get('commit'), new.get('commit')))
+    print('%-16s %18s %18s %18s %14s' % ('operation', 'rps', 'p50 ms', 'p95 ms', 'queries'))
+    regressed = []
+    for name, n in new['operations'].items():
+        b = base['operations'].get(name)
+        if not b:
+            continue
+
+        def cell(key, fmt='%.1f'):
+            if b[key] is None or n[key] is None:
+                return '-'
+            change = '' if not b[key] else ' (%+.0f%%)' % ((n[key] - b[key]) / b[key] * 100)
+            return (fmt % n[key]) + change
+
+        print('%-16s %18s %18s %18s %14s' % (name, cell('rps'), cell('ms_p50', '%.2f'), cell('ms_p95', '%.2f'),
+                                             cell('queries_per_request')))
+        if b['ms_p95'] and n['ms_p95'] and n['ms_p95'] > b['ms_p95'] * (1 + args.threshold / 100):
+            regressed.append(name)
+    if regressed:
+        print('p95 regressed by more than %g%%: %s' % (args.threshold, ', '.join(regressed)))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('seed', help='fill an empty, migrated database')
+    p.add_argument('--scale', type=float, default=1, help='multiplies houses, topics (and so files and tasks)')
+    p.add_argument('--years', type=float, default=5, help='years of daily food and green notes')
+    p.add_argument('--seed', type=float, default=0.42, help='random seed, between -1 and 1')
+    p.add_argument('--force', action='store_true', help='seed even if topics is not empty')
+
+    p = commands.add_parser('run', help='replay the traffic mix and report per-operation latency')
+    p.add_argument('--url', help='server to load instead of the in-process app')
+    p.add_argument('--duration', type=float, default=30, help='measured seconds')
+    p.add_argument('--warmup', type=float, default=5, help='seconds of unmeasured load first')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--drag-window', type=int, default=50, help='tasks sent with each drag')
+    p.add_argument('--blocks', type=int, default=8, help='blocks in each autosaved file')
+    p.add_argument('--out', help='also write the results as JSON to this file')
+    p.add_argument('--json', action='store_true', help='print results as JSON')
+
+    p = commands.add_parser('compare', help='compare two --out files')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=10, help='allowed p95 increase in percent')
+
+    args = parser.parse_args()
+    {'seed': seed, 'run': run, 'compare': compare}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Requests/sec and latency of the sync (WSGI) and async (ASGI) servers under the same load.
+
+Start both servers against the same database with the same number of
+worker processes pinned to the same cores, for example with 2 cores:
+
+    taskset -c 0,1 gunicorn -w 2 -b 127.0.0.1:8001 'app:create_app()'
+    taskset -c 0,1 uvicorn --workers 2 --port 8002 asgi:application
+
+then drive them one after the other from other cores:
+
+    taskset -c 2-7 python benchmarks/bench_asgi.py \\
+        --target sync=http://127.0.0.1:8001 --target async=http://127.0.0.1:8002 \\
+        --concurrency 32 --duration 30
+
+Each client thread keeps one HTTP/1.1 connection open and loops over the
+endpoints in ``--paths``. Only read endpoints are used, so repeated runs
+see the same data.
+"""
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_PATHS = ['/bootstrap', '/tasks', '/get_tracking', '/directories', '/get_control_files']
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def client(base, paths, deadline, latencies, errors, lock):
+    url = urlsplit(base)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    mine = {path: [] for path in paths}
+    failed = 0
+    i = 0
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                failed += 1
+                continue
+        except (OSError, http.client.HTTPException):
+            failed += 1
+            conn.close()
+            continue
+        mine[path].append((time.perf_counter() - started) * 1000)
+    conn.close()
+    with lock:
+        for path, values in mine.items():
+            latencies[path].extend(values)
+        errors[0] += failed
+
+
+def run(base, paths, concurrency, duration):
+    latencies = {path: [] for path in paths}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=client, args=(base, paths, deadline, latencies, errors, lock))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    everything = [v for values in latencies.values() for v in values]
+    return {
+        'requests': len(everything),
+        'errors': errors[0],
+        'rps': len(everything) / duration,
+        'ms_p50': percentile(everything, 50),
+        'ms_p99': percentile(everything, 99),
+        'endpoints': {
+            path: {
+                'requests': len(values),
+                'ms_p50': percentile(values, 50),
+                'ms_p99': percentile(values, 99),
+                'ms_mean': statistics.mean(values) if values else None,
+            }
+            for path, values in latencies.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', action='append', required=True, metavar='NAME=URL',
+                        help='server to load, may be repeated')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per target')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of unmeasured load first')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for target in args.target:
+        name, _, base = target.partition('=')
+        if args.warmup:
+            run(base, args.paths, args.concurrency, args.warmup)
+        results[name] = run(base, args.paths, args.concurrency, args.duration)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-10s %-20s %9s %8s %10s %10s' % ('target', 'endpoint', 'requests', 'rps', 'p50 ms', 'p99 ms'))
+    for name, r in results.items():
+        print('%-10s %-20s %9d %8.1f %10.2f %10.2f' % (name, '(all)', r['requests'], r['rps'],
+                                                      r['ms_p50'] or 0, r['ms_p99'] or 0))
+        for path, e in r['endpoints'].items():
+            print('%-10s %-20s %9d %8s %10.2f %10.2f' % ('', path, e['requests'], '',
+                                                        e['ms_p50'] or 0, e['ms_p99'] or 0))
+        if r['errors']:
+            print('%-10s %d failed requests' % ('', r['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Round trips and latency of drag-reordering, per-row UPDATEs vs. sparse keys.
+
+Runs against the database configured by the usual DB_* variables but only
+touches TEMP tables that shadow ``topics``, ``tasks`` and
+``unclassified_tasks`` for the benchmark session, so real data is never
+read or written.
+
+    python benchmarks/bench_reorder.py --sizes 10 100 1000 --repeat 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+from psycopg2.extensions import cursor as base_cursor
+
+# One pooled connection, so the TEMP tables are visible to the app's routes.
+os.environ['DB_POOL_MIN'] = os.environ['DB_POOL_MAX'] = '1'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tenants  # noqa: E402
+from app import create_app  # noqa: E402
+from db import get_pool  # noqa: E402
+
+
+class CountingCursor(base_cursor):
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.round_trips += 1
+        return super().execute(query, vars)
+
+
+def setup(conn, size):
+    cur = conn.cursor()
+    cur.execute("""
+        DROP TABLE IF EXISTS pg_temp.topics, pg_temp.tasks;
+        CREATE TEMP TABLE topics (id serial PRIMARY KEY, name text, color bigint,
+                                  house text, "order" double precision, flat boolean);
+        CREATE TEMP TABLE tasks (topic_id integer, file_name text, section text, "order" double precision);
+    """)
+    cur.execute("""
+        INSERT INTO topics (name, color, house, "order")
+        SELECT 't' || i, 0, 'bench', i * 1024 FROM generate_series(1, %s) i;
+        INSERT INTO tasks (topic_id, file_name, section, "order")
+        SELECT 1, 'f' || i, 'bench', i * 1024 FROM generate_series(1, %s) i;
+    """, (size, size))
+    conn.commit()
+
+
+def legacy_move_topic(conn, topic_id, new_house, new_order):
+    cur = conn.cursor()
+    cur.execute('UPDATE topics SET house = %s, "order" = -1 WHERE id = %s', (new_house, topic_id))
+    conn.commit()
+    cur.execute('SELECT id FROM topics WHERE house = %s AND id != %s ORDER BY "order"', (new_house, topic_id))
+    ordered = [r[0] for r in cur.fetchall()]
+    ordered.insert(min(new_order, len(ordered)), topic_id)
+    for index, tid in enumerate(ordered):
+        cur.execute('UPDATE topics SET "order" = %s WHERE id = %s', (index, tid))
+    conn.commit()
+
+
+def legacy_reorder_task(conn, tasks):
+    cur = conn.cursor()
+    for task in tasks:
+        cur.execute('UPDATE tasks SET section = %s, "order" = %s WHERE topic_id = %s AND file_name = %s',
+                    (task['section'], task['order'], task['topic_id'], task['file_name']))
+    conn.commit()
+
+
+def drag_last_to_first(size):
+    names = ['f%d' % i for i in range(1, size + 1)]
+    names.insert(0, names.pop())
+    return [{'topic_id': 1, 'file_name': n, 'section': 'bench', 'order': i} for i, n in enumerate(names)]
+
+
+def measure(fn, reset, repeat):
+    timings = []
+    trips = []
+    for _ in range(repeat):
+        reset()
+        CountingCursor.round_trips = 0
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+        trips.append(CountingCursor.round_trips)
+    return {'statements': max(trips), 'ms_median': statistics.median(timings), 'ms_max': max(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 500, 1000])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    client = create_app().test_client()
+    results = []
+    # The pool holds exactly this one connection; the routes borrow it between
+    # our own (strictly sequential) statements. It is bound to the tenant the
+    # routes run as, so they do not re-bind it mid-measurement.
+    conn = get_pool().getconn(tenants.DEFAULT_TENANT_ID)
+    conn.cursor_factory = CountingCursor
+    get_pool().putconn(conn)
+    for size in args.sizes:
+        tasks = drag_last_to_first(size)
+        cases = {
+            'move_topic/legacy': lambda: legacy_move_topic(conn, size, 'bench', 0),
+            'move_topic/sparse': lambda: client.post('/move_topic', json={
+                'topic_id': size, 'new_house': 'bench', 'new_order': 0}),
+            'reorder_task/legacy': lambda: legacy_reorder_task(conn, tasks),
+            'reorder_task/sparse': lambda: client.post('/reorder_task', json={'tasks': tasks}),
+        }
+        for name, fn in cases.items():
+            # Every run starts from the undragged layout so it moves the same rows.
+            stats = measure(fn, lambda: setup(conn, size), args.repeat)
+            results.append(dict(case=name, size=size, **stats))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    # Statement counts exclude COMMITs: one per request on the sparse path, two on legacy move_topic.
+    print('%-22s %6s %12s %12s %10s' % ('case', 'size', 'statements', 'median ms', 'max ms'))
+    for r in results:
+        print('%-22s %6d %12d %12.2f %10.2f' % (r['case'], r['size'], r['statements'], r['ms_median'], r['ms_max']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""In-process response cache for the read endpoints, with strong ETags.
+
+Entries are tagged with the tables their query reads. Mutating routes
+report the tables they wrote through ``events.publish_change``; the
+matching entries are dropped once the request's transaction has committed,
+and every other worker drops them when the change event reaches its
+listener.
+
+Entries and tags are per tenant (see tenants.py): a tenant's write only
+drops that tenant's entries.
+
+A response read from a replica (see replicas.py) is only stored if the
+replica was known to be in sync with the primary after the last
+invalidation of its tags; otherwise it could hold rows from before a write
+that already dropped the old entry.
+"""
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from flask import Response, g, request
+
+import compression
+import events
+import tenants
+
+
+class ResponseCache:
+    """LRU of serialized responses, bounded by total body size.
+
+    Entries carry tags (here ``(tenant, table)`` pairs); ``invalidate(tags)``
+    drops every entry carrying one of them.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (body, etag, mimetype, tags)
+        self._keys_by_tag = defaultdict(set)
+        self._generations = defaultdict(int)
+        self._invalidated_at = {}  # tag -> time.monotonic() of its last invalidation
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0, 'invalidations': 0}
+
+    def generation(self, tags):
+        with self._lock:
+            return tuple(self._generations[t] for t in tags)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def put(self, key, entry, generation, synced_at=None):
+        """Store ``entry`` unless a tag was invalidated since ``generation`` was taken.
+
+        ``synced_at`` (a ``time.monotonic()`` value) is when the data source
+        last had every committed write; the entry is also skipped if a tag
+        was invalidated after that.
+        """
+        body, _, _, tags = entry
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            # A write landed while the response was being built: it may be stale.
+            if tuple(self._generations[t] for t in tags) != generation:
+                return
+            if synced_at is not None and any(self._invalidated_at.get(t, synced_at) > synced_at for t in tags):
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += len(body)
+            for tag in tags:
+                self._keys_by_tag[tag].add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+            for tag in entry[3]:
+                self._keys_by_tag[tag].discard(key)
+
+    def invalidate(self, tags):
+        with self._lock:
+            now = time.monotonic()
+            for tag in tags:
+                self._generations[tag] += 1
+                self._invalidated_at[tag] = now
+                for key in list(self._keys_by_tag.pop(tag, ())):
+                    self._remove(key)
+                    self._stats['invalidations'] += 1
+
+    def count_not_modified(self):
+        with self._lock:
+            self._stats['not_modified'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size, max_bytes=self.max_bytes)
+
+
+response_cache = ResponseCache(int(os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024)))
+# A worker forked while another thread held the lock would deadlock on it.
+os.register_at_fork(after_in_child=lambda: setattr(response_cache, '_lock', threading.Lock()))
+
+
+def _tags(tables, tenant):
+    return [(tenant, table) for table in tables]
+
+
+def invalidate(tables, tenant=None):
+    """Drop the entries of ``tenant`` (default: the current one) that read any of ``tables``."""
+    response_cache.invalidate(_tags(tables, tenant if tenant is not None else tenants.current()))
+
+
+@events.on_event
+def _invalidate_from_event(event):
+    if event['kind'] == 'change':
+        invalidate(event['payload'].get('tables', []), event['tenant_id'])
+
+
+def invalidate_changed(exc=None):
+    """Teardown hook: drop entries for the tables this request wrote (after its commit)."""
+    tables = g.pop('changed_tables', None)
+    if tables:
+        invalidate(tables)
+
+
+def make_entry(response, tags):
+    body = response.get_data()
+    return body, hashlib.sha1(body).hexdigest(), response.mimetype, tags
+
+
+def cache_key(tenant, endpoint, view_args=None, args=(), varies=None):
+    """The key of one view's response: shared with the native ASGI reads (see asgi.py)."""
+    return tenant, endpoint, tuple(sorted((view_args or {}).items())), tuple(sorted(args)), varies
+
+
+def respond_from(entry, req):
+    """A response for the cached ``entry`` (a 304 when ``req`` already has it)."""
+    body, etag, mimetype, _ = entry
+    response = Response(body, mimetype=mimetype)
+    # Tagged with the encoding compression.compress will send it in.
+    response.set_etag(compression.tag_etag(etag, compression.negotiate(len(body))))
+    response.headers['Cache-Control'] = 'no-cache'
+    response = response.make_conditional(req)
+    if response.status_code == 304:
+        response_cache.count_not_modified()
+    return response
+
+
+def cached(*tables, vary=None):
+    """Serve a GET view from the cache, answering 304 when If-None-Match matches.
+
+    ``tables`` lists every table the view reads. ``vary()``, if given,
+    returns anything else the response depends on besides the URL (such
+    as today's date) and becomes part of the key. Only buffered 200
+    responses are stored.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Other workers' writes reach us through the listener.
+            events.get_listener()
+            tenant = tenants.current()
+            key = cache_key(tenant, request.endpoint, kwargs, request.args.items(multi=True),
+                            vary() if vary is not None else None)
+            tags = _tags(tables, tenant)
+            entry = response_cache.get(key)
+            if entry is None:
+                generation = response_cache.generation(tags)
+                response = view(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = make_entry(response, tags)
+                response_cache.put(key, entry, generation, g.get('db_synced_at'))
+            return respond_from(entry, request)
+        return wrapper
+    return decorator
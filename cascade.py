@@ -0,0 +1,202 @@
+"""Deletes and renames of houses, topics and files together with the rows that depend on them.
+
+Dependents: topics hang off houses(name); files off topics(id); tasks and
+control off files(topic_id, name). The foreign keys of migrations/006
+(per tenant since 010) carry every delete and rename down to them with
+ON DELETE / ON UPDATE CASCADE; Postgres applies those actions even while
+the keys are still NOT VALID. Only deleting a house is not a plain
+cascade: its topics move to the general house first. The callers commit.
+
+Rows orphaned before the keys existed are not reached by the cascades.
+They are removed once with
+
+    python cascade.py purge [--dry-run]
+
+which reports what it removed, validates the NOT VALID foreign keys of 006
+and 010 (from then on Postgres guarantees no new orphans) and vacuums the
+tables. It runs tenant by tenant, so a row whose parent belongs to
+another tenant counts as an orphan too. Until the keys are valid, the
+``purge_orphans`` job does the same every night, and for one tenant after
+its deletes of houses and topics.
+"""
+import argparse
+import logging
+import sys
+
+import psycopg2
+
+import jobs
+import tenants
+from db import dsn
+
+log = logging.getLogger(__name__)
+
+GENERAL_HOUSE = 'כללי'
+
+# Tables each operation may write, for events.publish_change.
+TOUCHES = {
+    'house': ('houses', 'topics'),
+    'topic': ('topics', 'files', 'tasks', 'control'),
+    'file': ('files', 'tasks', 'control'),
+}
+
+
+def delete_house(cur, name):
+    """Delete house ``name``, moving its topics to the general house. Returns the number of topics moved."""
+    # Two statements, in this order: the topics must point at the general
+    # house before the house row goes, or its ON DELETE CASCADE deletes
+    # them. Data-modifying CTEs of one statement share a snapshot, so they
+    # could not guarantee that order.
+    cur.execute("UPDATE topics SET house = %s WHERE house = %s", (GENERAL_HOUSE, name))
+    moved = cur.rowcount
+    cur.execute("DELETE FROM houses WHERE name = %s", (name,))
+    return moved
+
+
+def rename_house(cur, old_name, new_name):
+    """Rename a house; its topics follow by ON UPDATE CASCADE. Returns False if there is no such house.
+
+    Raises psycopg2.errors.UniqueViolation if ``new_name`` is taken.
+    """
+    cur.execute("UPDATE houses SET name = %s WHERE name = %s", (new_name, old_name))
+    return cur.rowcount > 0
+
+
+def delete_topic(cur, topic_id):
+    """Delete a topic; its files, and their tasks and control rows, go by ON DELETE CASCADE.
+
+    Returns False if there is no such topic.
+    """
+    cur.execute("DELETE FROM topics WHERE id = %s", (topic_id,))
+    return cur.rowcount > 0
+
+
+def delete_file(cur, topic_id, name):
+    """Delete a file; its task and control rows go by ON DELETE CASCADE. Returns False if there is no such file."""
+    cur.execute("DELETE FROM files WHERE topic_id = %s AND name = %s", (topic_id, name))
+    return cur.rowcount > 0
+
+
+def rename_file(cur, topic_id, old_name, new_name):
+    """Rename a file; its task and control rows follow by ON UPDATE CASCADE. Returns False if there is no such file.
+
+    Raises psycopg2.errors.UniqueViolation if the topic already has a file
+    named ``new_name``.
+    """
+    cur.execute("UPDATE files SET name = %s WHERE topic_id = %s AND name = %s", (new_name, topic_id, old_name))
+    return cur.rowcount > 0
+
+
+# ---------- one-off orphan purge ----------
+# (label, statement, parameters, foreign key of 006 it clears the way for).
+# Files go before tasks and control, so rows orphaned by the first are
+# caught too.
+ORPHANS = [
+    ('topics moved to %s' % GENERAL_HOUSE, """
+        UPDATE topics t SET house = %s
+        WHERE NOT EXISTS (SELECT 1 FROM houses h WHERE h.name = t.house)
+    """, (GENERAL_HOUSE,), ('topics', 'topics_house_fkey')),
+    ('files deleted', """
+        DELETE FROM files f WHERE NOT EXISTS (SELECT 1 FROM topics t WHERE t.id = f.topic_id)
+    """, (), ('files', 'files_topic_id_fkey')),
+    ('tasks deleted', """
+        DELETE FROM tasks k
+        WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.topic_id = k.topic_id AND f.name = k.file_name)
+    """, (), ('tasks', 'tasks_file_fkey')),
+    ('control rows deleted', """
+        DELETE FROM control c
+        WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.topic_id = c.topic_id AND f.name = c.name_file)
+    """, (), ('control', 'control_file_fkey')),
+    ('green note scores deleted', """
+        DELETE FROM green_note_scores s WHERE NOT EXISTS (SELECT 1 FROM green_notes n WHERE n.id = s.note_id)
+    """, (), ('green_note_scores', 'green_note_scores_note_id_fkey')),
+]
+
+
+def _unvalidated(cur):
+    """The ``(table, constraint)`` foreign keys of ORPHANS still NOT VALID."""
+    result = []
+    for _, _, _, (table, constraint) in ORPHANS:
+        cur.execute('SELECT NOT convalidated FROM pg_constraint WHERE conrelid = %s::regclass AND conname = %s',
+                    (table, constraint))
+        row = cur.fetchone()
+        if row and row[0]:
+            result.append((table, constraint))
+    return result
+
+
+def purge_orphans(conn, dry_run=False, tenant_ids=None):
+    """Remove orphaned rows and validate the foreign keys in one transaction. Returns the counts by label.
+
+    With ``tenant_ids``, only those tenants' orphans are removed, without
+    locking the tables, and the keys are left as they are.
+    """
+    counts = {}
+    validate = not dry_run and tenant_ids is None
+    with conn.cursor() as cur:
+        if validate:
+            # The run that validates the keys holds every tenant's writes
+            # until it commits, so none slips in between the purge and
+            # the validation. A purge of some tenants needs no lock: the
+            # NOT VALID keys already reject new orphans, and the rows it
+            # deletes have no parent for a write to reach them through.
+            cur.execute('LOCK TABLE houses, topics, files, tasks, control, green_notes, green_note_scores '
+                        'IN SHARE ROW EXCLUSIVE MODE')
+        # Each tenant's rows are only visible with its app.tenant_id set.
+        for tenant in tenant_ids if tenant_ids is not None else tenants.all_ids(cur):
+            cur.execute("SELECT set_config('app.tenant_id', %s, true)", (str(tenant),))
+            for label, sql, params, _ in ORPHANS:
+                cur.execute(sql, params)
+                counts[label] = counts.get(label, 0) + cur.rowcount
+        if validate:
+            for table, constraint in _unvalidated(cur):
+                cur.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, constraint))
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    return counts
+
+
+@jobs.handler('purge_orphans')
+def purge_orphans_job(conn, args):
+    """The job's tenant's orphans (queued by the deletes), or everyone's plus the key validation (nightly)."""
+    with conn.cursor() as cur:
+        if not _unvalidated(cur):
+            # Postgres already keeps orphans from existing.
+            return
+    tenant = tenants.current()
+    counts = purge_orphans(conn, tenant_ids=None if tenant is None else [tenant])
+    if any(counts.values()):
+        log.info('Purged orphans: %r', counts)
+
+
+jobs.schedule('purge_orphans', '20 3 * * *', 'purge_orphans', per_tenant=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    purge_parser = commands.add_parser('purge', help='remove orphaned rows and validate the foreign keys')
+    purge_parser.add_argument('--dry-run', action='store_true', help='only count, change nothing')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**dsn())
+    try:
+        counts = purge_orphans(conn, args.dry_run)
+        for label, count in counts.items():
+            print('%-32s %d' % (label + (' (dry run)' if args.dry_run else ''), count))
+        if not args.dry_run:
+            print('foreign keys validated')
+            # Return the dead rows' space for reuse; VACUUM cannot run in a transaction.
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                for _, _, _, (table, _) in ORPHANS:
+                    cur.execute('VACUUM ANALYZE %s' % table)
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
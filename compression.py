@@ -0,0 +1,55 @@
+"""Negotiated gzip / brotli compression of response bodies.
+
+``compress`` runs as an after-request hook on every response. Brotli
+(``brotli`` is in requirements.txt) is used when the client accepts it;
+otherwise gzip, which is also the fallback without the package. Bodies under ``COMPRESS_MIN_BYTES`` are sent
+as they are.
+
+A compressed body is a different representation, so its strong ETag gets
+the encoding as a suffix (``"<tag>-gzip"``); ``cache.cached`` tags its
+ETags the same way before evaluating If-None-Match.
+"""
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # e.g. a bare development checkout
+    brotli = None
+
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+
+def negotiate(size):
+    """The encoding a ``size``-byte body is sent with to the current client, or None."""
+    if size < MIN_SIZE:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def tag_etag(etag, encoding):
+    return '%s-%s' % (etag, encoding) if encoding else etag
+
+
+def compress(response):
+    """Compress ``response`` in place if it is big enough and the client accepts an encoding."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    encoding = negotiate(len(data))
+    if encoding is None:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not etag.endswith('-' + encoding):
+        response.set_etag(tag_etag(etag, encoding), weak)
+    return response
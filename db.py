@@ -0,0 +1,371 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from flask import g
+
+import metrics
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout."""
+
+
+class Connection(psycopg2.extensions.connection):
+    """A connection that runs ``before_commit`` callbacks as the last statements of each transaction.
+
+    Each callback is called with a cursor right before ``commit()``; a
+    rollback drops them. ``tenant`` is the ``app.tenant_id`` its session is
+    set to (see ConnectionPool._bind).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.before_commit = []
+        self.tenant = ''
+
+    def commit(self):
+        callbacks, self.before_commit = self.before_commit, []
+        if callbacks:
+            with self.cursor() as cur:
+                for callback in callbacks:
+                    callback(cur)
+        super().commit()
+
+    def rollback(self):
+        self.before_commit = []
+        super().rollback()
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 pool with a bounded wait, checkout health checks and metrics.
+
+    Up to ``maxconn`` connections are opened on demand and kept for reuse;
+    ``minconn`` of them are opened on first use. A caller that finds the pool
+    exhausted waits up to ``timeout`` seconds for a connection to be returned.
+    (``psycopg2.pool`` fails immediately instead, and closes every connection
+    above ``minconn`` when it is returned, so it is not used here.)
+
+    Each checkout names the tenant the connection is for (see tenants.py).
+    """
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_idle, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._dsn = dsn
+        self._idle = []  # (conn, returned_at) pairs, most recently returned last
+        self._opened = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'discarded': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _connect(self):
+        return psycopg2.connect(connection_factory=Connection, cursor_factory=metrics.InstrumentedCursor, **self._dsn)
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        # Only pay for a round trip when the connection sat idle long enough
+        # for the server or a proxy to have dropped it.
+        if time.monotonic() - returned_at < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _prefill(self, count):
+        """Open ``count`` idle connections into slots already reserved under the lock."""
+        for opened in range(count):
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                # Only a warm-up: give the slots back, borrowers connect on demand.
+                with self._cond:
+                    self._opened -= count - opened
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _bind(self, conn, tenant):
+        """Set the session's ``app.tenant_id``, which the row-level security policies read."""
+        value = '' if tenant is None else str(tenant)
+        # Kept on the connection, which only its borrower touches, so no
+        # other thread can make this skip the set_config.
+        if conn.tenant == value:
+            return
+        # Set outside a transaction, so a later rollback cannot revert it to
+        # the previous checkout's tenant.
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT set_config('app.tenant_id', %s, false)", (value,))
+        finally:
+            conn.autocommit = False
+        conn.tenant = value
+
+    def getconn(self, tenant=None):
+        """Check out a connection scoped to ``tenant`` (None: sees no tenant's rows)."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            # Reserve the slots up to minconn; they are connected below, outside the lock.
+            prefill = max(0, self.minconn - self._opened)
+            self._opened += prefill
+            while not self._idle and not prefill and self._opened >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._opened >= self.maxconn:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout('No database connection available within %ss' % self.timeout)
+            waited = time.monotonic() - started
+            self._stats['checkouts'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            elif prefill:
+                # One of the reserved slots is this caller's.
+                conn, returned_at = None, None
+                prefill -= 1
+            else:
+                conn, returned_at = None, None
+                self._opened += 1
+
+        # Connect and health-check outside the lock so other threads are not blocked.
+        try:
+            if conn is not None and not self._healthy(conn, returned_at):
+                # Replace the dead connection while keeping its slot.
+                conn.close()
+                with self._cond:
+                    self._stats['discarded'] += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+            self._bind(conn, tenant)
+        except Exception:
+            if conn is not None:
+                conn.close()
+            with self._cond:
+                self._opened -= 1 + prefill
+                self._cond.notify_all()
+            raise
+        self._prefill(prefill)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    def putconn(self, conn):
+        if not conn.closed:
+            try:
+                # Never hand an open transaction to the next request.
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, tenant=None):
+        """Check out a connection for code running outside a request."""
+        conn = self.getconn(tenant)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'open': self._opened,
+                'in_use': self._opened - len(self._idle),
+                'idle': len(self._idle),
+            })
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def dsn():
+    params = {
+        'host': os.environ['DB_HOST'],
+        'database': os.environ['DB_NAME'],
+        'user': os.environ['DB_USER'],
+        'password': os.environ['DB_PASSWORD'],
+    }
+    if os.environ.get('DB_PORT'):
+        params['port'] = int(os.environ['DB_PORT'])
+    return params
+
+
+def new_pool(**overrides):
+    """A pool with the DB_POOL_* settings, connecting to ``dsn()`` updated with ``overrides``."""
+    return ConnectionPool(
+        minconn=int(os.environ.get('DB_POOL_MIN', 1)),
+        maxconn=int(os.environ.get('DB_POOL_MAX', 10)),
+        timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        healthcheck_idle=float(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', 30)),
+        # Bounds how long one request can keep a connection busy.
+        options='-c statement_timeout=%d' % int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000)),
+        **dict(dsn(), **overrides)
+    )
+
+
+def get_pool():
+    """The primary's pool."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = new_pool()
+    return _pool
+
+
+def _forget_pool_after_fork():
+    # A forked worker must open its own connections; the parent's sockets
+    # stay with the parent (gunicorn's preload never opens any).
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
+
+
+def request_pool():
+    """The pool the current request reads from: the replica replicas.py routed it to, else the primary's."""
+    return g.get('db_read_pool') or get_pool()
+
+
+def use_primary():
+    """Run the rest of the current request on the primary, e.g. after it wrote through another connection."""
+    g.pop('db_read_pool', None)
+    g.pop('db_synced_at', None)
+    if 'db_conn' in g and g.get('db_conn_pool') is not get_pool():
+        release_db_connection()
+
+
+def get_db_connection():
+    """Return the connection bound to the current request, checking one out on first use."""
+    if 'db_conn' not in g:
+        started = time.perf_counter()
+        pool = request_pool()
+        g.db_conn = pool.getconn(g.get('tenant_id'))
+        g.db_conn_pool = pool
+        metrics.record_acquire(time.perf_counter() - started)
+    return g.db_conn
+
+
+def release_db_connection(exc=None):
+    """Teardown hook: hand the request's connection back to the pool it came from."""
+    conn = g.pop('db_conn', None)
+    pool = g.pop('db_conn_pool', None)
+    if conn is None:
+        # The request never touched the database (e.g. /ping): leave the pool unopened.
+        return
+    (pool or get_pool()).putconn(conn)
+
+
+def detach_db_connection():
+    """Take the request's connection away from the teardown hook; returns the callable that releases it.
+
+    For a streamed body, which still reads from the connection after the
+    request itself has ended.
+    """
+    conn = g.pop('db_conn')
+    pool = g.pop('db_conn_pool')
+    return lambda: pool.putconn(conn)
+
+
+def bulk_update(cur, table, key_columns, set_columns, rows):
+    """Update many rows with a single ``UPDATE ... FROM (VALUES ...)`` statement.
+
+    ``rows`` are tuples holding the key columns followed by the new values of
+    ``set_columns``. Returns the number of rows updated.
+    """
+    if not rows:
+        return 0
+    columns = list(key_columns) + list(set_columns)
+    quoted = ['"%s"' % c for c in columns]
+    sql = 'UPDATE %s AS t SET %s FROM (VALUES %%s) AS v (%s) WHERE %s' % (
+        table,
+        ', '.join('"%s" = v."%s"' % (c, c) for c in set_columns),
+        ', '.join(quoted),
+        ' AND '.join('t."%s" = v."%s"' % (c, c) for c in key_columns),
+    )
+    # One page so the whole batch is one round trip.
+    execute_values(cur, sql, rows, page_size=len(rows))
+    return cur.rowcount
+
+
+def begin_snapshot(cur):
+    """Start a read-only REPEATABLE READ transaction so several queries see one consistent state.
+
+    Must be the first statement of the transaction.
+    """
+    cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+
+
+class Query:
+    """A read usable from both the sync (psycopg2) and the async (psycopg 3) path.
+
+    ``shape(rows)`` turns the fetched rows into the JSON value; ``params``
+    may be a callable evaluated at run time. Calling the query with a
+    psycopg2 cursor runs it like a plain loader function.
+    """
+
+    def __init__(self, sql, shape, params=()):
+        self.sql = sql
+        self.shape = shape
+        self.params = params
+
+    def args(self):
+        return tuple(self.params() if callable(self.params) else self.params)
+
+    def __call__(self, cur):
+        cur.execute(self.sql, self.args())
+        return self.shape(cur.fetchall())
+
+    async def fetch(self, cur):
+        await cur.execute(self.sql, self.args())
+        return self.shape(await cur.fetchall())
@@ -0,0 +1,280 @@
+"""Change notifications shared by every worker process.
+
+Events are rows of ``app_events`` announced with Postgres NOTIFY. Each
+process runs one listener thread that keeps the newest events in memory
+and wakes the SSE / long-poll requests waiting on them, so clients no
+longer have to poll the data endpoints.
+
+An event belongs to the tenant whose session published it (app_events
+fills ``tenant_id`` from ``app.tenant_id``). The listener keeps each
+tenant's events apart and wakes only the subscribers of the tenant an
+event belongs to.
+"""
+import collections
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import Json
+from flask import g, has_request_context, request
+
+from db import dsn, get_pool
+
+CHANNEL = 'app_events'
+BUFFER_SIZE = 200  # newest events kept per tenant
+RETENTION = '1 day'
+# SSE streams and long polls each hold a server thread while they wait;
+# past this many per process further ones are refused (see app.py).
+MAX_WAITERS = int(os.environ.get('EVENTS_MAX_WAITERS', 4))
+
+log = logging.getLogger(__name__)
+
+
+def publish(cur, kind, payload=None):
+    """Record an event in the current transaction; listeners see it once it commits."""
+    before_commit = getattr(cur.connection, 'before_commit', None)
+    if before_commit is None:
+        _insert(cur, kind, payload)
+    else:
+        # Inserted as the transaction's last statement (see db.Connection),
+        # so the lock below is held for the commit only, not the whole
+        # transaction.
+        before_commit.append(lambda cur: _insert(cur, kind, payload))
+
+
+def _insert(cur, kind, payload):
+    # Serialise one tenant's publishers until commit, so that tenant's event
+    # ids become visible in increasing order and a subscriber's "id > last
+    # seen" never skips one. Other tenants' transactions are not held up.
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), COALESCE(app_tenant_id(), 0))", (CHANNEL,))
+    cur.execute("""
+        WITH e AS (
+            INSERT INTO app_events (kind, payload) VALUES (%s, %s) RETURNING id
+        )
+        SELECT pg_notify(%s, id::text) FROM e
+    """, (kind, Json(payload or {}), CHANNEL))
+
+
+def publish_change(cur, *tables):
+    """Announce that the current request (or background job) modified ``tables``."""
+    endpoint = None
+    if has_request_context():
+        batch = g.get('batch')
+        if batch is not None and cur.connection is batch['conn']:
+            # /batch announces all of its ops' changes once (see batch.py).
+            batch['changes'].update(tables)
+            return
+        endpoint = request.endpoint
+        g.setdefault('changed_tables', set()).update(tables)
+    publish(cur, 'change', {'tables': list(tables), 'endpoint': endpoint})
+
+
+def _event(row):
+    return {'id': row[0], 'kind': row[1], 'payload': row[2], 'created_at': row[3].isoformat(), 'tenant_id': row[4]}
+
+
+class Listener(threading.Thread):
+    """Per tenant, keeps the newest events and wakes only that tenant's subscribers."""
+
+    def __init__(self):
+        super().__init__(name='event-listener', daemon=True)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._conds = {}  # tenant -> Condition on _lock, notified on that tenant's events
+        self.buffers = {}  # tenant -> deque of its newest events
+        self.last_ids = {}  # tenant -> id of its newest event
+        # tenant -> id after which its buffer is complete: the newest id
+        # when first connected, then the newest event evicted from it.
+        self._complete_after = {}
+        self.floor = None  # newest id when first connected; None until then
+        self._conn = None
+        self._last_purge = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(**dsn())
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            for channel in [CHANNEL, *_channel_callbacks]:
+                cur.execute('LISTEN %s' % channel)
+            if self.floor is None:
+                cur.execute('SELECT COALESCE(MAX(id), 0) FROM app_events')
+                with self._lock:
+                    self.floor = cur.fetchone()[0]
+                    self._ready.notify_all()
+        self._conn = conn
+
+    def _catch_up(self):
+        """Read what was published while disconnected: per tenant, everything after its last event."""
+        with self._lock:
+            seen = dict(self.last_ids)
+        with self._conn.cursor() as cur:
+            cur.execute("""
+                SELECT e.id, e.kind, e.payload, e.created_at, e.tenant_id
+                FROM app_events e
+                LEFT JOIN unnest(%s::integer[], %s::bigint[]) AS seen (tenant_id, last_id)
+                    ON seen.tenant_id = e.tenant_id
+                WHERE e.id > %s AND e.id > COALESCE(seen.last_id, %s)
+                ORDER BY e.id
+            """, (list(seen), list(seen.values()), min([self.floor, *seen.values()]), self.floor))
+            self._deliver([_event(row) for row in cur.fetchall()])
+
+    def _fetch(self, ids):
+        with self._conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, kind, payload, created_at, tenant_id FROM app_events
+                WHERE id = ANY(%s) ORDER BY id
+            """, (ids,))
+            self._deliver([_event(row) for row in cur.fetchall()])
+
+    def _deliver(self, events):
+        new = []
+        with self._lock:
+            for event in events:
+                tenant = event['tenant_id']
+                if event['id'] <= self.last_ids.get(tenant, 0):
+                    continue  # already delivered before a reconnect
+                buffer = self.buffers.get(tenant)
+                if buffer is None:
+                    buffer = self.buffers[tenant] = collections.deque(maxlen=BUFFER_SIZE)
+                    self._complete_after[tenant] = self.floor
+                elif len(buffer) == BUFFER_SIZE:
+                    self._complete_after[tenant] = buffer[0]['id']
+                buffer.append(event)
+                self.last_ids[tenant] = event['id']
+                new.append(event)
+            for tenant in {event['tenant_id'] for event in new}:
+                cond = self._conds.get(tenant)
+                if cond is not None:
+                    cond.notify_all()
+        for callback in list(_callbacks):
+            for event in new:
+                try:
+                    callback(event)
+                except Exception:
+                    log.exception('Event callback failed')
+
+    def _purge(self):
+        if time.monotonic() - self._last_purge < 600:
+            return
+        self._last_purge = time.monotonic()
+        with self._conn.cursor() as cur:
+            cur.execute("DELETE FROM app_events WHERE created_at < now() - %s::interval", (RETENTION,))
+
+    def run(self):
+        while True:
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._connect()
+                    self._catch_up()
+                if select.select([self._conn], [], [], 30) != ([], [], []):
+                    self._conn.poll()
+                    if self._conn.notifies:
+                        notifies = list(self._conn.notifies)
+                        self._conn.notifies.clear()
+                        # Notifications arrive in commit order; each names its event.
+                        ids = [int(n.payload) for n in notifies if n.channel == CHANNEL]
+                        if ids:
+                            self._fetch(ids)
+                        for channel in {n.channel for n in notifies} - {CHANNEL}:
+                            _channel_callbacks[channel]()
+                self._purge()
+            except Exception:
+                log.exception('Event listener lost its connection, reconnecting')
+                if self._conn is not None:
+                    self._conn.close()
+                time.sleep(1)
+
+    def wait(self, since, timeout, tenant):
+        """``tenant``'s events after ``since`` (None: only future events), waiting up to ``timeout`` seconds for one.
+
+        Returns ``(last_id, events)``; ``last_id`` is the ``since`` of the next call.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self.floor is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return since or 0, []
+                self._ready.wait(remaining)
+            if since is None:
+                since = self.last_ids.get(tenant, self.floor)
+            upto = self.last_ids.get(tenant, self.floor)
+            if since >= self._complete_after.get(tenant, self.floor):
+                cond = self._conds.get(tenant)
+                if cond is None:
+                    cond = self._conds[tenant] = threading.Condition(self._lock)
+                while self.last_ids.get(tenant, 0) <= since:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return since, []
+                    cond.wait(remaining)
+                return self.last_ids[tenant], [e for e in self.buffers[tenant] if e['id'] > since]
+        # The client is further behind than the buffer reaches: read the table.
+        with get_pool().connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, kind, payload, created_at, tenant_id FROM app_events
+                WHERE tenant_id = %s AND id > %s AND id <= %s ORDER BY id LIMIT %s
+            """, (tenant, since, upto, BUFFER_SIZE))
+            events = [_event(row) for row in cur.fetchall()]
+        if not events:
+            return self.wait(upto, max(deadline - time.monotonic(), 0), tenant)
+        return (events[-1]['id'] if len(events) == BUFFER_SIZE else upto), events
+
+
+_listener = None
+_listener_lock = threading.Lock()
+_callbacks = []
+_channel_callbacks = {}  # other NOTIFY channel -> callback()
+# One slot per request waiting on events: acquire(blocking=False) before
+# waiting, release when the response closes.
+waiter_slots = threading.BoundedSemaphore(MAX_WAITERS)
+
+
+def _forget_listener_after_fork():
+    # The listener thread does not survive a fork; each worker starts its own.
+    global _listener, _listener_lock, waiter_slots
+    _listener = None
+    _listener_lock = threading.Lock()
+    waiter_slots = threading.BoundedSemaphore(MAX_WAITERS)
+
+
+os.register_at_fork(after_in_child=_forget_listener_after_fork)
+
+
+def get_listener():
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = Listener()
+                _listener.start()
+    return _listener
+
+
+def on_event(callback):
+    """Call ``callback(event)`` on the listener thread for every event, from any worker."""
+    _callbacks.append(callback)
+    return callback
+
+
+def on_notify(channel, callback):
+    """Call ``callback()`` on the listener thread after a NOTIFY on ``channel`` (register at import time)."""
+    _channel_callbacks[channel] = callback
+
+
+def sse_stream(since, tenant, heartbeat=15):
+    """Generator of Server-Sent Events frames for one subscriber of ``tenant``."""
+    listener = get_listener()
+    yield 'retry: 3000\n\n'
+    while True:
+        since, events = listener.wait(since, heartbeat, tenant)
+        if not events:
+            yield ': keep-alive\n\n'
+            continue
+        for event in events:
+            yield 'id: %d\nevent: %s\ndata: %s\n\n' % (event['id'], event['kind'], json.dumps(event))
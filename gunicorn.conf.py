@@ -0,0 +1,78 @@
+"""Production server settings: ``gunicorn -c gunicorn.conf.py 'app:create_app()'``.
+
+Every value can be overridden from the environment. For the ASGI mode
+(see asgi.py) add ``-k uvicorn.workers.UvicornWorker asgi:application``.
+"""
+import multiprocessing
+import os
+import tempfile
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '5000')
+
+# Threads, not more processes, absorb the long-lived /events and
+# /events/poll requests; processes scale the CPU-bound work.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# Each event stream or long poll holds a thread for as long as it is open;
+# past half the threads more are answered 503, so they can never take
+# every thread from the other requests (see events.py).
+os.environ.setdefault('EVENTS_MAX_WAITERS', str(max(1, threads // 2)))
+
+# Postgres connections. Each worker opens up to DB_POOL_MAX pooled
+# connections, one for the event listener and, with DB_REPLICA_HOSTS, one
+# for the replica monitor on the primary. DB_MAX_CONNECTIONS is the budget
+# all workers together must stay within: the server's max_connections
+# (100 by default) minus headroom for migrations, psql and other clients.
+# The pool gets an equal share of it, and never more than the threads
+# that can use it (request threads plus job workers). Setting DB_POOL_MAX
+# overrides the share; then workers * (DB_POOL_MAX + 2) must fit yourself.
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 90))
+if 'DB_POOL_MAX' not in os.environ:
+    per_worker = DB_MAX_CONNECTIONS // workers - 1 - bool(os.environ.get('DB_REPLICA_HOSTS'))
+    if per_worker < 1:
+        raise RuntimeError('DB_MAX_CONNECTIONS=%d cannot serve %d workers; lower WEB_CONCURRENCY'
+                           % (DB_MAX_CONNECTIONS, workers))
+    os.environ['DB_POOL_MAX'] = str(min(per_worker, threads + int(os.environ.get('JOB_WORKERS', 1))))
+
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Workers that stop heartbeating this long are killed and replaced; single
+# queries are bounded separately by DB_STATEMENT_TIMEOUT_MS.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# On SIGTERM workers stop accepting, finish in-flight requests for up to
+# this long, then flush the write-behind buffer (worker_exit below).
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Recycle workers now and then so slow leaks cannot accumulate; the jitter
+# keeps them from restarting together.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+# Import the app once in the master so workers fork ready to serve. Nothing
+# connects to Postgres or starts a thread at import time; what a worker
+# inherits is reset after the fork (os.register_at_fork in db, events,
+# cache, writebehind, jobs and replicas).
+preload_app = True
+
+accesslog = '-'
+
+# Workers share their request metrics through this directory, so /metrics
+# reports the whole server whichever worker answers (see metrics.py).
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='app-metrics-'))
+
+
+def on_starting(server):
+    import metrics
+    metrics.clear_shared_dir()
+
+
+def worker_exit(server, worker):
+    import metrics
+    import writebehind
+    writebehind.buffer.flush()
+    metrics.dump()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.archive(worker.pid)
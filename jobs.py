@@ -0,0 +1,431 @@
+"""Postgres-backed queue for maintenance work that should not hold up a request.
+
+A request handler enqueues a job with its own cursor, so the job exists
+exactly when the request's writes do, and returns:
+
+    jobs.enqueue(cur, 'rebalance', {'table': 'tasks', 'group': ['x']}, dedupe='rebalance:tasks:["x"]')
+
+Worker threads (JOB_WORKERS per app process, started with its first
+request; or ``python jobs.py work`` on its own) claim due jobs with
+``FOR UPDATE SKIP LOCKED``, so any number of them share the queue, and run
+each with a connection and ``tenants.scope`` for the job's tenant. An idle
+worker sleeps until ``enqueue``'s NOTIFY reaches the process's event
+listener (see events.py), or for JOB_POLL_SECONDS at most, which is how
+late delayed jobs, retries and expired leases may start. A
+claimed job is leased for JOB_LEASE_SECONDS (keep it above the slowest
+job): if its worker dies, another one claims it again after that. A
+failing job is retried with exponential backoff; after ``max_attempts``
+it stays ``failed`` until retried by hand.
+
+``schedule`` registers cron-like recurring jobs ("minute hour day month
+weekday", server local time). Each slot is enqueued once per deployment,
+for every tenant or once.
+
+GET /jobs lists the tenant's pending, running and failed jobs, and
+/job_stats counts them.
+
+    python jobs.py work                          # a worker process
+    python jobs.py list [--status failed] [--kind KIND]
+    python jobs.py retry ID
+    python jobs.py run KIND [--tenant ID] [--args JSON]   # enqueue now
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import psycopg2.errors
+from psycopg2.extras import Json
+
+import events
+import tenants
+from db import get_pool
+
+log = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+# Longest idle wait; a job enqueued to run now wakes the workers at once.
+POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 30))
+LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+KEEP_DAYS = int(os.environ.get('JOB_KEEP_DAYS', 7))
+BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 3600
+STATUSES = ('pending', 'running', 'done', 'failed')
+
+HANDLERS = {}  # kind -> fn(conn, args)
+SCHEDULES = []
+
+CHANNEL = 'jobs'
+
+Job = namedtuple('Job', 'id tenant kind args attempts max_attempts')
+Schedule = namedtuple('Schedule', 'name cron kind args per_tenant')
+
+_CURRENT = object()
+
+
+def handler(kind):
+    """Register ``fn(conn, args)`` to run the jobs of ``kind``.
+
+    It runs as the job's tenant on a connection checked out for it, and may
+    commit along the way; what it leaves uncommitted is committed after it
+    returns. An exception fails the attempt.
+    """
+    def decorator(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+def enqueue(cur, kind, args=None, tenant=_CURRENT, dedupe=None, delay=0, max_attempts=5):
+    """Queue a job in ``cur``'s transaction; it runs once that commits. Returns its id.
+
+    ``tenant`` defaults to the current one; None queues deployment-wide
+    work. If a pending job of the tenant already has the ``dedupe`` key, no
+    job is added and None is returned.
+    """
+    if tenant is _CURRENT:
+        tenant = tenants.current()
+    cur.execute("""
+        INSERT INTO jobs (tenant_id, kind, args, dedupe_key, run_at, max_attempts)
+        VALUES (%s, %s, %s, %s, now() + %s * interval '1 second', %s)
+        ON CONFLICT (COALESCE(tenant_id, 0), dedupe_key) WHERE status = 'pending' DO NOTHING
+        RETURNING id
+    """, (tenant, kind, Json(args or {}), dedupe, delay, max_attempts))
+    row = cur.fetchone()
+    if row and delay <= 0:
+        # Delivered on commit: idle workers claim it without waiting out their poll.
+        cur.execute('SELECT pg_notify(%s, %s)', (CHANNEL, ''))
+    return row[0] if row else None
+
+
+# ---------- workers ----------
+
+def claim():
+    """Lease the next due job, or a running one whose lease ran out. Returns a Job or None."""
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                       locked_until = now() + %s * interval '1 second'
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE (status = 'pending' AND run_at <= now())
+                       OR (status = 'running' AND locked_until < now())
+                    ORDER BY run_at, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, tenant_id, kind, args, attempts, max_attempts
+            """, (LEASE_SECONDS,))
+            row = cur.fetchone()
+        conn.commit()
+    return Job(*row) if row else None
+
+
+def run(job):
+    """Run a claimed job and record the outcome."""
+    fn = HANDLERS.get(job.kind)
+    try:
+        if fn is None:
+            raise LookupError('No handler for job kind %r' % job.kind)
+        if job.attempts > job.max_attempts:
+            raise RuntimeError('Lease expired on the last attempt')
+        with get_pool().connection(job.tenant) as conn, tenants.scope(job.tenant):
+            fn(conn, job.args)
+            conn.commit()
+    except Exception as e:
+        log.exception('Job %d (%s) failed, attempt %d of %d', job.id, job.kind, job.attempts, job.max_attempts)
+        _finish(job, '%s: %s' % (type(e).__name__, e))
+    else:
+        _finish(job)
+
+
+def _finish(job, error=None):
+    # Only if still ours: a lease that ran out lets another worker rerun it.
+    mine = 'WHERE id = %s AND status = %s AND attempts = %s'
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            if error is None:
+                cur.execute("UPDATE jobs SET status = 'done', finished_at = now(), locked_until = NULL " + mine,
+                            (job.id, 'running', job.attempts))
+            elif job.attempts >= job.max_attempts:
+                cur.execute("UPDATE jobs SET status = 'failed', finished_at = now(), locked_until = NULL, "
+                            "last_error = %s " + mine, (error, job.id, 'running', job.attempts))
+            else:
+                backoff = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+                try:
+                    cur.execute("UPDATE jobs SET status = 'pending', run_at = now() + %s * interval '1 second', "
+                                "locked_until = NULL, last_error = %s " + mine,
+                                (backoff, error, job.id, 'running', job.attempts))
+                except psycopg2.errors.UniqueViolation:
+                    # A newer pending job with the same key does the work instead.
+                    conn.rollback()
+                    cur.execute("UPDATE jobs SET status = 'done', finished_at = now(), locked_until = NULL, "
+                                "last_error = %s " + mine,
+                                (error + ' (superseded)', job.id, 'running', job.attempts))
+        conn.commit()
+
+
+_wakeup = threading.Event()
+events.on_notify(CHANNEL, _wakeup.set)
+
+
+def _work():
+    events.get_listener()
+    while True:
+        _wakeup.clear()
+        try:
+            job = claim()
+        except Exception:
+            log.exception('Claiming a job failed')
+            job = None
+        if job is None:
+            _wakeup.wait(POLL_SECONDS)
+            continue
+        try:
+            run(job)
+        except Exception:
+            # Its outcome could not be recorded; the lease running out hands it on.
+            log.exception('Recording the outcome of job %d failed', job.id)
+
+
+# ---------- schedules ----------
+
+_CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_cron(expr):
+    """``'minute hour day month weekday'`` as sets of allowed values (weekday 0 or 7 is Sunday).
+
+    Fields take ``*``, ``N``, ``A-B``, a ``/STEP`` after either, and comma
+    lists of those. Raises ValueError for anything else.
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError('A cron expression has five fields: %r' % expr)
+    allowed = []
+    for field, (low, high) in zip(fields, _CRON_RANGES):
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = (int(v) for v in span.split('-', 1))
+            else:
+                start = int(span)
+                end = high if step else start
+            if not low <= start <= end <= high:
+                raise ValueError('%r is out of range in %r' % (part, expr))
+            values.update(range(start, end + 1, int(step) if step else 1))
+        allowed.append(values)
+    if 7 in allowed[4]:
+        allowed[4].add(0)
+    # As in cron, restricting both the day and the weekday matches either.
+    return allowed + [fields[2] == '*' or fields[4] == '*']
+
+
+def cron_matches(cron, when):
+    minutes, hours, days, months, weekdays, both = cron
+    if when.minute not in minutes or when.hour not in hours or when.month not in months:
+        return False
+    day, weekday = when.day in days, when.isoweekday() % 7 in weekdays
+    return day and weekday if both else day or weekday
+
+
+def schedule(name, cron, kind, args=None, per_tenant=True):
+    """Enqueue ``kind`` at every minute matching ``cron``, for each tenant or (``per_tenant=False``) once."""
+    SCHEDULES.append(Schedule(name, parse_cron(cron), kind, args or {}, per_tenant))
+
+
+def enqueue_due(slot):
+    """Enqueue the schedules matching minute ``slot`` that no other process enqueued yet."""
+    due = [s for s in SCHEDULES if cron_matches(s.cron, slot)]
+    if not due:
+        return
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            for s in due:
+                cur.execute("""
+                    INSERT INTO job_schedules (name, last_slot) VALUES (%s, %s)
+                    ON CONFLICT (name) DO UPDATE SET last_slot = EXCLUDED.last_slot
+                    WHERE job_schedules.last_slot < EXCLUDED.last_slot
+                    RETURNING 1
+                """, (s.name, slot))
+                if cur.fetchone() is None:
+                    continue
+                for tenant in tenants.all_ids(cur) if s.per_tenant else [None]:
+                    enqueue(cur, s.kind, s.args, tenant=tenant, dedupe='schedule:' + s.name)
+        conn.commit()
+
+
+def _schedule_loop():
+    slot = datetime.now().replace(second=0, microsecond=0)
+    while True:
+        try:
+            enqueue_due(slot)
+        except Exception:
+            log.exception('Enqueueing the scheduled jobs of %s failed', slot)
+        slot += timedelta(minutes=1)
+        now = datetime.now()
+        if now - slot > timedelta(minutes=1):
+            # Suspended or stalled: go on from the current minute.
+            slot = now.replace(second=0, microsecond=0)
+        time.sleep(max(0, (slot - now).total_seconds()))
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def start(workers=WORKERS):
+    """Start this process's worker threads and scheduler, once."""
+    global _started
+    if _started or workers <= 0:
+        return
+    with _start_lock:
+        if _started:
+            return
+        for i in range(workers):
+            threading.Thread(target=_work, name='job-worker-%d' % i, daemon=True).start()
+        threading.Thread(target=_schedule_loop, name='job-scheduler', daemon=True).start()
+        _started = True
+
+
+def _forget_workers_after_fork():
+    # Threads do not survive a fork: each worker process starts its own.
+    global _started, _start_lock, _wakeup
+    _started = False
+    _start_lock = threading.Lock()
+    _wakeup = threading.Event()
+    events.on_notify(CHANNEL, _wakeup.set)
+
+
+os.register_at_fork(after_in_child=_forget_workers_after_fork)
+
+
+def init_app(app):
+    """Start the workers with the first request (after any fork of the server)."""
+    @app.before_request
+    def _start_workers():
+        start()
+
+
+# ---------- visibility ----------
+
+def _job(row):
+    return {
+        'id': row[0], 'tenant_id': row[1], 'kind': row[2], 'args': row[3], 'status': row[4],
+        'attempts': row[5], 'max_attempts': row[6], 'run_at': row[7].isoformat(),
+        'last_error': row[8], 'created_at': row[9].isoformat(),
+        'finished_at': row[10].isoformat() if row[10] else None,
+    }
+
+
+def listing(cur, tenant=_CURRENT, statuses=('pending', 'running', 'failed'), kind=None, limit=100):
+    """The newest jobs in ``statuses`` (of ``tenant``, default the current one; None: every tenant's)."""
+    if tenant is _CURRENT:
+        tenant = tenants.current()
+    cur.execute("""
+        SELECT id, tenant_id, kind, args, status, attempts, max_attempts, run_at, last_error, created_at, finished_at
+        FROM jobs
+        WHERE (%s::integer IS NULL OR tenant_id = %s) AND status = ANY(%s) AND (%s::text IS NULL OR kind = %s)
+        ORDER BY id DESC
+        LIMIT %s
+    """, (tenant, tenant, list(statuses), kind, kind, limit))
+    return [_job(row) for row in cur.fetchall()]
+
+
+def counts(cur, tenant=None):
+    """``{kind: {status: count}}`` for ``tenant``, or every tenant (None)."""
+    cur.execute("""
+        SELECT kind, status, count(*) FROM jobs
+        WHERE %s::integer IS NULL OR tenant_id = %s
+        GROUP BY kind, status
+    """, (tenant, tenant))
+    result = {}
+    for kind, status, count in cur.fetchall():
+        result.setdefault(kind, dict.fromkeys(STATUSES, 0))[status] = count
+    return result
+
+
+def retry(cur, job_id, tenant=_CURRENT):
+    """Queue a failed job again with fresh attempts. Returns False if there is no such failed job.
+
+    Raises psycopg2.errors.UniqueViolation if a pending job has its dedupe key.
+    """
+    if tenant is _CURRENT:
+        tenant = tenants.current()
+    cur.execute("""
+        UPDATE jobs SET status = 'pending', attempts = 0, run_at = now(), finished_at = NULL
+        WHERE id = %s AND status = 'failed' AND (%s::integer IS NULL OR tenant_id = %s)
+    """, (job_id, tenant, tenant))
+    return cur.rowcount > 0
+
+
+# ---------- housekeeping ----------
+
+@handler('prune_jobs')
+def prune_jobs(conn, args):
+    """Forget finished jobs older than JOB_KEEP_DAYS; failed ones stay until retried."""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < now() - %s * interval '1 day'",
+                    (KEEP_DAYS,))
+
+
+schedule('prune_jobs', '40 3 * * *', 'prune_jobs', per_tenant=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    work_parser = commands.add_parser('work', help='run workers and the scheduler until interrupted')
+    work_parser.add_argument('--threads', type=int, default=max(WORKERS, 1))
+    list_parser = commands.add_parser('list', help="list every tenant's jobs")
+    list_parser.add_argument('--status', action='append', choices=STATUSES)
+    list_parser.add_argument('--kind')
+    retry_parser = commands.add_parser('retry', help='queue a failed job again')
+    retry_parser.add_argument('id', type=int)
+    run_parser = commands.add_parser('run', help='enqueue a job now')
+    run_parser.add_argument('kind')
+    run_parser.add_argument('--tenant', type=int, help='default: deployment-wide')
+    run_parser.add_argument('--args', type=json.loads, default={})
+    args = parser.parse_args()
+
+    # Registers the handlers and schedules of every module.
+    import app
+
+    if args.command == 'work':
+        start(args.threads)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return 0
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        if args.command == 'list':
+            for job in reversed(listing(cur, None, args.status or STATUSES, args.kind)):
+                print('%8d  %-8s %-20s tenant %-6s %d/%d  %s  %s' % (
+                    job['id'], job['status'], job['kind'], job['tenant_id'], job['attempts'], job['max_attempts'],
+                    json.dumps(job['args'], ensure_ascii=False), job['last_error'] or ''))
+        elif args.command == 'retry':
+            if not retry(cur, args.id, None):
+                print('no failed job %d' % args.id)
+                return 1
+        else:
+            if args.kind not in HANDLERS:
+                print('unknown job kind %r (known: %s)' % (args.kind, ', '.join(sorted(HANDLERS))))
+                return 1
+            print('job %s queued' % enqueue(cur, args.kind, args.args, tenant=args.tenant))
+        conn.commit()
+    return 0
+
+
+if __name__ == '__main__':
+    # Run as the importable module, whose registry the other modules fill.
+    import jobs
+    sys.exit(jobs.main())
@@ -0,0 +1,355 @@
+"""Per-endpoint request metrics in the Prometheus text format.
+
+``init_app`` installs before/after-request hooks that time every request;
+pooled connections use ``InstrumentedCursor``, which adds each statement's
+time and row count to the current request. Per endpoint this records
+latency, database time, statements, rows returned, response size and the
+wait for a pooled connection, all served by GET /metrics.
+
+Requests slower than ``METRICS_SLOW_MS`` or issuing more than
+``METRICS_MANY_QUERIES`` statements (the usual N+1 signature) are logged
+as one JSON line each.
+
+Each worker process counts in memory. With ``METRICS_DIR`` set (gunicorn.conf.py
+sets it), every worker also writes its counts to ``<pid>.json`` there at
+most every ``METRICS_DUMP_INTERVAL`` seconds, and /metrics sums all
+workers, so any worker answers a scrape with the same totals. The master
+folds an exited worker's file into ``archived.json`` (``archive``), so the
+counters never go backwards when workers are recycled. Pool gauges are
+reported per live worker.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from psycopg2.extensions import cursor as base_cursor
+
+SLOW_MS = float(os.environ.get('METRICS_SLOW_MS', 0))  # 0: off
+MANY_QUERIES = int(os.environ.get('METRICS_MANY_QUERIES', 20))
+SHARED_DIR = os.environ.get('METRICS_DIR') or None  # None: this process only
+DUMP_INTERVAL = float(os.environ.get('METRICS_DUMP_INTERVAL', 1))
+ARCHIVE = 'archived.json'
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNTS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+log = logging.getLogger(__name__)
+
+
+class InstrumentedCursor(base_cursor):
+    """psycopg2 cursor that reports statement time and rows returned to the current request."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_query(time.perf_counter() - started, self)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record_query(time.perf_counter() - started, self)
+
+
+def _record_query(elapsed, cur):
+    if not has_request_context():
+        return
+    stats = g.get('request_stats')
+    if stats is not None:
+        stats['db_time'] += elapsed
+        stats['queries'] += 1
+        if cur.description is not None and cur.rowcount > 0:
+            stats['rows'] += cur.rowcount
+
+
+def record_acquire(elapsed):
+    """Add the wait for a pooled connection to the current request."""
+    if has_request_context() and 'request_stats' in g:
+        g.request_stats['acquire_time'] += elapsed
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+
+
+# name -> (help, buckets); every histogram is labelled by endpoint and method.
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Request latency', SECONDS),
+    'db_time_seconds': ('Time spent in database statements per request', SECONDS),
+    'db_queries_per_request': ('Statements issued per request', COUNTS),
+    'db_rows_per_request': ('Rows returned by the database per request', COUNTS),
+    'http_response_bytes': ('Response body size (buffered responses only)', BYTES),
+    'db_connection_acquire_seconds': ('Wait for a pooled connection per request', SECONDS),
+}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, endpoint, method) -> Histogram
+        self._requests = {}  # (endpoint, method, status) -> count
+
+    def observe(self, endpoint, method, status, values):
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for name, value in values.items():
+                if value is None:
+                    continue
+                histogram = self._histograms.get((name, endpoint, method))
+                if histogram is None:
+                    histogram = self._histograms[(name, endpoint, method)] = Histogram(HISTOGRAMS[name][1])
+                histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': [[*key, count] for key, count in self._requests.items()],
+                'histograms': [[*key, histogram.counts, histogram.sum]
+                               for key, histogram in self._histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        """Add the counts of another registry's ``snapshot()``."""
+        with self._lock:
+            for endpoint, method, status, count in snapshot['requests']:
+                key = (endpoint, method, status)
+                self._requests[key] = self._requests.get(key, 0) + count
+            for name, endpoint, method, counts, total in snapshot['histograms']:
+                histogram = self._histograms.get((name, endpoint, method))
+                if histogram is None:
+                    histogram = self._histograms[(name, endpoint, method)] = Histogram(HISTOGRAMS[name][1])
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+
+    def render(self, pool_stats=None, replica_stats=None):
+        lines = ['# HELP http_requests_total Requests handled', '# TYPE http_requests_total counter']
+        with self._lock:
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append('http_requests_total{%s} %d' % (
+                    _labels(endpoint=endpoint, method=method, status=status), count))
+            for name, (help_text, buckets) in HISTOGRAMS.items():
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                for (metric, endpoint, method), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    labels = _labels(endpoint=endpoint, method=method)
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+                    lines.append('%s_sum{%s} %s' % (name, labels, repr(histogram.sum)))
+                    lines.append('%s_count{%s} %d' % (name, labels, cumulative))
+        # Either one process's {key: value}, or {worker pid: {key: value}}.
+        by_worker = pool_stats if pool_stats and isinstance(next(iter(pool_stats.values())), dict) else None
+        for key in sorted(next(iter(by_worker.values())) if by_worker else pool_stats or {}):
+            name = 'db_pool_%s' % key
+            lines.append('# TYPE %s gauge' % name)
+            if by_worker is None:
+                lines.append('%s %s' % (name, pool_stats[key]))
+                continue
+            for worker, stats in sorted(by_worker.items()):
+                lines.append('%s{%s} %s' % (name, _labels(worker=worker), stats[key]))
+        for key in ('healthy', 'lag_seconds', 'lag_bytes') if replica_stats else ():
+            name = 'db_replica_%s' % key
+            lines.append('# TYPE %s gauge' % name)
+            for replica, stats in sorted(replica_stats.items()):
+                if stats[key] is not None:
+                    value = int(stats[key]) if key == 'healthy' else stats[key]
+                    lines.append('%s{%s} %s' % (name, _labels(replica=replica), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in labels.items())
+
+
+registry = Registry()
+_gauges = None  # callable returning this process's pool gauges, see init_app
+
+
+# ---------- SHARED ACROSS WORKERS ----------
+class _Dumper:
+    """Writes this process's registry to ``SHARED_DIR`` after it changes, at most every DUMP_INTERVAL."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._thread = None
+
+    def touch(self):
+        self._dirty.set()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='metrics-dump', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(DUMP_INTERVAL)
+            self._dirty.clear()
+            try:
+                dump()
+            except Exception:
+                log.exception('Writing metrics to %s failed', SHARED_DIR)
+
+
+_dumper = _Dumper()
+os.register_at_fork(after_in_child=lambda: _dumper.__init__())
+
+
+def _write(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)  # readers never see a partial file
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _dir_lock(mode):
+    """Shared for reading the directory, exclusive while ``archive`` moves a file into the archive."""
+    with open(os.path.join(SHARED_DIR, '.lock'), 'a') as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def dump():
+    """Write this process's counts and pool gauges to ``SHARED_DIR``."""
+    if SHARED_DIR is None:
+        return
+    snapshot = registry.snapshot()
+    snapshot['gauges'] = _gauges() if _gauges is not None else {}
+    _write(os.path.join(SHARED_DIR, '%d.json' % os.getpid()), snapshot)
+
+
+def archive(pid):
+    """Fold an exited worker's counts into the archive (gunicorn's ``child_exit``, in the master)."""
+    if SHARED_DIR is None:
+        return
+    path = os.path.join(SHARED_DIR, '%d.json' % pid)
+    with _dir_lock(fcntl.LOCK_EX):
+        snapshot = _read(path)
+        if snapshot is None:
+            return
+        archived = Registry()
+        archived.merge(_read(os.path.join(SHARED_DIR, ARCHIVE)) or {'requests': [], 'histograms': []})
+        archived.merge(snapshot)
+        _write(os.path.join(SHARED_DIR, ARCHIVE), archived.snapshot())
+        os.remove(path)
+
+
+def clear_shared_dir():
+    """Forget the counts of a previous server run (gunicorn's ``on_starting``)."""
+    if SHARED_DIR is None:
+        return
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    for name in os.listdir(SHARED_DIR):
+        if name.endswith('.json'):
+            os.remove(os.path.join(SHARED_DIR, name))
+
+
+def render(replica_stats=None):
+    """The /metrics text: this process's numbers, or every worker's with ``SHARED_DIR``."""
+    own_gauges = _gauges() if _gauges is not None else None
+    if SHARED_DIR is None:
+        return registry.render(own_gauges, replica_stats)
+    total = Registry()
+    total.merge(registry.snapshot())  # this worker's live counts, not its last dump
+    pool_stats = {os.getpid(): own_gauges} if own_gauges else {}
+    own = '%d.json' % os.getpid()
+    with _dir_lock(fcntl.LOCK_SH):
+        for name in os.listdir(SHARED_DIR):
+            if name == own or not name.endswith('.json'):
+                continue
+            snapshot = _read(os.path.join(SHARED_DIR, name))
+            if snapshot is None:
+                continue
+            total.merge(snapshot)
+            if snapshot.get('gauges') and name != ARCHIVE:
+                pool_stats[int(name[:-len('.json')])] = snapshot['gauges']
+    return total.render(pool_stats, replica_stats)
+
+
+def _before_request():
+    g.request_stats = {'started': time.perf_counter(), 'db_time': 0.0, 'queries': 0, 'rows': 0,
+                       'acquire_time': 0.0}
+
+
+def _after_request(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    elapsed = time.perf_counter() - stats['started']
+    endpoint = request.endpoint or 'unmatched'
+    size = None if response.is_streamed else response.calculate_content_length()
+    registry.observe(endpoint, request.method, response.status_code, {
+        'http_request_duration_seconds': elapsed,
+        'db_time_seconds': stats['db_time'],
+        'db_queries_per_request': stats['queries'],
+        'db_rows_per_request': stats['rows'],
+        'http_response_bytes': size,
+        'db_connection_acquire_seconds': stats['acquire_time'],
+    })
+    if SHARED_DIR is not None:
+        _dumper.touch()
+
+    slow = SLOW_MS and elapsed * 1000 >= SLOW_MS
+    if slow or stats['queries'] > MANY_QUERIES:
+        log.warning(json.dumps({
+            'event': 'slow_request' if slow else 'many_queries',
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 2),
+            'db_ms': round(stats['db_time'] * 1000, 2),
+            'queries': stats['queries'],
+            'rows': stats['rows'],
+            'bytes': size,
+            'acquire_ms': round(stats['acquire_time'] * 1000, 2),
+        }))
+    return response
+
+
+def init_app(app, gauges=None):
+    """``gauges``: returns this process's pool gauges for /metrics."""
+    global _gauges
+    _gauges = gauges
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,203 @@
+"""Versioned schema migrations for the files in migrations/.
+
+Each migration is a pair ``NNN_name.up.sql`` / ``NNN_name.down.sql`` and
+runs in its own transaction together with its row in ``schema_migrations``.
+The migrations are written to be re-runnable, so a database that had some
+of them applied by hand is brought under this tool with a plain ``apply``.
+
+    python migrate.py status
+    python migrate.py apply [--to 006]
+    python migrate.py rollback [--steps 1 | --to 004]
+    python migrate.py check
+
+``check`` EXPLAINs the hot queries of app.py with sequential scans
+disabled and exits non-zero if any of them still needs one, i.e. has no
+usable index.
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+
+import psycopg2
+
+from db import dsn
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+LOCK_KEY = 'schema_migrations'
+
+Migration = collections.namedtuple('Migration', 'version name up down')
+
+# (name, query, sample parameters) for the lookups every request depends on.
+HOT_QUERIES = [
+    ('file by key', 'SELECT content, linked, revision FROM files WHERE topic_id = %s AND name = %s', (1, 'x')),
+    ('files of topic', 'SELECT name, section FROM files WHERE topic_id = %s', (1,)),
+    ('linked files', 'SELECT topic_id, name, section FROM files WHERE linked = TRUE', ()),
+    ('task by file', 'SELECT section FROM tasks WHERE topic_id = %s AND file_name = %s', (1, 'x')),
+    ('tasks by section', 'SELECT topic_id, file_name, "order" FROM tasks WHERE section = %s ORDER BY "order"', ('x',)),
+    ('task list', 'SELECT topic_id, file_name, section, "order" FROM tasks ORDER BY section, "order"', ()),
+    ('topics of house', 'SELECT id FROM topics WHERE house = %s ORDER BY "order", id', ('x',)),
+    ('control by file', 'SELECT is_plan FROM control WHERE topic_id = %s AND name_file = %s', (1, 'x')),
+    ('food of day', 'SELECT name, calories, protein FROM food WHERE date = %s ORDER BY id', ('2024-01-01',)),
+    ('green note by signature', 'SELECT id FROM green_notes WHERE signature = %s', ('x',)),
+    ('green note scores', 'SELECT category, score FROM green_note_scores WHERE note_id = %s', (1,)),
+    ('unclassified list', 'SELECT "order", content FROM unclassified_tasks ORDER BY "order"', ()),
+    ('search words', "SELECT key FROM search_index WHERE tsv @@ websearch_to_tsquery('simple', %s)", ('x',)),
+    ('search substring', 'SELECT key FROM search_index WHERE body ILIKE %s', ('%abc%',)),
+]
+
+
+def discover():
+    """All migrations on disk, in version order."""
+    found = {}
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'^(\d+)_(.+)\.(up|down)\.sql$', filename)
+        if not match:
+            continue
+        version, name, direction = match.groups()
+        found.setdefault(version, {'name': name})[direction] = os.path.join(MIGRATIONS_DIR, filename)
+    migrations = []
+    for version, files in sorted(found.items()):
+        if 'up' not in files or 'down' not in files:
+            raise SystemExit('Migration %s is missing its %s file' % (version, 'down' if 'up' in files else 'up'))
+        migrations.append(Migration(version, files['name'], files['up'], files['down']))
+    return migrations
+
+
+def applied_versions(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version text PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute('SELECT version, applied_at FROM schema_migrations')
+    return dict(cur.fetchall())
+
+
+def _run(conn, migration, direction):
+    with open(getattr(migration, direction), encoding='utf-8') as f:
+        sql = f.read()
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        if direction == 'up':
+            cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                        (migration.version, migration.name))
+        else:
+            cur.execute('DELETE FROM schema_migrations WHERE version = %s', (migration.version,))
+    conn.commit()
+    print('%s %s_%s' % ('applied' if direction == 'up' else 'rolled back', migration.version, migration.name))
+
+
+def apply(conn, to=None):
+    """Apply every pending migration up to and including version ``to``."""
+    with conn.cursor() as cur:
+        done = applied_versions(cur)
+    conn.commit()
+    pending = [m for m in discover() if m.version not in done and (to is None or m.version <= to)]
+    for migration in pending:
+        _run(conn, migration, 'up')
+    if not pending:
+        print('Nothing to apply')
+
+
+def rollback(conn, steps=1, to=None):
+    """Roll back the newest ``steps`` applied migrations, or all of those above version ``to``."""
+    with conn.cursor() as cur:
+        done = applied_versions(cur)
+    conn.commit()
+    applied = [m for m in discover() if m.version in done]
+    if to is not None:
+        targets = [m for m in applied if m.version > to]
+    else:
+        targets = applied[len(applied) - steps:] if steps else []
+    for migration in reversed(targets):
+        _run(conn, migration, 'down')
+    if not targets:
+        print('Nothing to roll back')
+
+
+def status(conn):
+    with conn.cursor() as cur:
+        done = applied_versions(cur)
+    conn.commit()
+    known = set()
+    for migration in discover():
+        known.add(migration.version)
+        applied_at = done.get(migration.version)
+        print('%s  %-28s %s' % (migration.version, migration.name,
+                                applied_at.strftime('%Y-%m-%d %H:%M') if applied_at else 'pending'))
+    for version in sorted(set(done) - known):
+        print('%s  %-28s applied, but its files are missing' % (version, '?'))
+
+
+def _seq_scans(plan):
+    """Relations read by a Seq Scan anywhere in an EXPLAIN (FORMAT JSON) plan."""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def check(conn):
+    """EXPLAIN the hot queries; returns the number that would fall back to a sequential scan."""
+    failures = 0
+    with conn.cursor() as cur:
+        # Small tables are cheaper to scan, so the planner would pick a scan
+        # on a dev database anyway. Disabling it leaves a Seq Scan in the
+        # plan only where no index can answer the query.
+        cur.execute('SET LOCAL enable_seqscan = off')
+        for name, query, params in HOT_QUERIES:
+            cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scans = _seq_scans(plan[0]['Plan'])
+            if scans:
+                failures += 1
+                print('FAIL  %-24s sequential scan on %s' % (name, ', '.join(scans)))
+            else:
+                print('ok    %s' % name)
+    conn.rollback()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='list migrations and whether they are applied')
+    apply_parser = commands.add_parser('apply', help='apply pending migrations')
+    apply_parser.add_argument('--to', help='last version to apply')
+    rollback_parser = commands.add_parser('rollback', help='roll back applied migrations')
+    target = rollback_parser.add_mutually_exclusive_group()
+    target.add_argument('--steps', type=int, default=1, help='how many migrations to roll back (default 1)')
+    target.add_argument('--to', help='roll back every migration after this version')
+    commands.add_parser('check', help='fail if a hot query needs a sequential scan')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**dsn())
+    try:
+        if args.command == 'check':
+            return 1 if check(conn) else 0
+        # One runner at a time, e.g. when several instances deploy at once.
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_lock(hashtext(%s))', (LOCK_KEY,))
+        conn.commit()
+        if args.command == 'status':
+            status(conn)
+        elif args.command == 'apply':
+            apply(conn, args.to)
+        else:
+            rollback(conn, args.steps, args.to)
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+-- Rolling back past the base schema drops every table and its data.
+
+DROP TABLE IF EXISTS green_note_scores;
+DROP TABLE IF EXISTS green_notes;
+DROP TABLE IF EXISTS green_note_topics;
+DROP TABLE IF EXISTS tracking;
+DROP TABLE IF EXISTS food;
+DROP TABLE IF EXISTS control;
+DROP TABLE IF EXISTS unclassified_tasks;
+DROP TABLE IF EXISTS tasks;
+DROP TABLE IF EXISTS files;
+DROP TABLE IF EXISTS topics;
+DROP TABLE IF EXISTS houses;
@@ -0,0 +1,85 @@
+-- The tables app.py was written against, as they stood before 001. Every
+-- statement is IF NOT EXISTS, so on an existing database this is a no-op
+-- and only a fresh one is created from it. Keys, indexes and foreign keys
+-- for the query paths are added by 006.
+--
+-- Dates are stored as 'YYYY-MM-DD' text: the client sends and compares
+-- them as strings.
+
+CREATE TABLE IF NOT EXISTS houses (
+    name text PRIMARY KEY
+);
+INSERT INTO houses (name) VALUES ('כללי') ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS topics (
+    id serial PRIMARY KEY,
+    name text NOT NULL,
+    color bigint,
+    house text NOT NULL,
+    "order" integer NOT NULL DEFAULT 0,
+    flat boolean NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    topic_id integer NOT NULL,
+    section text NOT NULL,
+    name text NOT NULL,
+    linked boolean NOT NULL DEFAULT FALSE,
+    content text NOT NULL DEFAULT '[]'
+);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    topic_id integer NOT NULL,
+    file_name text NOT NULL,
+    section text NOT NULL,
+    "order" integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS unclassified_tasks (
+    "order" integer NOT NULL DEFAULT 0,
+    content text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS control (
+    name_file text NOT NULL,
+    topic_id integer NOT NULL,
+    is_plan boolean NOT NULL,
+    order_index integer NOT NULL DEFAULT 0,
+    modification_alert boolean NOT NULL DEFAULT FALSE
+);
+
+-- No key: rows were told apart by (date, name) only; 008 adds an id.
+CREATE TABLE IF NOT EXISTS food (
+    date text NOT NULL,
+    name text NOT NULL,
+    calories integer NOT NULL DEFAULT 0,
+    protein integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS tracking (
+    name text NOT NULL,
+    time text,
+    amount integer NOT NULL DEFAULT 1,
+    done integer NOT NULL DEFAULT 0,
+    content text
+);
+
+CREATE TABLE IF NOT EXISTS green_note_topics (
+    name text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS green_notes (
+    id serial PRIMARY KEY,
+    signature text NOT NULL,
+    date text NOT NULL,
+    good_1 text,
+    good_2 text,
+    good_3 text,
+    improve text
+);
+
+CREATE TABLE IF NOT EXISTS green_note_scores (
+    note_id integer NOT NULL,
+    category text NOT NULL,
+    score integer NOT NULL
+);
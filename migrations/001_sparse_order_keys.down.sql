@@ -0,0 +1,35 @@
+-- Back to dense 0-based integer positions.
+
+DROP INDEX IF EXISTS topics_house_order_idx;
+DROP INDEX IF EXISTS tasks_section_order_idx;
+DROP INDEX IF EXISTS unclassified_tasks_order_idx;
+DROP INDEX IF EXISTS control_is_plan_order_idx;
+
+UPDATE topics AS t SET "order" = r.rn - 1
+FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY house ORDER BY "order", id) AS rn FROM topics) AS r
+WHERE t.id = r.id;
+
+UPDATE tasks AS t SET "order" = r.rn - 1
+FROM (
+    SELECT topic_id, file_name,
+           ROW_NUMBER() OVER (PARTITION BY section ORDER BY "order", topic_id, file_name) AS rn
+    FROM tasks
+) AS r
+WHERE t.topic_id = r.topic_id AND t.file_name = r.file_name;
+
+UPDATE unclassified_tasks AS t SET "order" = r.rn - 1
+FROM (SELECT content, ROW_NUMBER() OVER (ORDER BY "order", content) AS rn FROM unclassified_tasks) AS r
+WHERE t.content = r.content;
+
+UPDATE control AS t SET order_index = r.rn - 1
+FROM (
+    SELECT topic_id, name_file,
+           ROW_NUMBER() OVER (PARTITION BY is_plan ORDER BY order_index, topic_id, name_file) AS rn
+    FROM control
+) AS r
+WHERE t.topic_id = r.topic_id AND t.name_file = r.name_file;
+
+ALTER TABLE topics ALTER COLUMN "order" TYPE integer;
+ALTER TABLE tasks ALTER COLUMN "order" TYPE integer;
+ALTER TABLE unclassified_tasks ALTER COLUMN "order" TYPE integer;
+ALTER TABLE control ALTER COLUMN order_index TYPE integer;
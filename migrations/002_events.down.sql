@@ -0,0 +1,2 @@
+DROP TABLE IF EXISTS window_state;
+DROP TABLE IF EXISTS app_events;
@@ -0,0 +1,16 @@
+-- Shared event log behind /events (see events.py) and the window hand-off
+-- state that used to live in per-process globals.
+
+CREATE TABLE IF NOT EXISTS app_events (
+    id bigserial PRIMARY KEY,
+    kind text NOT NULL,
+    payload jsonb NOT NULL DEFAULT '{}',
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS app_events_created_at_idx ON app_events (created_at);
+
+CREATE TABLE IF NOT EXISTS window_state (
+    id integer PRIMARY KEY CHECK (id = 1),
+    args jsonb NOT NULL DEFAULT '{}',
+    open boolean NOT NULL DEFAULT FALSE
+);
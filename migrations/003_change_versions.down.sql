@@ -0,0 +1,18 @@
+DO $$
+DECLARE
+    tbl text;
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY['houses', 'topics', 'files', 'tasks', 'unclassified_tasks', 'control', 'tracking']
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_touch ON %I', tbl);
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_tombstone ON %I', tbl);
+        EXECUTE format('ALTER TABLE %I DROP COLUMN IF EXISTS version', tbl);
+    END LOOP;
+END
+$$;
+
+DROP FUNCTION IF EXISTS sync_tombstone();
+DROP FUNCTION IF EXISTS sync_touch();
+DROP FUNCTION IF EXISTS sync_row_key(jsonb, text[]);
+DROP TABLE IF EXISTS sync_horizon;
+DROP TABLE IF EXISTS sync_tombstones;
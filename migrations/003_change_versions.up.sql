@@ -0,0 +1,73 @@
+-- Per-row change versions and delete tombstones behind GET /sync (see sync.py).
+--
+-- A row's version is the id of the transaction that last wrote it. Every
+-- transaction below txid_snapshot_xmin(txid_current_snapshot()) has
+-- finished, so that value is a safe cursor: nothing with a smaller version
+-- can still appear later.
+
+CREATE TABLE IF NOT EXISTS sync_tombstones (
+    table_name text NOT NULL,
+    row_key jsonb NOT NULL,
+    version bigint NOT NULL DEFAULT txid_current(),
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS sync_tombstones_version_idx ON sync_tombstones (version);
+
+-- Oldest cursor that can still be served incrementally; raised when
+-- tombstones are purged.
+CREATE TABLE IF NOT EXISTS sync_horizon (
+    id integer PRIMARY KEY CHECK (id = 1),
+    version bigint NOT NULL
+);
+INSERT INTO sync_horizon (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION sync_row_key(rec jsonb, keys text[]) RETURNS jsonb AS $$
+    SELECT jsonb_object_agg(k, rec -> k) FROM unnest(keys) AS k
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Trigger arguments (TG_ARGV) name the table's key columns.
+CREATE OR REPLACE FUNCTION sync_touch() RETURNS trigger AS $$
+BEGIN
+    NEW.version := txid_current();
+    IF sync_row_key(to_jsonb(OLD), TG_ARGV) IS DISTINCT FROM sync_row_key(to_jsonb(NEW), TG_ARGV) THEN
+        -- A key change makes the old key disappear for the client.
+        INSERT INTO sync_tombstones (table_name, row_key)
+        VALUES (TG_TABLE_NAME, sync_row_key(to_jsonb(OLD), TG_ARGV));
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sync_tombstones (table_name, row_key)
+    VALUES (TG_TABLE_NAME, sync_row_key(to_jsonb(OLD), TG_ARGV));
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t record;
+    args text;
+BEGIN
+    FOR t IN SELECT * FROM (VALUES
+        ('houses', ARRAY['name']),
+        ('topics', ARRAY['id']),
+        ('files', ARRAY['topic_id', 'name']),
+        ('tasks', ARRAY['topic_id', 'file_name']),
+        ('unclassified_tasks', ARRAY['content']),
+        ('control', ARRAY['topic_id', 'name_file']),
+        ('tracking', ARRAY['name'])
+    ) AS v (tbl, keys)
+    LOOP
+        SELECT string_agg(quote_literal(k), ', ') INTO args FROM unnest(t.keys) AS k;
+        EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT txid_current()', t.tbl);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (version)', t.tbl || '_version_idx', t.tbl);
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_touch ON %I', t.tbl);
+        EXECUTE format('CREATE TRIGGER sync_touch BEFORE UPDATE ON %I FOR EACH ROW EXECUTE PROCEDURE sync_touch(%s)', t.tbl, args);
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_tombstone ON %I', t.tbl);
+        EXECUTE format('CREATE TRIGGER sync_tombstone AFTER DELETE ON %I FOR EACH ROW EXECUTE PROCEDURE sync_tombstone(%s)', t.tbl, args);
+    END LOOP;
+END
+$$;
@@ -0,0 +1,2 @@
+DROP FUNCTION IF EXISTS files_apply_patch(jsonb, jsonb);
+ALTER TABLE files DROP COLUMN IF EXISTS revision;
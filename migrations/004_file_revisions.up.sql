@@ -0,0 +1,54 @@
+-- Revision numbers and server-side patching for files.content
+-- (POST /file_content/patch).
+
+ALTER TABLE files ALTER COLUMN content TYPE jsonb USING content::jsonb;
+ALTER TABLE files ADD COLUMN IF NOT EXISTS revision integer NOT NULL DEFAULT 0;
+
+-- Applies a list of block-level operations to a content list:
+--   {"op": "replace", "index": i, "value": block}
+--   {"op": "set", "index": i, "path": ["text"], "value": v}   one field of a block
+--   {"op": "insert", "index": i, "value": block}             index omitted: append
+--   {"op": "remove", "index": i}
+--   {"op": "move", "from": i, "to": j}
+-- Raises invalid_parameter_value (22023) on an unknown op or a bad index.
+CREATE OR REPLACE FUNCTION files_apply_patch(doc jsonb, ops jsonb) RETURNS jsonb AS $$
+DECLARE
+    op jsonb;
+    item jsonb;
+    idx integer;
+BEGIN
+    FOR op IN SELECT value FROM jsonb_array_elements(ops) LOOP
+        idx := COALESCE(op->>'index', op->>'from')::integer;
+        IF op->>'op' IN ('replace', 'set', 'remove', 'move')
+                AND (idx IS NULL OR idx < 0 OR idx >= jsonb_array_length(doc)) THEN
+            RAISE EXCEPTION 'patch index % out of range', idx USING ERRCODE = '22023';
+        END IF;
+
+        CASE op->>'op'
+        WHEN 'replace' THEN
+            doc := jsonb_set(doc, ARRAY[idx::text], op->'value');
+        WHEN 'set' THEN
+            doc := jsonb_set(doc, ARRAY[idx::text] || ARRAY(SELECT jsonb_array_elements_text(op->'path')), op->'value');
+        WHEN 'insert' THEN
+            IF idx IS NOT NULL AND idx < jsonb_array_length(doc) THEN
+                doc := jsonb_insert(doc, ARRAY[GREATEST(idx, 0)::text], op->'value');
+            ELSE
+                doc := doc || jsonb_build_array(op->'value');
+            END IF;
+        WHEN 'remove' THEN
+            doc := doc - idx;
+        WHEN 'move' THEN
+            item := doc -> idx;
+            doc := doc - idx;
+            IF (op->>'to')::integer < jsonb_array_length(doc) THEN
+                doc := jsonb_insert(doc, ARRAY[GREATEST((op->>'to')::integer, 0)::text], item);
+            ELSE
+                doc := doc || jsonb_build_array(item);
+            END IF;
+        ELSE
+            RAISE EXCEPTION 'unknown patch op %', op->>'op' USING ERRCODE = '22023';
+        END CASE;
+    END LOOP;
+    RETURN doc;
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
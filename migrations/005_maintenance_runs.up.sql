@@ -0,0 +1,7 @@
+-- Last run date of once-a-day maintenance (e.g. the tracking reset), shared
+-- by every worker so each task runs once per day per deployment.
+
+CREATE TABLE IF NOT EXISTS maintenance_runs (
+    name text PRIMARY KEY,
+    last_run date NOT NULL
+);
@@ -0,0 +1,16 @@
+DROP INDEX IF EXISTS files_linked_idx;
+DROP INDEX IF EXISTS green_notes_date_idx;
+DROP INDEX IF EXISTS green_note_scores_note_id_idx;
+DROP INDEX IF EXISTS food_date_idx;
+
+ALTER TABLE green_note_scores DROP CONSTRAINT IF EXISTS green_note_scores_note_id_fkey;
+ALTER TABLE control DROP CONSTRAINT IF EXISTS control_file_fkey;
+ALTER TABLE tasks DROP CONSTRAINT IF EXISTS tasks_file_fkey;
+ALTER TABLE files DROP CONSTRAINT IF EXISTS files_topic_id_fkey;
+ALTER TABLE topics DROP CONSTRAINT IF EXISTS topics_house_fkey;
+
+ALTER TABLE green_notes DROP CONSTRAINT IF EXISTS green_notes_signature_key;
+ALTER TABLE control DROP CONSTRAINT IF EXISTS control_topic_id_name_file_key;
+ALTER TABLE tasks DROP CONSTRAINT IF EXISTS tasks_topic_id_file_name_key;
+ALTER TABLE files DROP CONSTRAINT IF EXISTS files_topic_id_name_key;
+ALTER TABLE houses DROP CONSTRAINT IF EXISTS houses_name_key;
@@ -0,0 +1,74 @@
+-- Keys, indexes and foreign keys for the lookups app.py runs on every
+-- request (checked by `python migrate.py check`).
+--
+-- Unique keys are only added where no primary key or unique constraint on
+-- the same columns exists yet. This fails if the table already holds
+-- duplicates; remove them and run the migration again.
+--
+-- Foreign keys are added NOT VALID: new writes are checked straight away,
+-- but existing orphan rows do not block the migration. They are validated
+-- once the orphans have been purged.
+
+DO $$
+DECLARE
+    k record;
+BEGIN
+    FOR k IN SELECT * FROM (VALUES
+        ('houses', 'houses_name_key', ARRAY['name']),
+        ('files', 'files_topic_id_name_key', ARRAY['topic_id', 'name']),
+        ('tasks', 'tasks_topic_id_file_name_key', ARRAY['topic_id', 'file_name']),
+        ('control', 'control_topic_id_name_file_key', ARRAY['topic_id', 'name_file']),
+        ('green_notes', 'green_notes_signature_key', ARRAY['signature'])
+    ) AS v (tbl, conname, cols)
+    LOOP
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint c
+            WHERE c.conrelid = k.tbl::regclass AND c.contype IN ('p', 'u')
+              AND c.conkey = (
+                  SELECT array_agg(a.attnum ORDER BY col.ord)
+                  FROM unnest(k.cols) WITH ORDINALITY AS col (name, ord)
+                  JOIN pg_attribute a ON a.attrelid = k.tbl::regclass AND a.attname = col.name
+              )
+        ) THEN
+            EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I UNIQUE (%s)', k.tbl, k.conname,
+                           (SELECT string_agg(quote_ident(c), ', ') FROM unnest(k.cols) AS c));
+        END IF;
+    END LOOP;
+END
+$$;
+
+-- delete_house moves topics here, so it must exist for topics.house to reference.
+INSERT INTO houses (name) VALUES ('כללי') ON CONFLICT DO NOTHING;
+
+DO $$
+DECLARE
+    f record;
+BEGIN
+    FOR f IN SELECT * FROM (VALUES
+        ('topics', 'topics_house_fkey',
+         'FOREIGN KEY (house) REFERENCES houses (name) ON UPDATE CASCADE ON DELETE CASCADE'),
+        ('files', 'files_topic_id_fkey',
+         'FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE'),
+        ('tasks', 'tasks_file_fkey',
+         'FOREIGN KEY (topic_id, file_name) REFERENCES files (topic_id, name) ON UPDATE CASCADE ON DELETE CASCADE'),
+        ('control', 'control_file_fkey',
+         'FOREIGN KEY (topic_id, name_file) REFERENCES files (topic_id, name) ON UPDATE CASCADE ON DELETE CASCADE'),
+        ('green_note_scores', 'green_note_scores_note_id_fkey',
+         'FOREIGN KEY (note_id) REFERENCES green_notes (id) ON DELETE CASCADE')
+    ) AS v (tbl, conname, def)
+    LOOP
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = f.tbl::regclass AND conname = f.conname) THEN
+            EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s NOT VALID', f.tbl, f.conname, f.def);
+        END IF;
+    END LOOP;
+END
+$$;
+
+-- The unique keys above serve files(topic_id, name), tasks(topic_id, file_name),
+-- control(topic_id, name_file) and green_notes(signature); 001's
+-- topics_house_order_idx and tasks_section_order_idx serve topics(house, "order")
+-- and tasks(section). The rest:
+CREATE INDEX IF NOT EXISTS food_date_idx ON food (date);
+CREATE INDEX IF NOT EXISTS green_note_scores_note_id_idx ON green_note_scores (note_id);
+CREATE INDEX IF NOT EXISTS green_notes_date_idx ON green_notes (date, signature);
+CREATE INDEX IF NOT EXISTS files_linked_idx ON files (topic_id) WHERE linked;
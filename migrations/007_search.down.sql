@@ -0,0 +1,8 @@
+DROP TRIGGER IF EXISTS search_sync ON files;
+DROP TRIGGER IF EXISTS search_sync ON topics;
+DROP TRIGGER IF EXISTS search_sync ON unclassified_tasks;
+DROP TRIGGER IF EXISTS search_sync ON green_notes;
+DROP FUNCTION IF EXISTS search_sync();
+DROP FUNCTION IF EXISTS search_row(text, jsonb);
+DROP FUNCTION IF EXISTS search_content_text(jsonb);
+DROP TABLE IF EXISTS search_index;
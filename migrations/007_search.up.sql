@@ -0,0 +1,105 @@
+-- Full-text search behind GET /search (see search.py).
+--
+-- search_index holds one document per file, topic, unclassified task and
+-- green note, kept current by triggers on those tables. Words are matched
+-- through the tsvector with the 'simple' configuration (Postgres has no
+-- Hebrew stemmer); the trigram indexes answer substring matches, which
+-- Hebrew needs for words carrying attached prefixes (ו, ה, ב, ...).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE IF NOT EXISTS search_index (
+    kind text NOT NULL,
+    key jsonb NOT NULL,
+    meta jsonb NOT NULL DEFAULT '{}',
+    title text NOT NULL DEFAULT '',
+    body text NOT NULL DEFAULT '',
+    tsv tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', body), 'B')
+    ) STORED,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS search_index_tsv_idx ON search_index USING gin (tsv);
+CREATE INDEX IF NOT EXISTS search_index_title_trgm_idx ON search_index USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS search_index_body_trgm_idx ON search_index USING gin (body gin_trgm_ops);
+
+-- Plain text of a files.content list: the "text" of each block.
+CREATE OR REPLACE FUNCTION search_content_text(content jsonb) RETURNS text AS $$
+    SELECT COALESCE(string_agg(
+        CASE jsonb_typeof(block) WHEN 'object' THEN block ->> 'text' WHEN 'string' THEN block #>> '{}' END,
+        E'\n'), '')
+    FROM jsonb_array_elements(CASE jsonb_typeof(content) WHEN 'array' THEN content ELSE '[]' END) AS block
+$$ LANGUAGE sql IMMUTABLE;
+
+-- The search document for a row of one of the indexed tables.
+CREATE OR REPLACE FUNCTION search_row(tbl text, rec jsonb)
+RETURNS TABLE (kind text, key jsonb, meta jsonb, title text, body text) AS $$
+    SELECT 'file', jsonb_build_object('topic_id', rec -> 'topic_id', 'name', rec -> 'name'),
+           jsonb_build_object('section', rec -> 'section'),
+           COALESCE(rec ->> 'name', ''), search_content_text(rec -> 'content')
+    WHERE tbl = 'files'
+    UNION ALL
+    SELECT 'topic', jsonb_build_object('id', rec -> 'id'),
+           jsonb_build_object('house', rec -> 'house', 'color', rec -> 'color'),
+           COALESCE(rec ->> 'name', ''), ''
+    WHERE tbl = 'topics'
+    UNION ALL
+    SELECT 'unclassified_task', jsonb_build_object('content', rec -> 'content'), '{}',
+           '', COALESCE(rec ->> 'content', '')
+    WHERE tbl = 'unclassified_tasks'
+    UNION ALL
+    SELECT 'green_note', jsonb_build_object('signature', rec -> 'signature'),
+           jsonb_build_object('date', rec -> 'date'),
+           COALESCE(rec ->> 'date', ''),
+           concat_ws(E'\n', rec ->> 'good_1', rec ->> 'good_2', rec ->> 'good_3', rec ->> 'improve')
+    WHERE tbl = 'green_notes'
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION search_sync() RETURNS trigger AS $$
+DECLARE
+    old_doc record;
+    new_key jsonb;
+BEGIN
+    IF TG_OP <> 'DELETE' THEN
+        SELECT s.key INTO new_key FROM search_row(TG_TABLE_NAME, to_jsonb(NEW)) AS s;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        SELECT s.kind, s.key INTO old_doc FROM search_row(TG_TABLE_NAME, to_jsonb(OLD)) AS s;
+        IF old_doc.key IS DISTINCT FROM new_key THEN
+            DELETE FROM search_index WHERE kind = old_doc.kind AND key = old_doc.key;
+        END IF;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO search_index (kind, key, meta, title, body)
+        SELECT * FROM search_row(TG_TABLE_NAME, to_jsonb(NEW))
+        ON CONFLICT (kind, key) DO UPDATE
+        SET meta = EXCLUDED.meta, title = EXCLUDED.title, body = EXCLUDED.body;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Only the columns that feed a document fire the trigger, so reorders,
+-- link toggles and the like do not rewrite the index.
+DO $$
+DECLARE
+    t record;
+BEGIN
+    FOR t IN SELECT * FROM (VALUES
+        ('files', 'topic_id, section, name, content'),
+        ('topics', 'name, house, color'),
+        ('unclassified_tasks', 'content'),
+        ('green_notes', 'signature, date, good_1, good_2, good_3, improve')
+    ) AS v (tbl, cols)
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS search_sync ON %I', t.tbl);
+        EXECUTE format('CREATE TRIGGER search_sync AFTER INSERT OR DELETE OR UPDATE OF %s ON %I '
+                       'FOR EACH ROW EXECUTE PROCEDURE search_sync()', t.cols, t.tbl);
+        EXECUTE format('INSERT INTO search_index (kind, key, meta, title, body) '
+                       'SELECT s.* FROM %I AS r, search_row(%L, to_jsonb(r)) AS s '
+                       'ON CONFLICT (kind, key) DO UPDATE '
+                       'SET meta = EXCLUDED.meta, title = EXCLUDED.title, body = EXCLUDED.body',
+                       t.tbl, t.tbl);
+    END LOOP;
+END
+$$;
@@ -0,0 +1,6 @@
+CREATE INDEX IF NOT EXISTS unclassified_tasks_order_idx ON unclassified_tasks ("order");
+DROP INDEX IF EXISTS unclassified_tasks_order_content_idx;
+
+CREATE INDEX IF NOT EXISTS food_date_idx ON food (date);
+DROP INDEX IF EXISTS food_date_id_idx;
+ALTER TABLE food DROP COLUMN IF EXISTS id;
@@ -0,0 +1,10 @@
+-- Keys for the keyset-paginated lists (see pagination.py). food rows had
+-- no unique key, so they get an id; the other lists page on the unique
+-- keys added in 006.
+
+ALTER TABLE food ADD COLUMN IF NOT EXISTS id serial;
+CREATE UNIQUE INDEX IF NOT EXISTS food_date_id_idx ON food (date, id);
+DROP INDEX IF EXISTS food_date_idx;
+
+CREATE INDEX IF NOT EXISTS unclassified_tasks_order_content_idx ON unclassified_tasks ("order", content);
+DROP INDEX IF EXISTS unclassified_tasks_order_idx;
@@ -0,0 +1,11 @@
+DROP TRIGGER IF EXISTS analytics_tracking ON tracking;
+DROP TRIGGER IF EXISTS analytics_green_notes ON green_note_scores;
+DROP TRIGGER IF EXISTS analytics_green_notes ON green_notes;
+DROP TRIGGER IF EXISTS analytics_food ON food;
+DROP FUNCTION IF EXISTS analytics_tracking();
+DROP FUNCTION IF EXISTS analytics_green_notes();
+DROP FUNCTION IF EXISTS analytics_refresh_green_day(text);
+DROP FUNCTION IF EXISTS analytics_food();
+DROP TABLE IF EXISTS tracking_days;
+DROP TABLE IF EXISTS green_note_day_scores;
+DROP TABLE IF EXISTS food_daily;
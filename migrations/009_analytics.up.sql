@@ -0,0 +1,122 @@
+-- Summary tables behind GET /analytics (see analytics.py), kept current by
+-- triggers so every writer (add_food, delete_food, save_green_note,
+-- update_tracking_done, the write-behind buffer) updates them in the same
+-- transaction.
+
+-- Calories and protein per day.
+CREATE TABLE IF NOT EXISTS food_daily (
+    date text PRIMARY KEY,
+    calories bigint NOT NULL DEFAULT 0,
+    protein bigint NOT NULL DEFAULT 0,
+    items integer NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION analytics_food() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE food_daily
+        SET calories = calories - COALESCE(OLD.calories, 0), protein = protein - COALESCE(OLD.protein, 0),
+            items = items - 1
+        WHERE date = OLD.date;
+        DELETE FROM food_daily WHERE date = OLD.date AND items <= 0;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO food_daily (date, calories, protein, items)
+        VALUES (NEW.date, COALESCE(NEW.calories, 0), COALESCE(NEW.protein, 0), 1)
+        ON CONFLICT (date) DO UPDATE
+        SET calories = food_daily.calories + EXCLUDED.calories, protein = food_daily.protein + EXCLUDED.protein,
+            items = food_daily.items + 1;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS analytics_food ON food;
+CREATE TRIGGER analytics_food AFTER INSERT OR DELETE OR UPDATE OF date, calories, protein ON food
+FOR EACH ROW EXECUTE PROCEDURE analytics_food();
+
+TRUNCATE food_daily;
+INSERT INTO food_daily (date, calories, protein, items)
+SELECT date, COALESCE(SUM(calories), 0), COALESCE(SUM(protein), 0), COUNT(*) FROM food GROUP BY date;
+
+-- Scores of each day's latest green note version (the most recently
+-- created one), averaged per category.
+CREATE TABLE IF NOT EXISTS green_note_day_scores (
+    date text NOT NULL,
+    category text NOT NULL,
+    score double precision NOT NULL,
+    PRIMARY KEY (date, category)
+);
+
+CREATE OR REPLACE FUNCTION analytics_refresh_green_day(day text) RETURNS void AS $$
+    DELETE FROM green_note_day_scores WHERE date = day;
+    INSERT INTO green_note_day_scores (date, category, score)
+    SELECT day, s.category, AVG(s.score)
+    FROM green_note_scores s
+    WHERE s.note_id = (SELECT id FROM green_notes WHERE date = day ORDER BY id DESC LIMIT 1)
+    GROUP BY s.category;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION analytics_green_notes() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'green_notes' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM analytics_refresh_green_day(OLD.date);
+        END IF;
+        IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.date IS DISTINCT FROM OLD.date) THEN
+            PERFORM analytics_refresh_green_day(NEW.date);
+        END IF;
+    ELSE
+        -- Scores of a deleted note are handled by the green_notes trigger.
+        PERFORM analytics_refresh_green_day(n.date)
+        FROM green_notes n
+        WHERE n.id = CASE WHEN TG_OP = 'DELETE' THEN OLD.note_id ELSE NEW.note_id END;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS analytics_green_notes ON green_notes;
+CREATE TRIGGER analytics_green_notes AFTER INSERT OR DELETE OR UPDATE OF date ON green_notes
+FOR EACH ROW EXECUTE PROCEDURE analytics_green_notes();
+DROP TRIGGER IF EXISTS analytics_green_notes ON green_note_scores;
+CREATE TRIGGER analytics_green_notes AFTER INSERT OR DELETE OR UPDATE ON green_note_scores
+FOR EACH ROW EXECUTE PROCEDURE analytics_green_notes();
+
+TRUNCATE green_note_day_scores;
+SELECT analytics_refresh_green_day(date) FROM (SELECT DISTINCT date FROM green_notes) AS d;
+
+-- tracking only holds today's count; this keeps one row per item and day.
+CREATE TABLE IF NOT EXISTS tracking_days (
+    name text NOT NULL,
+    date text NOT NULL,
+    done integer NOT NULL,
+    amount integer NOT NULL,
+    PRIMARY KEY (name, date)
+);
+
+CREATE OR REPLACE FUNCTION analytics_tracking() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM tracking_days WHERE name = OLD.name;
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.name IS DISTINCT FROM OLD.name THEN
+        UPDATE tracking_days SET name = NEW.name WHERE name = OLD.name;
+    END IF;
+    IF NEW.time IS NOT NULL THEN
+        INSERT INTO tracking_days (name, date, done, amount)
+        VALUES (NEW.name, NEW.time, COALESCE(NEW.done, 0), COALESCE(NEW.amount, 0))
+        ON CONFLICT (name, date) DO UPDATE SET done = EXCLUDED.done, amount = EXCLUDED.amount;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS analytics_tracking ON tracking;
+CREATE TRIGGER analytics_tracking AFTER INSERT OR DELETE OR UPDATE OF name, time, done, amount ON tracking
+FOR EACH ROW EXECUTE PROCEDURE analytics_tracking();
+
+INSERT INTO tracking_days (name, date, done, amount)
+SELECT name, time, COALESCE(done, 0), COALESCE(amount, 0) FROM tracking WHERE time IS NOT NULL
+ON CONFLICT (name, date) DO UPDATE SET done = EXCLUDED.done, amount = EXCLUDED.amount;
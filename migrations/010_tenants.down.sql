@@ -0,0 +1,206 @@
+-- Back to one global data set. Only possible once a single tenant's rows
+-- remain (delete the others with `python tenants.py delete ID`): the
+-- restored single-column keys would otherwise see duplicates.
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'houses', 'topics', 'files', 'tasks', 'unclassified_tasks', 'control', 'food', 'tracking',
+        'green_note_topics', 'green_notes', 'green_note_scores', 'window_state', 'maintenance_runs',
+        'search_index', 'food_daily', 'green_note_day_scores', 'tracking_days', 'sync_tombstones'
+    ]
+    LOOP
+        EXECUTE format('DROP POLICY IF EXISTS tenant_isolation ON %I', t);
+        EXECUTE format('ALTER TABLE %I NO FORCE ROW LEVEL SECURITY', t);
+        EXECUTE format('ALTER TABLE %I DISABLE ROW LEVEL SECURITY', t);
+    END LOOP;
+END
+$$;
+
+-- ---------- triggers (as of 003, 007 and 009) ----------
+
+CREATE OR REPLACE FUNCTION sync_touch() RETURNS trigger AS $$
+BEGIN
+    NEW.version := txid_current();
+    IF sync_row_key(to_jsonb(OLD), TG_ARGV) IS DISTINCT FROM sync_row_key(to_jsonb(NEW), TG_ARGV) THEN
+        -- A key change makes the old key disappear for the client.
+        INSERT INTO sync_tombstones (table_name, row_key)
+        VALUES (TG_TABLE_NAME, sync_row_key(to_jsonb(OLD), TG_ARGV));
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sync_tombstones (table_name, row_key)
+    VALUES (TG_TABLE_NAME, sync_row_key(to_jsonb(OLD), TG_ARGV));
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION search_sync() RETURNS trigger AS $$
+DECLARE
+    old_doc record;
+    new_key jsonb;
+BEGIN
+    IF TG_OP <> 'DELETE' THEN
+        SELECT s.key INTO new_key FROM search_row(TG_TABLE_NAME, to_jsonb(NEW)) AS s;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        SELECT s.kind, s.key INTO old_doc FROM search_row(TG_TABLE_NAME, to_jsonb(OLD)) AS s;
+        IF old_doc.key IS DISTINCT FROM new_key THEN
+            DELETE FROM search_index WHERE kind = old_doc.kind AND key = old_doc.key;
+        END IF;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO search_index (kind, key, meta, title, body)
+        SELECT * FROM search_row(TG_TABLE_NAME, to_jsonb(NEW))
+        ON CONFLICT (kind, key) DO UPDATE
+        SET meta = EXCLUDED.meta, title = EXCLUDED.title, body = EXCLUDED.body;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION analytics_food() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE food_daily
+        SET calories = calories - COALESCE(OLD.calories, 0), protein = protein - COALESCE(OLD.protein, 0),
+            items = items - 1
+        WHERE date = OLD.date;
+        DELETE FROM food_daily WHERE date = OLD.date AND items <= 0;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO food_daily (date, calories, protein, items)
+        VALUES (NEW.date, COALESCE(NEW.calories, 0), COALESCE(NEW.protein, 0), 1)
+        ON CONFLICT (date) DO UPDATE
+        SET calories = food_daily.calories + EXCLUDED.calories, protein = food_daily.protein + EXCLUDED.protein,
+            items = food_daily.items + 1;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION analytics_refresh_green_day(day text) RETURNS void AS $$
+    DELETE FROM green_note_day_scores WHERE date = day;
+    INSERT INTO green_note_day_scores (date, category, score)
+    SELECT day, s.category, AVG(s.score)
+    FROM green_note_scores s
+    WHERE s.note_id = (SELECT id FROM green_notes WHERE date = day ORDER BY id DESC LIMIT 1)
+    GROUP BY s.category;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION analytics_green_notes() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'green_notes' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM analytics_refresh_green_day(OLD.date);
+        END IF;
+        IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.date IS DISTINCT FROM OLD.date) THEN
+            PERFORM analytics_refresh_green_day(NEW.date);
+        END IF;
+    ELSE
+        -- Scores of a deleted note are handled by the green_notes trigger.
+        PERFORM analytics_refresh_green_day(n.date)
+        FROM green_notes n
+        WHERE n.id = CASE WHEN TG_OP = 'DELETE' THEN OLD.note_id ELSE NEW.note_id END;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS analytics_refresh_green_day(integer, text);
+
+CREATE OR REPLACE FUNCTION analytics_tracking() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM tracking_days WHERE name = OLD.name;
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.name IS DISTINCT FROM OLD.name THEN
+        UPDATE tracking_days SET name = NEW.name WHERE name = OLD.name;
+    END IF;
+    IF NEW.time IS NOT NULL THEN
+        INSERT INTO tracking_days (name, date, done, amount)
+        VALUES (NEW.name, NEW.time, COALESCE(NEW.done, 0), COALESCE(NEW.amount, 0))
+        ON CONFLICT (name, date) DO UPDATE SET done = EXCLUDED.done, amount = EXCLUDED.amount;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- ---------- keys and indexes ----------
+-- Dropping the columns drops every key, foreign key and index that leads
+-- on them; the single-tenant ones are put back.
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'houses', 'topics', 'files', 'tasks', 'unclassified_tasks', 'control', 'food', 'tracking',
+        'green_note_topics', 'green_notes', 'green_note_scores', 'window_state', 'maintenance_runs',
+        'search_index', 'food_daily', 'green_note_day_scores', 'tracking_days', 'sync_tombstones', 'app_events'
+    ]
+    LOOP
+        EXECUTE format('ALTER TABLE %I DROP COLUMN IF EXISTS tenant_id CASCADE', t);
+    END LOOP;
+END
+$$;
+
+ALTER TABLE houses ADD CONSTRAINT houses_pkey PRIMARY KEY (name);
+ALTER TABLE files ADD CONSTRAINT files_topic_id_name_key UNIQUE (topic_id, name);
+ALTER TABLE tasks ADD CONSTRAINT tasks_topic_id_file_name_key UNIQUE (topic_id, file_name);
+ALTER TABLE control ADD CONSTRAINT control_topic_id_name_file_key UNIQUE (topic_id, name_file);
+ALTER TABLE green_notes ADD CONSTRAINT green_notes_signature_key UNIQUE (signature);
+ALTER TABLE window_state ADD CONSTRAINT window_state_pkey PRIMARY KEY (id);
+ALTER TABLE maintenance_runs ADD CONSTRAINT maintenance_runs_pkey PRIMARY KEY (name);
+ALTER TABLE search_index ADD CONSTRAINT search_index_pkey PRIMARY KEY (kind, key);
+ALTER TABLE food_daily ADD CONSTRAINT food_daily_pkey PRIMARY KEY (date);
+ALTER TABLE green_note_day_scores ADD CONSTRAINT green_note_day_scores_pkey PRIMARY KEY (date, category);
+ALTER TABLE tracking_days ADD CONSTRAINT tracking_days_pkey PRIMARY KEY (name, date);
+
+ALTER TABLE topics ADD CONSTRAINT topics_house_fkey
+    FOREIGN KEY (house) REFERENCES houses (name) ON UPDATE CASCADE ON DELETE CASCADE NOT VALID;
+ALTER TABLE files ADD CONSTRAINT files_topic_id_fkey
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE NOT VALID;
+ALTER TABLE tasks ADD CONSTRAINT tasks_file_fkey
+    FOREIGN KEY (topic_id, file_name) REFERENCES files (topic_id, name) ON UPDATE CASCADE ON DELETE CASCADE NOT VALID;
+ALTER TABLE control ADD CONSTRAINT control_file_fkey
+    FOREIGN KEY (topic_id, name_file) REFERENCES files (topic_id, name) ON UPDATE CASCADE ON DELETE CASCADE NOT VALID;
+ALTER TABLE green_note_scores ADD CONSTRAINT green_note_scores_note_id_fkey
+    FOREIGN KEY (note_id) REFERENCES green_notes (id) ON DELETE CASCADE NOT VALID;
+
+CREATE INDEX IF NOT EXISTS topics_house_order_idx ON topics (house, "order");
+CREATE INDEX IF NOT EXISTS tasks_section_order_idx ON tasks (section, "order");
+CREATE INDEX IF NOT EXISTS unclassified_tasks_order_content_idx ON unclassified_tasks ("order", content);
+CREATE INDEX IF NOT EXISTS control_is_plan_order_idx ON control (is_plan, order_index);
+CREATE UNIQUE INDEX IF NOT EXISTS food_date_id_idx ON food (date, id);
+CREATE INDEX IF NOT EXISTS green_notes_date_idx ON green_notes (date, signature);
+CREATE INDEX IF NOT EXISTS green_note_scores_note_id_idx ON green_note_scores (note_id);
+CREATE INDEX IF NOT EXISTS files_linked_idx ON files (topic_id) WHERE linked;
+CREATE INDEX IF NOT EXISTS search_index_tsv_idx ON search_index USING gin (tsv);
+CREATE INDEX IF NOT EXISTS search_index_title_trgm_idx ON search_index USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS search_index_body_trgm_idx ON search_index USING gin (body gin_trgm_ops);
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'houses', 'topics', 'files', 'tasks', 'unclassified_tasks', 'control', 'tracking', 'sync_tombstones'
+    ]
+    LOOP
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (version)', t || '_version_idx', t);
+    END LOOP;
+END
+$$;
+
+DROP EXTENSION IF EXISTS btree_gin;
+DROP FUNCTION IF EXISTS app_table_name(oid);
+DROP FUNCTION IF EXISTS app_tenant_id();
+DROP TABLE IF EXISTS tenants;
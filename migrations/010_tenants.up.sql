@@ -0,0 +1,328 @@
+-- Tenants: one deployment serves many users, each seeing only their own rows
+-- (see tenants.py).
+--
+-- Every data table gets a tenant_id and a row-level security policy that
+-- shows and accepts only the rows of the tenant named by the session's
+-- app.tenant_id setting, which db.ConnectionPool sets on checkout. A
+-- session without it sees no rows and cannot insert any, so a query that
+-- forgets the tenant fails closed. FORCE makes the policies apply to the
+-- table owner too, since the app usually connects as the owner; it must
+-- not connect as a superuser or a BYPASSRLS role, which skip them.
+--
+-- Existing rows become tenant 1, the deployment's single user so far.
+--
+-- Keys and indexes are rebuilt to lead on tenant_id, so each tenant's
+-- lookups read only that tenant's index range whatever the total size.
+-- Foreign keys become composite, so a row can only reference a row of its
+-- own tenant; like 006 they are added NOT VALID and validated by
+-- `python cascade.py purge`.
+--
+-- app_events keeps no policy (the listener reads every tenant's events and
+-- filters them per subscriber) and sync_horizon stays global.
+
+CREATE TABLE IF NOT EXISTS tenants (
+    id serial PRIMARY KEY,
+    name text NOT NULL,
+    -- SHA-256 (hex) of the tenant's bearer token.
+    token_hash text UNIQUE,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+INSERT INTO tenants (id, name) VALUES (1, 'default') ON CONFLICT (id) DO NOTHING;
+SELECT setval(pg_get_serial_sequence('tenants', 'id'), GREATEST((SELECT MAX(id) FROM tenants), 1));
+
+-- The session's tenant, or NULL.
+CREATE OR REPLACE FUNCTION app_tenant_id() RETURNS integer AS $$
+    SELECT NULLIF(current_setting('app.tenant_id', true), '')::integer
+$$ LANGUAGE sql STABLE PARALLEL SAFE;
+
+-- Name of the table a trigger fired on; for a partition (see
+-- migrations/optional/partition_by_tenant.sql), its partitioned parent.
+CREATE OR REPLACE FUNCTION app_table_name(relid oid) RETURNS text AS $$
+    SELECT COALESCE(
+        (SELECT p.relname FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhparent WHERE i.inhrelid = relid),
+        (SELECT relname FROM pg_class WHERE oid = relid))
+$$ LANGUAGE sql STABLE;
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'houses', 'topics', 'files', 'tasks', 'unclassified_tasks', 'control', 'food', 'tracking',
+        'green_note_topics', 'green_notes', 'green_note_scores', 'window_state', 'maintenance_runs',
+        'search_index', 'food_daily', 'green_note_day_scores', 'tracking_days', 'sync_tombstones'
+    ]
+    LOOP
+        EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS tenant_id integer NOT NULL DEFAULT 1 '
+                       'REFERENCES tenants (id) ON DELETE CASCADE', t);
+        EXECUTE format('ALTER TABLE %I ALTER COLUMN tenant_id SET DEFAULT app_tenant_id()', t);
+        EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY', t);
+        EXECUTE format('ALTER TABLE %I FORCE ROW LEVEL SECURITY', t);
+        EXECUTE format('DROP POLICY IF EXISTS tenant_isolation ON %I', t);
+        EXECUTE format('CREATE POLICY tenant_isolation ON %I '
+                       'USING (tenant_id = app_tenant_id()) WITH CHECK (tenant_id = app_tenant_id())', t);
+    END LOOP;
+END
+$$;
+
+ALTER TABLE app_events ADD COLUMN IF NOT EXISTS tenant_id integer DEFAULT app_tenant_id();
+
+-- ---------- keys ----------
+-- Each key on the old columns (whatever its name) is replaced by one on
+-- (tenant_id, old columns). Dropping a key drops the foreign keys that
+-- reference it; they are re-added below.
+CREATE OR REPLACE FUNCTION pg_temp.rekey(tbl text, cols text[], conname text, kind text) RETURNS void AS $$
+DECLARE
+    c record;
+BEGIN
+    FOR c IN
+        SELECT k.conname FROM pg_constraint k
+        WHERE k.conrelid = tbl::regclass AND k.contype IN ('p', 'u')
+          AND k.conkey = (
+              SELECT array_agg(a.attnum ORDER BY col.ord)
+              FROM unnest(cols) WITH ORDINALITY AS col (name, ord)
+              JOIN pg_attribute a ON a.attrelid = tbl::regclass AND a.attname = col.name
+          )
+    LOOP
+        EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I CASCADE', tbl, c.conname);
+    END LOOP;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conrelid = tbl::regclass AND k.conname = rekey.conname) THEN
+        EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s (tenant_id, %s)', tbl, conname, kind,
+                       (SELECT string_agg(quote_ident(col), ', ') FROM unnest(cols) AS col));
+    END IF;
+END
+$$ LANGUAGE plpgsql;
+
+SELECT pg_temp.rekey(tbl, cols, conname, kind) FROM (VALUES
+    ('houses', ARRAY['name'], 'houses_pkey', 'PRIMARY KEY'),
+    ('files', ARRAY['topic_id', 'name'], 'files_topic_id_name_key', 'UNIQUE'),
+    ('tasks', ARRAY['topic_id', 'file_name'], 'tasks_topic_id_file_name_key', 'UNIQUE'),
+    ('control', ARRAY['topic_id', 'name_file'], 'control_topic_id_name_file_key', 'UNIQUE'),
+    ('green_notes', ARRAY['signature'], 'green_notes_signature_key', 'UNIQUE'),
+    ('window_state', ARRAY['id'], 'window_state_pkey', 'PRIMARY KEY'),
+    ('maintenance_runs', ARRAY['name'], 'maintenance_runs_pkey', 'PRIMARY KEY'),
+    ('search_index', ARRAY['kind', 'key'], 'search_index_pkey', 'PRIMARY KEY'),
+    ('food_daily', ARRAY['date'], 'food_daily_pkey', 'PRIMARY KEY'),
+    ('green_note_day_scores', ARRAY['date', 'category'], 'green_note_day_scores_pkey', 'PRIMARY KEY'),
+    ('tracking_days', ARRAY['name', 'date'], 'tracking_days_pkey', 'PRIMARY KEY')
+) AS v (tbl, cols, conname, kind);
+
+-- Targets of the composite foreign keys (ids stay globally unique).
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'topics'::regclass AND conname = 'topics_tenant_id_id_key') THEN
+        ALTER TABLE topics ADD CONSTRAINT topics_tenant_id_id_key UNIQUE (tenant_id, id);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'green_notes'::regclass AND conname = 'green_notes_tenant_id_id_key') THEN
+        ALTER TABLE green_notes ADD CONSTRAINT green_notes_tenant_id_id_key UNIQUE (tenant_id, id);
+    END IF;
+END
+$$;
+
+DO $$
+DECLARE
+    f record;
+BEGIN
+    FOR f IN SELECT * FROM (VALUES
+        ('topics', 'topics_house_fkey',
+         'FOREIGN KEY (tenant_id, house) REFERENCES houses (tenant_id, name) ON UPDATE CASCADE ON DELETE CASCADE'),
+        ('files', 'files_topic_id_fkey',
+         'FOREIGN KEY (tenant_id, topic_id) REFERENCES topics (tenant_id, id) ON DELETE CASCADE'),
+        ('tasks', 'tasks_file_fkey',
+         'FOREIGN KEY (tenant_id, topic_id, file_name) REFERENCES files (tenant_id, topic_id, name) '
+         'ON UPDATE CASCADE ON DELETE CASCADE'),
+        ('control', 'control_file_fkey',
+         'FOREIGN KEY (tenant_id, topic_id, name_file) REFERENCES files (tenant_id, topic_id, name) '
+         'ON UPDATE CASCADE ON DELETE CASCADE'),
+        ('green_note_scores', 'green_note_scores_note_id_fkey',
+         'FOREIGN KEY (tenant_id, note_id) REFERENCES green_notes (tenant_id, id) ON DELETE CASCADE')
+    ) AS v (tbl, conname, def)
+    LOOP
+        -- Replace the single-tenant version of the key, if it survived the rekeying.
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint c JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+            WHERE c.conrelid = f.tbl::regclass AND c.conname = f.conname AND a.attname = 'tenant_id'
+        ) THEN
+            EXECUTE format('ALTER TABLE %I DROP CONSTRAINT IF EXISTS %I', f.tbl, f.conname);
+            EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s NOT VALID', f.tbl, f.conname, f.def);
+        END IF;
+    END LOOP;
+END
+$$;
+
+-- delete_house moves topics to the general house, so every tenant needs one.
+-- Writes pass the policies only as their own tenant.
+DO $$
+DECLARE
+    t integer;
+BEGIN
+    FOR t IN SELECT id FROM tenants LOOP
+        PERFORM set_config('app.tenant_id', t::text, true);
+        INSERT INTO houses (name) VALUES ('כללי') ON CONFLICT DO NOTHING;
+    END LOOP;
+    PERFORM set_config('app.tenant_id', '', true);
+END
+$$;
+
+-- ---------- indexes ----------
+-- The same lookups as 001, 006 and 008, now within one tenant.
+CREATE INDEX IF NOT EXISTS topics_tenant_house_order_idx ON topics (tenant_id, house, "order");
+DROP INDEX IF EXISTS topics_house_order_idx;
+CREATE INDEX IF NOT EXISTS tasks_tenant_section_order_idx ON tasks (tenant_id, section, "order");
+DROP INDEX IF EXISTS tasks_section_order_idx;
+CREATE INDEX IF NOT EXISTS unclassified_tasks_tenant_order_content_idx ON unclassified_tasks (tenant_id, "order", content);
+DROP INDEX IF EXISTS unclassified_tasks_order_content_idx;
+CREATE INDEX IF NOT EXISTS control_tenant_is_plan_order_idx ON control (tenant_id, is_plan, order_index);
+DROP INDEX IF EXISTS control_is_plan_order_idx;
+CREATE UNIQUE INDEX IF NOT EXISTS food_tenant_date_id_idx ON food (tenant_id, date, id);
+DROP INDEX IF EXISTS food_date_id_idx;
+CREATE INDEX IF NOT EXISTS green_notes_tenant_date_idx ON green_notes (tenant_id, date, signature);
+DROP INDEX IF EXISTS green_notes_date_idx;
+CREATE INDEX IF NOT EXISTS green_note_scores_tenant_note_id_idx ON green_note_scores (tenant_id, note_id);
+DROP INDEX IF EXISTS green_note_scores_note_id_idx;
+CREATE INDEX IF NOT EXISTS files_tenant_linked_idx ON files (tenant_id, topic_id) WHERE linked;
+DROP INDEX IF EXISTS files_linked_idx;
+CREATE INDEX IF NOT EXISTS tracking_tenant_name_idx ON tracking (tenant_id, name);
+CREATE INDEX IF NOT EXISTS green_note_topics_tenant_idx ON green_note_topics (tenant_id);
+
+-- /sync reads each table's rows above a version.
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'houses', 'topics', 'files', 'tasks', 'unclassified_tasks', 'control', 'tracking', 'sync_tombstones'
+    ]
+    LOOP
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (tenant_id, version)', t || '_tenant_version_idx', t);
+        EXECUTE format('DROP INDEX IF EXISTS %I', t || '_version_idx');
+    END LOOP;
+END
+$$;
+
+-- btree_gin lets the text search indexes lead on tenant_id too.
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+CREATE INDEX IF NOT EXISTS search_index_tenant_tsv_idx ON search_index USING gin (tenant_id, tsv);
+CREATE INDEX IF NOT EXISTS search_index_tenant_title_trgm_idx ON search_index USING gin (tenant_id, title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS search_index_tenant_body_trgm_idx ON search_index USING gin (tenant_id, body gin_trgm_ops);
+DROP INDEX IF EXISTS search_index_tsv_idx;
+DROP INDEX IF EXISTS search_index_title_trgm_idx;
+DROP INDEX IF EXISTS search_index_body_trgm_idx;
+
+-- ---------- triggers ----------
+-- The derived rows (tombstones, search documents, analytics summaries)
+-- belong to the tenant of the row that produced them.
+
+CREATE OR REPLACE FUNCTION sync_touch() RETURNS trigger AS $$
+BEGIN
+    NEW.version := txid_current();
+    IF sync_row_key(to_jsonb(OLD), TG_ARGV) IS DISTINCT FROM sync_row_key(to_jsonb(NEW), TG_ARGV) THEN
+        -- A key change makes the old key disappear for the client.
+        INSERT INTO sync_tombstones (tenant_id, table_name, row_key)
+        VALUES (OLD.tenant_id, app_table_name(TG_RELID), sync_row_key(to_jsonb(OLD), TG_ARGV));
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sync_tombstones (tenant_id, table_name, row_key)
+    VALUES (OLD.tenant_id, app_table_name(TG_RELID), sync_row_key(to_jsonb(OLD), TG_ARGV));
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION search_sync() RETURNS trigger AS $$
+DECLARE
+    tbl text := app_table_name(TG_RELID);
+    old_doc record;
+    new_key jsonb;
+BEGIN
+    IF TG_OP <> 'DELETE' THEN
+        SELECT s.key INTO new_key FROM search_row(tbl, to_jsonb(NEW)) AS s;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        SELECT s.kind, s.key INTO old_doc FROM search_row(tbl, to_jsonb(OLD)) AS s;
+        IF old_doc.key IS DISTINCT FROM new_key THEN
+            DELETE FROM search_index WHERE tenant_id = OLD.tenant_id AND kind = old_doc.kind AND key = old_doc.key;
+        END IF;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO search_index (tenant_id, kind, key, meta, title, body)
+        SELECT NEW.tenant_id, s.* FROM search_row(tbl, to_jsonb(NEW)) AS s
+        ON CONFLICT (tenant_id, kind, key) DO UPDATE
+        SET meta = EXCLUDED.meta, title = EXCLUDED.title, body = EXCLUDED.body;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION analytics_food() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE food_daily
+        SET calories = calories - COALESCE(OLD.calories, 0), protein = protein - COALESCE(OLD.protein, 0),
+            items = items - 1
+        WHERE tenant_id = OLD.tenant_id AND date = OLD.date;
+        DELETE FROM food_daily WHERE tenant_id = OLD.tenant_id AND date = OLD.date AND items <= 0;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO food_daily (tenant_id, date, calories, protein, items)
+        VALUES (NEW.tenant_id, NEW.date, COALESCE(NEW.calories, 0), COALESCE(NEW.protein, 0), 1)
+        ON CONFLICT (tenant_id, date) DO UPDATE
+        SET calories = food_daily.calories + EXCLUDED.calories, protein = food_daily.protein + EXCLUDED.protein,
+            items = food_daily.items + 1;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION analytics_refresh_green_day(tenant integer, day text) RETURNS void AS $$
+    DELETE FROM green_note_day_scores WHERE tenant_id = tenant AND date = day;
+    INSERT INTO green_note_day_scores (tenant_id, date, category, score)
+    SELECT tenant, day, s.category, AVG(s.score)
+    FROM green_note_scores s
+    WHERE s.tenant_id = tenant
+      AND s.note_id = (SELECT id FROM green_notes WHERE tenant_id = tenant AND date = day ORDER BY id DESC LIMIT 1)
+    GROUP BY s.category;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION analytics_green_notes() RETURNS trigger AS $$
+BEGIN
+    IF app_table_name(TG_RELID) = 'green_notes' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM analytics_refresh_green_day(OLD.tenant_id, OLD.date);
+        END IF;
+        IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.date IS DISTINCT FROM OLD.date) THEN
+            PERFORM analytics_refresh_green_day(NEW.tenant_id, NEW.date);
+        END IF;
+    ELSE
+        -- Scores of a deleted note are handled by the green_notes trigger.
+        PERFORM analytics_refresh_green_day(n.tenant_id, n.date)
+        FROM green_notes n
+        WHERE n.id = CASE WHEN TG_OP = 'DELETE' THEN OLD.note_id ELSE NEW.note_id END;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS analytics_refresh_green_day(text);
+
+CREATE OR REPLACE FUNCTION analytics_tracking() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM tracking_days WHERE tenant_id = OLD.tenant_id AND name = OLD.name;
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.name IS DISTINCT FROM OLD.name THEN
+        UPDATE tracking_days SET name = NEW.name WHERE tenant_id = OLD.tenant_id AND name = OLD.name;
+    END IF;
+    IF NEW.time IS NOT NULL THEN
+        INSERT INTO tracking_days (tenant_id, name, date, done, amount)
+        VALUES (NEW.tenant_id, NEW.name, NEW.time, COALESCE(NEW.done, 0), COALESCE(NEW.amount, 0))
+        ON CONFLICT (tenant_id, name, date) DO UPDATE SET done = EXCLUDED.done, amount = EXCLUDED.amount;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,34 @@
+-- Background job queue (see jobs.py). No row-level security: workers claim
+-- every tenant's jobs and run each one as its tenant.
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id bigserial PRIMARY KEY,
+    -- NULL for deployment-wide work.
+    tenant_id integer REFERENCES tenants ON DELETE CASCADE,
+    kind text NOT NULL,
+    args jsonb NOT NULL DEFAULT '{}',
+    dedupe_key text,
+    status text NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'done', 'failed')),
+    attempts integer NOT NULL DEFAULT 0,
+    max_attempts integer NOT NULL DEFAULT 5,
+    run_at timestamptz NOT NULL DEFAULT now(),
+    -- A running job's lease; past it, another worker may claim the job again.
+    locked_until timestamptz,
+    last_error text,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    finished_at timestamptz
+);
+
+CREATE INDEX IF NOT EXISTS jobs_due_idx ON jobs (run_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS jobs_lease_idx ON jobs (locked_until) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS jobs_tenant_status_idx ON jobs (tenant_id, status, id);
+-- At most one pending job per tenant and key; enqueueing another is a no-op.
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending_dedupe_idx
+    ON jobs (COALESCE(tenant_id, 0), dedupe_key) WHERE status = 'pending';
+
+-- Last slot each recurring job was enqueued for, so that every slot is
+-- enqueued by one worker process only.
+CREATE TABLE IF NOT EXISTS job_schedules (
+    name text PRIMARY KEY,
+    last_slot timestamp NOT NULL
+);
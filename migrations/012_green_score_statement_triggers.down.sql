@@ -0,0 +1,7 @@
+DROP TRIGGER IF EXISTS analytics_green_note_scores_delete ON green_note_scores;
+DROP TRIGGER IF EXISTS analytics_green_note_scores_update ON green_note_scores;
+DROP TRIGGER IF EXISTS analytics_green_note_scores_insert ON green_note_scores;
+DROP FUNCTION IF EXISTS analytics_green_note_scores();
+DROP TRIGGER IF EXISTS analytics_green_notes ON green_note_scores;
+CREATE TRIGGER analytics_green_notes AFTER INSERT OR DELETE OR UPDATE ON green_note_scores
+FOR EACH ROW EXECUTE PROCEDURE analytics_green_notes();
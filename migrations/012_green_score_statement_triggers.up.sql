@@ -0,0 +1,48 @@
+-- save_green_note writes a note's scores in one multi-row statement, and
+-- the row-level trigger of 009 recomputed that day's averages once per
+-- score. These statement-level triggers read the changed scores from the
+-- transition tables and recompute each affected day once per statement.
+-- A trigger with transition tables can only fire on one event, hence three.
+
+CREATE OR REPLACE FUNCTION analytics_green_note_scores() RETURNS trigger AS $$
+BEGIN
+    -- Scores of a deleted note are handled by the green_notes trigger.
+    IF TG_OP = 'INSERT' THEN
+        PERFORM analytics_refresh_green_day(d.tenant_id, d.date)
+        FROM (
+            SELECT DISTINCT n.tenant_id, n.date
+            FROM green_notes n JOIN new_scores s ON s.tenant_id = n.tenant_id AND s.note_id = n.id
+        ) AS d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM analytics_refresh_green_day(d.tenant_id, d.date)
+        FROM (
+            SELECT DISTINCT n.tenant_id, n.date
+            FROM green_notes n JOIN old_scores s ON s.tenant_id = n.tenant_id AND s.note_id = n.id
+        ) AS d;
+    ELSE
+        PERFORM analytics_refresh_green_day(d.tenant_id, d.date)
+        FROM (
+            SELECT DISTINCT n.tenant_id, n.date
+            FROM green_notes n
+            JOIN (SELECT tenant_id, note_id FROM new_scores
+                  UNION SELECT tenant_id, note_id FROM old_scores) AS s
+                ON s.tenant_id = n.tenant_id AND s.note_id = n.id
+        ) AS d;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS analytics_green_notes ON green_note_scores;
+DROP TRIGGER IF EXISTS analytics_green_note_scores_insert ON green_note_scores;
+CREATE TRIGGER analytics_green_note_scores_insert AFTER INSERT ON green_note_scores
+REFERENCING NEW TABLE AS new_scores
+FOR EACH STATEMENT EXECUTE PROCEDURE analytics_green_note_scores();
+DROP TRIGGER IF EXISTS analytics_green_note_scores_update ON green_note_scores;
+CREATE TRIGGER analytics_green_note_scores_update AFTER UPDATE ON green_note_scores
+REFERENCING OLD TABLE AS old_scores NEW TABLE AS new_scores
+FOR EACH STATEMENT EXECUTE PROCEDURE analytics_green_note_scores();
+DROP TRIGGER IF EXISTS analytics_green_note_scores_delete ON green_note_scores;
+CREATE TRIGGER analytics_green_note_scores_delete AFTER DELETE ON green_note_scores
+REFERENCING OLD TABLE AS old_scores
+FOR EACH STATEMENT EXECUTE PROCEDURE analytics_green_note_scores();
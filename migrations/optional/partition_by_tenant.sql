@@ -0,0 +1,124 @@
+-- Optional: LIST-partition files, food and green_notes by tenant_id
+-- (PostgreSQL 13 or later).
+--
+-- Not a numbered migration, since most deployments do not need it: the
+-- tenant-leading indexes of 010 already keep a tenant's lookups independent
+-- of the other tenants' rows. Partitioning pays off when a few tenants hold
+-- most of the rows: their partitions are vacuumed, cached and dropped on
+-- their own. Run it by hand after 010, once orphans are purged (the
+-- partitioned tables' foreign keys are validated on creation):
+--
+--     python cascade.py purge
+--     psql -v ON_ERROR_STOP=1 -f migrations/optional/partition_by_tenant.sql
+--
+-- Tenants with at least app.partition_min_rows rows in a table get their
+-- own partition of it; everyone else shares the DEFAULT partition. Later,
+--
+--     SELECT tenant_partition(42);
+--
+-- gives tenant 42 its own partitions, provided it has no rows in the
+-- default ones yet (e.g. right after `python tenants.py create`).
+--
+-- Each table is rebuilt: copied into a new partitioned table that gets the
+-- old one's keys, indexes, triggers, policy and the foreign keys pointing
+-- at it. The tables are locked while that runs. Rolling back 010 requires
+-- undoing this first.
+
+BEGIN;
+
+SET LOCAL app.partition_min_rows = 100000;
+
+-- Only (tenant_id, ...) keys can exist on a partitioned table.
+ALTER TABLE food DROP CONSTRAINT IF EXISTS food_pkey;
+ALTER TABLE food ADD CONSTRAINT food_pkey PRIMARY KEY (tenant_id, id);
+-- green_notes_tenant_id_id_key (010) takes its place.
+ALTER TABLE green_notes DROP CONSTRAINT IF EXISTS green_notes_pkey;
+
+CREATE FUNCTION pg_temp.partition_by_tenant(tbl text) RETURNS void AS $$
+DECLARE
+    old_name text := tbl || '_unpartitioned';
+    min_rows bigint := current_setting('app.partition_min_rows')::bigint;
+    stmts text[];
+    stmt text;
+    s record;
+    t integer;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = tbl::regclass) = 'p' THEN
+        RAISE NOTICE '% is already partitioned', tbl;
+        RETURN;
+    END IF;
+
+    -- Everything defined on or pointing at the table, to re-create on the
+    -- partitioned one. Foreign keys of a partitioned table cannot be NOT VALID.
+    SELECT array_agg(format('ALTER TABLE %I ADD CONSTRAINT %I %s', tbl, conname,
+                            replace(pg_get_constraintdef(oid), ' NOT VALID', ''))
+                     ORDER BY contype DESC)
+    INTO stmts FROM pg_constraint WHERE conrelid = tbl::regclass AND contype IN ('p', 'u', 'f', 'c');
+    stmts := COALESCE(stmts, '{}')
+        || (SELECT COALESCE(array_agg(pg_get_indexdef(i.indexrelid)), '{}') FROM pg_index i
+            WHERE i.indrelid = tbl::regclass
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid))
+        || (SELECT COALESCE(array_agg(pg_get_triggerdef(oid)), '{}') FROM pg_trigger
+            WHERE tgrelid = tbl::regclass AND NOT tgisinternal)
+        || (SELECT COALESCE(array_agg(format('ALTER TABLE %s ADD CONSTRAINT %I %s',
+                                             conrelid::regclass, conname, pg_get_constraintdef(oid))), '{}')
+            FROM pg_constraint WHERE confrelid = tbl::regclass AND contype = 'f');
+
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', tbl, old_name);
+    -- The copy below must see every tenant's rows.
+    EXECUTE format('ALTER TABLE %I NO FORCE ROW LEVEL SECURITY', old_name);
+    EXECUTE format('ALTER TABLE %I DISABLE ROW LEVEL SECURITY', old_name);
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMMENTS) '
+                   'PARTITION BY LIST (tenant_id)', tbl, old_name);
+    FOR t IN EXECUTE format('SELECT tenant_id FROM %I GROUP BY tenant_id HAVING count(*) >= %s', old_name, min_rows)
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%s)', tbl || '_t' || t, tbl, t);
+    END LOOP;
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', tbl || '_default', tbl);
+    -- Copied before the triggers exist, so the summaries and the search
+    -- index are not written a second time.
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I', tbl, old_name);
+
+    -- Serial columns keep their sequence.
+    FOR s IN
+        SELECT a.attname, pg_get_serial_sequence(old_name, a.attname) AS seq
+        FROM pg_attribute a
+        WHERE a.attrelid = old_name::regclass AND a.attnum > 0 AND NOT a.attisdropped
+          AND pg_get_serial_sequence(old_name, a.attname) IS NOT NULL
+    LOOP
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I', s.seq, tbl, s.attname);
+    END LOOP;
+
+    EXECUTE format('DROP TABLE %I CASCADE', old_name);
+    FOREACH stmt IN ARRAY stmts LOOP
+        EXECUTE stmt;
+    END LOOP;
+
+    EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY', tbl);
+    EXECUTE format('ALTER TABLE %I FORCE ROW LEVEL SECURITY', tbl);
+    EXECUTE format('CREATE POLICY tenant_isolation ON %I '
+                   'USING (tenant_id = app_tenant_id()) WITH CHECK (tenant_id = app_tenant_id())', tbl);
+    EXECUTE format('ANALYZE %I', tbl);
+END
+$$ LANGUAGE plpgsql;
+
+LOCK TABLE files, tasks, control, food, green_notes, green_note_scores IN ACCESS EXCLUSIVE MODE;
+SELECT pg_temp.partition_by_tenant('files');
+SELECT pg_temp.partition_by_tenant('food');
+SELECT pg_temp.partition_by_tenant('green_notes');
+
+-- A tenant's own partitions of the three tables. Fails if the tenant
+-- already has rows in a default partition.
+CREATE OR REPLACE FUNCTION tenant_partition(tenant integer) RETURNS void AS $$
+DECLARE
+    tbl text;
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY['files', 'food', 'green_notes'] LOOP
+        IF to_regclass(quote_ident(tbl || '_t' || tenant)) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%s)', tbl || '_t' || tenant, tbl, tenant);
+        END IF;
+    END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+COMMIT;
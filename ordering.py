@@ -0,0 +1,198 @@
+"""Sparse ordering keys for the drag-and-drop lists.
+
+Lists are ordered by a ``double precision`` key instead of a dense index.
+New keys are placed halfway between their neighbours, so inserting or
+moving one item writes exactly one row. When repeated inserts at the same
+spot squeeze a gap below ``MIN_GAP`` the list is renumbered by a
+background job, ``STEP`` apart again.
+
+On the wire, ``order`` / ``order_index`` in responses is the stored key, a
+JSON float such as ``1536.0``; the client keeps it as an opaque ``num``
+and only sends it back to name a row (POST /delete_unclassified). What
+the client sends to the reorder endpoints is a position, e.g. the dense
+list index: those endpoints use it only to sort the rows they are given
+and then place them with ``reorder``, so no dense index is ever stored.
+"""
+import bisect
+import json
+
+from psycopg2.extras import execute_values
+
+import events
+import jobs
+from db import bulk_update
+
+STEP = 1024.0
+MIN_GAP = 1e-3
+
+# Ordered lists: row key columns, the ordering column and the columns that
+# split a table into independent lists.
+LISTS = {
+    'topics': {'key': ['id'], 'column': 'order', 'group': ['house']},
+    'tasks': {'key': ['topic_id', 'file_name'], 'column': 'order', 'group': ['section']},
+    'unclassified_tasks': {'key': ['content'], 'column': 'order', 'group': []},
+    'control': {'key': ['topic_id', 'name_file'], 'column': 'order_index', 'group': ['is_plan']},
+}
+
+
+def key_between(before, after):
+    """Return a key strictly between two neighbours (either may be None), or None if there is no room."""
+    if before is None and after is None:
+        return STEP
+    if before is None:
+        return after - STEP
+    if after is None:
+        return before + STEP
+    key = (before + after) / 2
+    if not before < key < after:
+        return None
+    return key
+
+
+def crowded(before, after):
+    return before is not None and after is not None and after - before < MIN_GAP
+
+
+def next_key_sql(table, first=False):
+    """SQL expression for a key after the last (or before the first) item of a list.
+
+    The group columns are bound as parameters, in ``LISTS`` order.
+    """
+    spec = LISTS[table]
+    where = ' AND '.join('"%s" = %%s' % c for c in spec['group']) or 'TRUE'
+    if first:
+        return '(SELECT COALESCE(MIN("%s"), %s) - %s FROM %s WHERE %s)' % (spec['column'], STEP, STEP, table, where)
+    return '(SELECT COALESCE(MAX("%s"), 0) + %s FROM %s WHERE %s)' % (spec['column'], STEP, table, where)
+
+
+def _increasing_subsequence(keys):
+    """Indices of a longest strictly increasing run of ``keys``, skipping None."""
+    tails = []  # key ending the best subsequence of each length
+    tail_index = []
+    previous = [None] * len(keys)
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        pos = bisect.bisect_left(tails, key)
+        if pos == len(tails):
+            tails.append(key)
+            tail_index.append(i)
+        else:
+            tails[pos] = key
+            tail_index[pos] = i
+        previous[i] = tail_index[pos - 1] if pos else None
+    kept = set()
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+    return kept
+
+
+def plan_reorder(keys):
+    """Work out the fewest key changes that put a list into the given order.
+
+    ``keys`` holds the current key of every item in the desired order (None
+    for items new to the list). Items on a longest increasing run keep their
+    key; every other item gets a key between its new neighbours. Returns
+    ``(changes, crowded)`` where ``changes`` maps list index to new key, or
+    ``(None, True)`` if some gap has no room left and the list must be
+    renumbered.
+    """
+    kept = _increasing_subsequence(keys)
+    next_kept = [None] * len(keys)
+    upcoming = None
+    for i in range(len(keys) - 1, -1, -1):
+        next_kept[i] = upcoming
+        if i in kept:
+            upcoming = keys[i]
+
+    changes = {}
+    is_crowded = False
+    before = None
+    for i, key in enumerate(keys):
+        if i not in kept:
+            key = key_between(before, next_kept[i])
+            if key is None:
+                return None, True
+            is_crowded = is_crowded or crowded(before, next_kept[i])
+            changes[i] = key
+        before = key
+    return changes, is_crowded
+
+
+def rebalance(cur, table, group_values=()):
+    """Renumber one list ``STEP`` apart, keeping its current order, in one statement."""
+    spec = LISTS[table]
+    key = ', '.join('"%s"' % c for c in spec['key'])
+    where = ' AND '.join('"%s" = %%s' % c for c in spec['group']) or 'TRUE'
+    cur.execute("""
+        UPDATE {table} AS t SET "{column}" = r.rn * %s
+        FROM (
+            SELECT {key}, ROW_NUMBER() OVER (ORDER BY "{column}", {key}) AS rn
+            FROM {table} WHERE {where}
+        ) AS r
+        WHERE {join}
+    """.format(
+        table=table, column=spec['column'], key=key, where=where,
+        join=' AND '.join('t."%s" = r."%s"' % (c, c) for c in spec['key']),
+    ), (STEP,) + tuple(group_values))
+
+
+def reorder(cur, table, group_values, row_keys):
+    """Put the rows identified by ``row_keys`` into that order within one list.
+
+    Rows that already sit in the right relative order keep their key, so a
+    single drag writes a single row. Rows coming from another list are moved
+    into this one. Returns ``(written, crowded, ordering)`` where ``ordering``
+    lists ``(row_key, new_key)`` in order; ``crowded`` means the list should
+    be rebalanced soon.
+    """
+    spec = LISTS[table]
+    columns = spec['key'] + spec['group'] + [spec['column']]
+    group_values = list(group_values)
+    select = 'SELECT %s FROM %s AS t JOIN (VALUES %%s) AS v (%s) ON %s' % (
+        ', '.join('t."%s"' % c for c in columns),
+        table,
+        ', '.join('"%s"' % c for c in spec['key']),
+        ' AND '.join('t."%s" = v."%s"' % (c, c) for c in spec['key']),
+    )
+    width = len(spec['key'])
+    if not row_keys:
+        return 0, False, []
+
+    def current_keys():
+        rows = execute_values(cur, select, row_keys, page_size=len(row_keys), fetch=True)
+        current = {tuple(r[:width]): r[-1] for r in rows if list(r[width:-1]) == group_values}
+        return [current.get(tuple(k)) for k in row_keys]
+
+    keys = current_keys()
+    changes, is_crowded = plan_reorder(keys)
+    if changes is None:
+        # No room left between two neighbours: renumber now and plan again.
+        rebalance(cur, table, group_values)
+        keys = current_keys()
+        changes, is_crowded = plan_reorder(keys)
+
+    bulk_update(cur, table, spec['key'], spec['group'] + [spec['column']], [
+        tuple(row_keys[i]) + tuple(group_values) + (key,) for i, key in changes.items()
+    ])
+    ordering = [(tuple(k), changes.get(i, keys[i])) for i, k in enumerate(row_keys)]
+    return len(changes), is_crowded, ordering
+
+
+def schedule_rebalance(cur, table, group_values=()):
+    """Queue renumbering a crowded list of the current tenant in ``cur``'s transaction (see jobs.py).
+
+    A list waits in the queue at most once.
+    """
+    group_values = list(group_values)
+    jobs.enqueue(cur, 'rebalance', {'table': table, 'group': group_values},
+                 dedupe='rebalance:%s:%s' % (table, json.dumps(group_values, ensure_ascii=False)))
+
+
+@jobs.handler('rebalance')
+def rebalance_job(conn, args):
+    with conn.cursor() as cur:
+        rebalance(cur, args['table'], args['group'])
+        events.publish_change(cur, args['table'])
@@ -0,0 +1,181 @@
+"""Keyset pagination and streaming for the list endpoints.
+
+A list endpoint answers three ways depending on its query string:
+
+* no ``limit`` / ``cursor``: the whole list as a JSON array, as before;
+* ``?limit=N[&cursor=C]``: ``{"items": [...], "next_cursor": C2}``, where
+  ``next_cursor`` is null on the last page. Pages are fetched with
+  ``WHERE (key) > (last key)``, so a page costs the same at any depth;
+* ``?stream=ndjson`` or ``?stream=json``: every row, read through a
+  server-side cursor and sent in chunks as they are fetched, so memory
+  stays flat however long the list is.
+
+The first two also take ``?format=columns``, which sends the items as
+``{"columns": [...], "rows": [[...], ...]}`` (plus ``next_cursor`` for a
+page) so the keys are not repeated in every item.
+"""
+import base64
+import binascii
+import json
+import uuid
+
+from flask import Response, jsonify, request
+
+from db import Query, detach_db_connection, get_db_connection
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_CHUNK = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    """The key values in ``cursor``, checked against ``types`` (the Python type of each key column)."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise InvalidCursor('Malformed cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise InvalidCursor('Cursor does not belong to this list')
+    for value, type_ in zip(values, types):
+        # A float key may come back as an integer; a bool is never a key.
+        expected = (int, float) if type_ is float else type_
+        if isinstance(value, bool) or not isinstance(value, expected):
+            raise InvalidCursor('Cursor does not belong to this list')
+    return values
+
+
+class KeysetList:
+    """One list endpoint: what it selects and the unique key it is ordered by.
+
+    ``columns`` are the selected SQL expressions and ``row`` turns a result
+    row into its JSON item. ``key`` lists the ordering columns; each must
+    also appear in ``columns``. ``key_types`` gives the Python type of each
+    (``str``, ``int`` or ``float``), which a client's cursor must match
+    before it is sent to Postgres. ``where`` may hold ``%s`` placeholders
+    bound from the ``params`` given to each call.
+    """
+
+    def __init__(self, source, columns, key, row, where=None, *, key_types):
+        self.source = source
+        self.columns = columns
+        self.key = key
+        self.key_types = key_types
+        self.row = row
+        self.where = where
+        self._key_index = [columns.index(k) for k in key]
+
+    def _sql(self, after=False, limit=False):
+        conditions = [self.where] if self.where else []
+        if after:
+            conditions.append('(%s) > (%s)' % (', '.join(self.key), ', '.join(['%s'] * len(self.key))))
+        sql = 'SELECT %s FROM %s' % (', '.join(self.columns), self.source)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join('(%s)' % c for c in conditions)
+        sql += ' ORDER BY ' + ', '.join(self.key)
+        if limit:
+            sql += ' LIMIT %s'
+        return sql
+
+    def all(self, cur, params=()):
+        return self.query(params)(cur)
+
+    def query(self, params=()):
+        """The whole list as a ``db.Query``."""
+        return Query(self._sql(), lambda rows: [self.row(r) for r in rows], params)
+
+    def page(self, cur, cursor, limit, params=()):
+        """Return ``(items, next_cursor)`` for the ``limit`` rows after ``cursor`` (None: the first page)."""
+        args = tuple(params)
+        if cursor:
+            args += tuple(decode_cursor(cursor, self.key_types))
+        # One extra row tells whether another page follows.
+        cur.execute(self._sql(after=bool(cursor), limit=True), args + (limit + 1,))
+        rows = cur.fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][i] for i in self._key_index)
+        return [self.row(r) for r in rows], next_cursor
+
+    def stream(self, fmt, params=()):
+        """A streamed response of every row, as NDJSON or as one JSON array."""
+        # The request's connection, checked out before the response starts
+        # so a busy pool still fails with a clean 503.
+        conn = get_db_connection()
+
+        def generate():
+            with conn.cursor(name='stream_%s' % uuid.uuid4().hex) as cur:
+                cur.itersize = STREAM_CHUNK
+                cur.execute(self._sql(), tuple(params))
+                first = True
+                if fmt == 'json':
+                    yield '['
+                while True:
+                    rows = cur.fetchmany(STREAM_CHUNK)
+                    if not rows:
+                        break
+                    items = [json.dumps(self.row(r), ensure_ascii=False) for r in rows]
+                    if fmt == 'json':
+                        yield ('' if first else ',') + ','.join(items)
+                    else:
+                        yield '\n'.join(items) + '\n'
+                    first = False
+                if fmt == 'json':
+                    yield ']'
+
+        response = Response(generate(), mimetype='application/x-ndjson' if fmt == 'ndjson' else 'application/json')
+        # The body is read after the request has ended: the connection is
+        # returned once it is closed rather than at teardown.
+        response.call_on_close(detach_db_connection())
+        return response
+
+
+def columnar(items):
+    """``items`` (dicts with the same keys) as ``{"columns": [...], "rows": [[...], ...]}``.
+
+    A list of plain values is returned under ``rows`` as it is, with null ``columns``.
+    """
+    if not items or not isinstance(items[0], dict):
+        return {'columns': None, 'rows': items}
+    columns = list(items[0])
+    return {'columns': columns, 'rows': [[item[c] for c in columns] for item in items]}
+
+
+def respond(keyset_list, params=()):
+    """Answer the current request from ``keyset_list`` in the mode its query string asks for."""
+    fmt = request.args.get('format')
+    if fmt not in (None, 'columns'):
+        return jsonify({'error': 'format must be columns'}), 400
+    stream = request.args.get('stream')
+    if stream:
+        if stream not in ('ndjson', 'json'):
+            return jsonify({'error': 'stream must be ndjson or json'}), 400
+        if fmt:
+            return jsonify({'error': 'format=columns cannot be streamed'}), 400
+        return keyset_list.stream(stream, params)
+
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', type=int)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if cursor is None and limit is None:
+            items = keyset_list.all(cur, params)
+            return jsonify(columnar(items) if fmt else items)
+        limit = max(1, min(limit or DEFAULT_LIMIT, MAX_LIMIT))
+        items, next_cursor = keyset_list.page(cur, cursor, limit, params)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        cur.close()
+    if fmt:
+        return jsonify(dict(columnar(items), next_cursor=next_cursor))
+    return jsonify({'items': items, 'next_cursor': next_cursor})
@@ -0,0 +1,342 @@
+"""Route the read-only GET endpoints to streaming-replication standbys.
+
+With ``DB_REPLICA_HOSTS`` set (``host[:port]``, comma-separated; same
+database and credentials as the primary), a GET request reads from a
+healthy replica. Everything else runs on the primary:
+
+* every other method, and the GET endpoints that write (the
+  ``primary_endpoints`` passed to ``init_app``);
+* the rest of a request once ``db.use_primary()`` is called, which
+  writebehind.py does when a read had to flush buffered writes;
+* a client that wrote recently. A write's response carries the primary's
+  WAL position after it, in the ``db_lsn`` cookie and the ``X-DB-LSN``
+  header (for clients that do not keep cookies: send it back as is). A
+  read naming a position only goes to a replica that has replayed that
+  far. Writes left in the write-behind buffer carry ``primary`` instead,
+  which keeps the client on the primary until the cookie expires.
+
+A monitor thread per process checks the replicas every
+REPLICA_CHECK_INTERVAL seconds. A replica leaves the rotation while it is
+unreachable, out of recovery (promoted), or more than
+REPLICA_MAX_LAG_SECONDS behind, and rejoins once it has caught up. Lag is
+measured against the primary's WAL position, not replay timestamps, so an
+idle primary does not make a replica look stale; it is known to within one
+check interval. asgi.py's /bootstrap keeps reading the primary.
+
+To try it against a local primary and standby:
+
+    python replicas.py local-pair --dir /tmp/pg-pair   # prints the env to export
+    python migrate.py apply
+    python replicas.py status
+    python replicas.py local-pair --dir /tmp/pg-pair --stop
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from flask import g, request
+
+from db import dsn, get_pool, new_pool
+
+log = logging.getLogger(__name__)
+
+REPLICA_HOSTS = [h.strip() for h in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if h.strip()]
+CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 1))
+MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+# How long a client reads from the primary, or from replicas that replayed
+# its write, after writing. At least MAX_LAG_SECONDS: after that any
+# healthy replica has the write.
+STICKY_SECONDS = int(float(os.environ.get('REPLICA_STICKY_SECONDS', 2 * MAX_LAG_SECONDS)))
+
+LSN_COOKIE = 'db_lsn'
+LSN_HEADER = 'X-DB-LSN'
+PRIMARY = 'primary'
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+def parse_lsn(text):
+    """``'16/B374D848'`` as an integer, or None if it is not a WAL position."""
+    try:
+        high, low = text.split('/')
+        return (int(high, 16) << 32) | int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_lsn(lsn):
+    return None if lsn is None else '%X/%X' % (lsn >> 32, lsn & 0xFFFFFFFF)
+
+
+def _address(host):
+    name, _, port = host.rpartition(':')
+    if not name or not port.isdigit():
+        return {'host': host}
+    return {'host': name, 'port': int(port)}
+
+
+class Replica:
+    def __init__(self, name):
+        self.name = name
+        self.address = _address(name)
+        self.pool = new_pool(**self.address)
+        self.healthy = False
+        self.replay_lsn = None
+        # time.monotonic() at which the primary was sampled at a position
+        # this replica has since replayed: it has every commit before then.
+        self.synced_at = None
+        self.error = 'not checked yet'
+
+
+class Monitor:
+    """Checks the replicas' lag and picks one for each routed read."""
+
+    def __init__(self, hosts, interval, max_lag):
+        self.replicas = [Replica(host) for host in hosts]
+        self.interval = interval
+        self.max_lag = max_lag
+        # (time.monotonic(), primary WAL position), covering max_lag.
+        self._samples = deque(maxlen=int(max_lag / interval) + 2)
+        self._conns = {}  # None (the primary) or replica name -> autocommit connection
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='replica-monitor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                log.exception('Replica check failed')
+            time.sleep(self.interval)
+
+    def _fetch(self, name, sql, **address):
+        conn = self._conns.get(name)
+        try:
+            if conn is None or conn.closed:
+                conn = self._conns[name] = psycopg2.connect(
+                    connect_timeout=max(1, int(self.interval * 2)), **dict(dsn(), **address))
+                conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(sql)
+                return cur.fetchone()
+        except psycopg2.Error:
+            conn = self._conns.pop(name, None)
+            if conn is not None:
+                conn.close()
+            raise
+
+    def check(self):
+        """Sample the primary's WAL position, then every replica's replay position."""
+        now = time.monotonic()
+        try:
+            self._samples.append((now, parse_lsn(self._fetch(None, 'SELECT pg_current_wal_lsn()::text')[0])))
+        except psycopg2.Error as e:
+            # Without samples the replicas' lag grows until they leave the rotation.
+            log.warning('Replica monitor cannot reach the primary: %s', str(e).strip())
+        for replica in self.replicas:
+            try:
+                in_recovery, replay = self._fetch(
+                    replica.name, 'SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn()::text', **replica.address)
+                error = None if in_recovery else 'not in recovery'
+            except psycopg2.Error as e:
+                replay, error = None, str(e).strip()
+            replay = parse_lsn(replay)
+            synced = [at for at, position in self._samples if replay is not None and replay >= position]
+            with self._lock:
+                replica.replay_lsn = replay
+                replica.error = error
+                if synced:
+                    replica.synced_at = max(synced)
+                healthy = (error is None and replica.synced_at is not None
+                           and now - replica.synced_at <= self.max_lag)
+                if healthy != replica.healthy:
+                    log.warning('Replica %s %s', replica.name, 'is back in rotation' if healthy else
+                                'left the rotation: %s' % (error or 'lagging'))
+                replica.healthy = healthy
+
+    def choose(self, min_lsn=None):
+        """A healthy replica that has replayed ``min_lsn`` (round robin), or None for the primary."""
+        with self._lock:
+            # A standby that has not replayed anything yet has caught up to nothing.
+            candidates = [r for r in self.replicas if r.healthy and (
+                min_lsn is None or (r.replay_lsn is not None and r.replay_lsn >= min_lsn))]
+            if not candidates:
+                return None
+            return candidates[next(self._turn) % len(candidates)]
+
+    def stats(self):
+        now = time.monotonic()
+        primary = self._samples[-1][1] if self._samples else None
+        with self._lock:
+            return {r.name: {
+                'healthy': r.healthy,
+                'lag_seconds': None if r.synced_at is None else round(now - r.synced_at, 3),
+                'lag_bytes': None if primary is None or r.replay_lsn is None else max(0, primary - r.replay_lsn),
+                'replay_lsn': format_lsn(r.replay_lsn),
+                'error': r.error,
+                'pool': r.pool.stats(),
+            } for r in self.replicas}
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_monitor():
+    """This process's monitor, started on first use."""
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                monitor = Monitor(REPLICA_HOSTS, CHECK_INTERVAL, MAX_LAG_SECONDS)
+                monitor.start()
+                _monitor = monitor
+    return _monitor
+
+
+def _forget_monitor_after_fork():
+    # The parent's thread, connections and pools stay with the parent.
+    global _monitor, _monitor_lock
+    _monitor = None
+    _monitor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_monitor_after_fork)
+
+
+def stats():
+    """Per-replica health, lag and pool statistics ({} without replicas)."""
+    return get_monitor().stats() if REPLICA_HOSTS else {}
+
+
+def init_app(app, primary_endpoints=()):
+    """Route reads to the replicas and hand writers their read-your-writes position."""
+    if not REPLICA_HOSTS:
+        return
+
+    @app.before_request
+    def _route_read():
+        if request.method not in READ_METHODS or request.endpoint in primary_endpoints:
+            return None
+        written = request.headers.get(LSN_HEADER) or request.cookies.get(LSN_COOKIE)
+        if written == PRIMARY:
+            return None
+        replica = get_monitor().choose(parse_lsn(written))
+        if replica is not None:
+            g.db_read_pool = replica.pool
+            # For cache.py: the replica has every write committed before this.
+            g.db_synced_at = replica.synced_at
+        return None
+
+    @app.after_request
+    def _remember_write(response):
+        if request.method in READ_METHODS and request.endpoint not in primary_endpoints:
+            return response
+        position = PRIMARY
+        conn = g.get('db_conn')
+        if conn is not None and g.get('db_conn_pool') is get_pool():
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT pg_current_wal_lsn()::text')
+                    position = cur.fetchone()[0]
+            except psycopg2.Error:
+                pass
+        response.set_cookie(LSN_COOKIE, position, max_age=STICKY_SECONDS, httponly=True, samesite='Lax')
+        response.headers[LSN_HEADER] = position
+        return response
+
+
+# ---------- local primary and standby ----------
+
+def _append_conf(data_dir, settings):
+    with open(os.path.join(data_dir, 'postgresql.conf'), 'a') as f:
+        f.write('\n' + ''.join("%s = '%s'\n" % item for item in settings.items()))
+
+
+def local_pair(directory, port, stop=False):
+    """Start (or stop) a primary on ``port`` and a streaming standby on ``port + 1`` under ``directory``.
+
+    Needs initdb, pg_ctl and pg_basebackup on PATH. Both trust local
+    connections, so DB_PASSWORD is not checked.
+    """
+    primary_dir = os.path.join(directory, 'primary')
+    replica_dir = os.path.join(directory, 'replica')
+    if stop:
+        for data_dir in (replica_dir, primary_dir):
+            if os.path.isdir(data_dir):
+                subprocess.run(['pg_ctl', '-D', data_dir, '-m', 'fast', 'stop'], check=False)
+        return
+
+    user = os.environ.get('DB_USER', 'postgres')
+    database = os.environ.get('DB_NAME', 'thoughts')
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    if not os.path.isdir(primary_dir):
+        subprocess.run(['initdb', '-D', primary_dir, '-U', user, '--auth=trust', '--encoding=UTF8'], check=True)
+        _append_conf(primary_dir, {
+            'port': port, 'listen_addresses': 'localhost', 'unix_socket_directories': directory,
+            'wal_level': 'replica', 'max_wal_senders': 4, 'hot_standby': 'on',
+        })
+    subprocess.run(['pg_ctl', '-D', primary_dir, '-l', os.path.join(directory, 'primary.log'), '-w', 'start'],
+                   check=True)
+
+    conn = psycopg2.connect(host='localhost', port=port, user=user, dbname='postgres')
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('SELECT 1 FROM pg_database WHERE datname = %s', (database,))
+        if cur.fetchone() is None:
+            cur.execute('CREATE DATABASE "%s"' % database.replace('"', '""'))
+    conn.close()
+
+    if not os.path.isdir(replica_dir):
+        # -R writes primary_conninfo and standby.signal: the copy starts as a standby.
+        subprocess.run(['pg_basebackup', '-h', 'localhost', '-p', str(port), '-U', user,
+                        '-D', replica_dir, '-R', '-X', 'stream'], check=True)
+        _append_conf(replica_dir, {'port': port + 1})
+    subprocess.run(['pg_ctl', '-D', replica_dir, '-l', os.path.join(directory, 'replica.log'), '-w', 'start'],
+                   check=True)
+
+    print('export DB_HOST=localhost DB_PORT=%d DB_NAME=%s DB_USER=%s DB_PASSWORD=%s'
+          % (port, database, user, os.environ.get('DB_PASSWORD', 'unused')))
+    print('export DB_REPLICA_HOSTS=localhost:%d' % (port + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help="print every replica's health and lag")
+    pair_parser = commands.add_parser('local-pair', help='start a local primary and streaming standby')
+    pair_parser.add_argument('--dir', required=True, help='directory holding both data directories')
+    pair_parser.add_argument('--port', type=int, default=5433, help="the primary's port; the standby's is one above")
+    pair_parser.add_argument('--stop', action='store_true', help='stop both servers')
+    args = parser.parse_args()
+
+    if args.command == 'local-pair':
+        local_pair(args.dir, args.port, args.stop)
+        return 0
+    if not REPLICA_HOSTS:
+        print('DB_REPLICA_HOSTS is not set')
+        return 1
+    monitor = Monitor(REPLICA_HOSTS, CHECK_INTERVAL, MAX_LAG_SECONDS)
+    # Two rounds, so a replica can be matched against an earlier sample.
+    monitor.check()
+    time.sleep(CHECK_INTERVAL)
+    monitor.check()
+    print(json.dumps(monitor.stats(), indent=2, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
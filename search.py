@@ -0,0 +1,70 @@
+"""Ranked full-text search for GET /search.
+
+Documents live in ``search_index`` and are maintained by triggers, see
+migrations/007_search.up.sql. A hit either matches the query's words
+through the tsvector index or, for queries of at least ``MIN_SUBSTRING``
+characters, contains the query as a substring through the trigram indexes.
+"""
+KINDS = ('file', 'topic', 'unclassified_task', 'green_note')
+
+# Trigram indexes cannot narrow shorter patterns, so those would scan.
+MIN_SUBSTRING = 3
+
+HEADLINE_OPTIONS = 'MaxFragments=2, MaxWords=18, MinWords=6, FragmentDelimiter=" … "'
+SNIPPET_CONTEXT = 60
+
+
+def _like_pattern(query):
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+
+def search(cur, query, kinds=None, limit=20, offset=0):
+    """Return up to ``limit + 1`` hits, best first, so the caller can tell whether there is another page.
+
+    Each hit holds the document's key fields (e.g. ``topic_id`` and ``name``
+    for a file), its ``kind``, ``title``, ``rank`` and a ``snippet`` with the
+    matched words wrapped in ``<b>``.
+    """
+    pattern = _like_pattern(query) if len(query) >= MIN_SUBSTRING else None
+    # Rank and page first, then build snippets for that page only:
+    # ts_headline re-parses the whole body.
+    cur.execute("""
+        WITH q AS (
+            SELECT websearch_to_tsquery('simple', %(query)s) AS tsq
+        ), hits AS (
+            SELECT s.kind, s.key, s.meta, s.title, s.body, s.tsv @@ q.tsq AS word_match,
+                   ts_rank_cd(s.tsv, q.tsq, 32)
+                     + CASE WHEN s.title ILIKE %(pattern)s::text THEN 0.5 ELSE 0 END AS rank
+            FROM search_index s, q
+            WHERE (s.tsv @@ q.tsq
+                   OR (%(pattern)s::text IS NOT NULL
+                       AND (s.title ILIKE %(pattern)s::text OR s.body ILIKE %(pattern)s::text)))
+              AND (%(kinds)s::text[] IS NULL OR s.kind = ANY(%(kinds)s::text[]))
+            ORDER BY rank DESC, s.kind, s.key::text
+            LIMIT %(limit)s OFFSET %(offset)s
+        )
+        SELECT h.kind, h.key, h.meta, h.title, h.rank,
+               CASE
+                   WHEN h.body = '' THEN ''
+                   WHEN h.word_match THEN ts_headline('simple', h.body, q.tsq, %(headline)s)
+                   ELSE substr(h.body, GREATEST(strpos(lower(h.body), lower(%(query)s)) - %(context)s, 1),
+                               2 * %(context)s + length(%(query)s))
+               END
+        FROM hits h, q
+        ORDER BY h.rank DESC, h.kind, h.key::text
+    """, {
+        'query': query,
+        'pattern': pattern,
+        'kinds': list(kinds) if kinds else None,
+        'limit': limit + 1,
+        'offset': offset,
+        'headline': HEADLINE_OPTIONS,
+        'context': SNIPPET_CONTEXT,
+    })
+    hits = []
+    for kind, key, meta, title, rank, snippet in cur.fetchall():
+        hit = dict(meta, **key)
+        hit.update({'kind': kind, 'title': title, 'rank': round(rank, 4), 'snippet': snippet})
+        hits.append(hit)
+    return hits
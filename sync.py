@@ -0,0 +1,85 @@
+"""Delta fetch for GET /sync.
+
+Rows carry the id of the transaction that last wrote them (``version``) and
+deletes leave a tombstone, see migrations/003_change_versions.up.sql. A
+client keeps the ``version`` returned by its last call and passes it back
+as ``since`` to receive only what changed after it. Tombstones older than
+30 days are purged every night by the ``purge_tombstones`` job.
+"""
+import jobs
+from db import begin_snapshot
+
+# Synced tables, with columns left out of the delta (file bodies are
+# fetched on demand through /file_info).
+TABLES = {
+    'houses': [],
+    'topics': [],
+    'files': ['content'],
+    'tasks': [],
+    'unclassified_tasks': [],
+    'control': [],
+    'tracking': [],
+}
+
+
+def fetch_changes(cur, since, tables=None):
+    """Return the /sync document for changes after cursor ``since`` (None: full snapshot)."""
+    tables = [t for t in (tables or TABLES) if t in TABLES]
+    begin_snapshot(cur)
+    cur.execute("""
+        SELECT txid_snapshot_xmin(txid_current_snapshot()), (SELECT version FROM sync_horizon WHERE id = 1)
+    """)
+    cursor, horizon = cur.fetchone()
+
+    # Tombstones older than the horizon were purged, so such a cursor can
+    # only be served by a full snapshot.
+    full = since is None or since < (horizon or 0)
+    changes = {}
+    for table in tables:
+        dropped = ''.join(" - '%s'" % c for c in TABLES[table] + ['version', 'tenant_id'])
+        if full:
+            cur.execute('SELECT to_jsonb(t)%s FROM %s t' % (dropped, table))
+        else:
+            cur.execute('SELECT to_jsonb(t)%s FROM %s t WHERE version >= %%s' % (dropped, table), (since,))
+        changes[table] = [row[0] for row in cur.fetchall()]
+
+    deleted = {}
+    if not full:
+        cur.execute("""
+            SELECT table_name, row_key FROM sync_tombstones
+            WHERE version >= %s AND table_name = ANY(%s)
+            ORDER BY version
+        """, (since, tables))
+        for table, key in cur.fetchall():
+            deleted.setdefault(table, []).append(key)
+
+    cur.connection.commit()
+    return {'version': cursor, 'full': full, 'changes': changes, 'deleted': deleted}
+
+
+def purge_tombstones(cur, keep='30 days'):
+    """Drop the session tenant's tombstones older than ``keep`` and raise the horizon past them.
+
+    The horizon is shared by all tenants, so purging one tenant's
+    tombstones may send other tenants' stale clients a full snapshot early.
+    Returns the number purged.
+    """
+    cur.execute("""
+        WITH purged AS (
+            DELETE FROM sync_tombstones WHERE created_at < now() - %s::interval RETURNING version
+        ), horizon AS (
+            UPDATE sync_horizon SET version = GREATEST(version, (SELECT MAX(version) + 1 FROM purged))
+            WHERE id = 1 AND EXISTS (SELECT 1 FROM purged)
+        )
+        SELECT COUNT(*) FROM purged
+    """, (keep,))
+    return cur.fetchone()[0]
+
+
+@jobs.handler('purge_tombstones')
+def purge_tombstones_job(conn, args):
+    with conn.cursor() as cur:
+        purge_tombstones(cur, args.get('keep', '30 days'))
+
+
+jobs.schedule('purge_tombstones', '10 3 * * *', 'purge_tombstones')
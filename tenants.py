@@ -0,0 +1,185 @@
+"""Which tenant (user account) a request's rows belong to.
+
+Every data table has a ``tenant_id`` and a row-level security policy that
+only shows and accepts the rows of the session's ``app.tenant_id``, see
+migrations/010_tenants.up.sql. The connection pool sets that setting to
+the tenant a connection is checked out for, so the queries in app.py need
+no tenant filter of their own.
+
+A request names its tenant with ``Authorization: Bearer <token>``; the
+tenants table stores the token's SHA-256. A request without a token acts
+as ``DEFAULT_TENANT_ID`` (1, the deployment's user from before tenants),
+since the shipped client sends none yet. Anyone reaching the server can
+then read and write that tenant's data, so once every client sends a
+token (``python tenants.py token 1`` issues one for that user), set
+``TENANT_ALLOW_ANONYMOUS=0`` to answer token-less requests 401.
+
+    python tenants.py create NAME      # prints the new tenant's token
+    python tenants.py token ID         # replaces a tenant's token, prints the new one
+    python tenants.py list
+    python tenants.py delete ID        # deletes the tenant and all its rows
+"""
+import argparse
+import contextvars
+import hashlib
+import os
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, jsonify, request
+
+from db import get_pool
+
+DEFAULT_TENANT_ID = int(os.environ.get('DEFAULT_TENANT_ID', 1))
+# On until the client sends a token (see above); 0 refuses token-less requests.
+ALLOW_ANONYMOUS = os.environ.get('TENANT_ALLOW_ANONYMOUS', '1').lower() not in ('0', 'false', 'no')
+# How long a token's tenant is remembered before it is looked up again
+# (i.e. how long a deleted tenant's token keeps working in each worker).
+TOKEN_CACHE_SECONDS = float(os.environ.get('TENANT_TOKEN_CACHE_SECONDS', 60))
+
+_tokens = {}  # token hash -> (tenant id, looked up at)
+_tokens_lock = threading.Lock()
+_scoped = contextvars.ContextVar('tenant', default=None)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def tenant_for(authorization):
+    """The tenant id for an ``Authorization`` header value (None: absent).
+
+    Raises LookupError for an unknown token, or a missing one unless
+    anonymous requests are allowed.
+    """
+    if not authorization:
+        if not ALLOW_ANONYMOUS:
+            raise LookupError('Authorization required')
+        return DEFAULT_TENANT_ID
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        raise LookupError('Expected a bearer token')
+    token_hash = hash_token(token.strip())
+    with _tokens_lock:
+        cached = _tokens.get(token_hash)
+    if cached is not None and time.monotonic() - cached[1] < TOKEN_CACHE_SECONDS:
+        return cached[0]
+    # tenants has no row-level security, so no tenant is needed to read it.
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT id FROM tenants WHERE token_hash = %s', (token_hash,))
+        row = cur.fetchone()
+    if row is None:
+        raise LookupError('Unknown token')
+    with _tokens_lock:
+        _tokens[token_hash] = (row[0], time.monotonic())
+    return row[0]
+
+
+def current():
+    """The tenant the running code acts for: the one entered with ``scope``, else the request's."""
+    scoped = _scoped.get()
+    if scoped is not None:
+        return scoped
+    return g.get('tenant_id') if has_request_context() else None
+
+
+@contextmanager
+def scope(tenant_id):
+    """Act for ``tenant_id``, e.g. in a write-behind flush or a background job."""
+    token = _scoped.set(tenant_id)
+    try:
+        yield
+    finally:
+        _scoped.reset(token)
+
+
+def init_app(app, unscoped=()):
+    """Resolve every request's tenant before its view runs; ``unscoped`` endpoints read no tenant data."""
+    @app.before_request
+    def _resolve_tenant():
+        if request.endpoint in unscoped or request.method == 'OPTIONS':
+            return None
+        try:
+            g.tenant_id = tenant_for(request.headers.get('Authorization'))
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 401
+        return None
+
+
+def all_ids(cur):
+    """Every tenant id, for jobs that run once per tenant."""
+    cur.execute('SELECT id FROM tenants ORDER BY id')
+    return [row[0] for row in cur.fetchall()]
+
+
+def create(conn, name):
+    """Create a tenant with its general house. Returns ``(id, token)``; only the token's hash is stored."""
+    token = secrets.token_urlsafe(32)
+    with conn.cursor() as cur:
+        cur.execute('INSERT INTO tenants (name, token_hash) VALUES (%s, %s) RETURNING id', (name, hash_token(token)))
+        tenant_id = cur.fetchone()[0]
+        cur.execute("SELECT set_config('app.tenant_id', %s, true)", (str(tenant_id),))
+        cur.execute("INSERT INTO houses (name) VALUES ('כללי')")
+    conn.commit()
+    return tenant_id, token
+
+
+def rotate_token(conn, tenant_id):
+    """Give a tenant a new token, revoking the old one. Returns the token, or None if unknown."""
+    token = secrets.token_urlsafe(32)
+    with conn.cursor() as cur:
+        cur.execute('UPDATE tenants SET token_hash = %s WHERE id = %s', (hash_token(token), tenant_id))
+        found = cur.rowcount > 0
+    conn.commit()
+    return token if found else None
+
+
+def delete(conn, tenant_id):
+    """Delete a tenant; its rows go with it through the ON DELETE CASCADE keys. Returns False if unknown."""
+    with conn.cursor() as cur:
+        # The cascade's triggers write tombstones and summaries as that tenant.
+        cur.execute("SELECT set_config('app.tenant_id', %s, true)", (str(tenant_id),))
+        cur.execute('DELETE FROM tenants WHERE id = %s', (tenant_id,))
+        deleted = cur.rowcount > 0
+    conn.commit()
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    create_parser = commands.add_parser('create', help='create a tenant and print its token')
+    create_parser.add_argument('name')
+    token_parser = commands.add_parser('token', help="replace a tenant's token and print the new one")
+    token_parser.add_argument('id', type=int)
+    commands.add_parser('list', help='list tenants')
+    delete_parser = commands.add_parser('delete', help='delete a tenant and all of its rows')
+    delete_parser.add_argument('id', type=int)
+    args = parser.parse_args()
+
+    with get_pool().connection() as conn:
+        if args.command == 'create':
+            tenant_id, token = create(conn, args.name)
+            print('tenant %d created; its token (shown once): %s' % (tenant_id, token))
+        elif args.command == 'token':
+            token = rotate_token(conn, args.id)
+            if token is None:
+                print('no tenant %d' % args.id)
+                return 1
+            print('new token of tenant %d (shown once; the old one stops working): %s' % (args.id, token))
+        elif args.command == 'list':
+            with conn.cursor() as cur:
+                cur.execute('SELECT id, name, created_at FROM tenants ORDER BY id')
+                for tenant_id, name, created_at in cur.fetchall():
+                    print('%6d  %-32s %s' % (tenant_id, name, created_at.strftime('%Y-%m-%d %H:%M')))
+        elif not delete(conn, args.id):
+            print('no tenant %d' % args.id)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
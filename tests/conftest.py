@@ -0,0 +1,9 @@
+"""Unit tests that need no database: the modules only connect when used."""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# db.dsn() reads these when a pool is built; no test builds one.
+for name in ('DB_HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD'):
+    os.environ.setdefault(name, 'unused')
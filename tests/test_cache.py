@@ -0,0 +1,153 @@
+import hashlib
+
+import pytest
+from flask import Flask, g, jsonify
+
+import cache
+import events
+from cache import ResponseCache
+
+
+def entry(body, *tags):
+    return (body, hashlib.sha1(body).hexdigest(), 'application/json', list(tags))
+
+
+def put(rc, key, body, *tags):
+    rc.put(key, entry(body, *tags), rc.generation(tags))
+
+
+def test_get_returns_what_was_put():
+    rc = ResponseCache(100)
+    put(rc, 'a', b'12345', 't')
+    assert rc.get('a')[0] == b'12345'
+    assert rc.get('b') is None
+    assert rc.stats()['hits'] == 1
+    assert rc.stats()['misses'] == 1
+
+
+def test_evicts_the_least_recently_used_entry_past_max_bytes():
+    rc = ResponseCache(10)
+    put(rc, 'a', b'1234', 't')
+    put(rc, 'b', b'1234', 't')
+    rc.get('a')  # now b is the oldest
+    put(rc, 'c', b'1234', 't')
+    assert rc.get('b') is None
+    assert rc.get('a') is not None
+    assert rc.get('c') is not None
+    assert rc.stats()['evictions'] == 1
+    assert rc.stats()['bytes'] == 8
+
+
+def test_replacing_an_entry_keeps_the_size_right():
+    rc = ResponseCache(10)
+    put(rc, 'a', b'1234', 't')
+    put(rc, 'a', b'123456', 't')
+    assert rc.stats()['bytes'] == 6
+    assert rc.stats()['entries'] == 1
+
+
+def test_skips_a_body_larger_than_the_cache():
+    rc = ResponseCache(4)
+    put(rc, 'a', b'12345', 't')
+    assert rc.get('a') is None
+
+
+def test_invalidate_drops_the_entries_of_a_tag_only():
+    rc = ResponseCache(100)
+    put(rc, 'a', b'1', (1, 'houses'))
+    put(rc, 'b', b'2', (1, 'topics'))
+    put(rc, 'c', b'3', (2, 'houses'))
+    rc.invalidate([(1, 'houses')])
+    assert rc.get('a') is None
+    assert rc.get('b') is not None
+    assert rc.get('c') is not None
+    assert rc.stats()['bytes'] == 2
+
+
+def test_put_skips_a_response_built_across_an_invalidation():
+    rc = ResponseCache(100)
+    generation = rc.generation(['t'])
+    rc.invalidate(['t'])
+    rc.put('a', entry(b'stale', 't'), generation)
+    assert rc.get('a') is None
+    put(rc, 'a', b'fresh', 't')
+    assert rc.get('a')[0] == b'fresh'
+
+
+def test_put_skips_a_replica_read_older_than_the_last_invalidation():
+    rc = ResponseCache(100)
+    rc.invalidate(['t'])
+    synced_at = rc._invalidated_at['t'] - 1
+    rc.put('a', entry(b'x', 't'), rc.generation(['t']), synced_at)
+    assert rc.get('a') is None
+    rc.put('a', entry(b'x', 't'), rc.generation(['t']), synced_at + 2)
+    assert rc.get('a') is not None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(cache, 'response_cache', ResponseCache(1 << 20))
+    monkeypatch.setattr(events, 'get_listener', lambda: None)
+    app = Flask(__name__)
+    calls = []
+
+    @app.before_request
+    def _tenant():
+        g.tenant_id = 1
+
+    @app.route('/houses')
+    @cache.cached('houses')
+    def houses():
+        calls.append(1)
+        return jsonify(['home', 'work'])
+
+    test_client = app.test_client()
+    test_client.calls = calls
+    return test_client
+
+
+def test_cached_view_answers_304_for_a_matching_etag(client):
+    first = client.get('/houses')
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+    assert etag
+
+    again = client.get('/houses', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert client.calls == [1]
+    assert cache.response_cache.stats()['not_modified'] == 1
+
+    other = client.get('/houses', headers={'If-None-Match': '"other"'})
+    assert other.status_code == 200
+    assert other.headers['ETag'] == etag
+
+
+def test_cached_view_runs_again_after_its_table_changes(client):
+    etag = client.get('/houses').headers['ETag']
+    cache.invalidate(['houses'], tenant=1)
+    response = client.get('/houses', headers={'If-None-Match': etag})
+    # Same content, so the same ETag, but the view ran again.
+    assert response.status_code == 304
+    assert client.calls == [1, 1]
+
+
+def test_vary_is_part_of_the_key(monkeypatch):
+    monkeypatch.setattr(cache, 'response_cache', ResponseCache(1 << 20))
+    monkeypatch.setattr(events, 'get_listener', lambda: None)
+    app = Flask(__name__)
+    today = ['2026-10-18']
+
+    @app.before_request
+    def _tenant():
+        g.tenant_id = 1
+
+    @app.route('/analytics')
+    @cache.cached('food', vary=lambda: today[0])
+    def analytics():
+        return jsonify({'to': today[0]})
+
+    client = app.test_client()
+    assert client.get('/analytics').get_json() == {'to': '2026-10-18'}
+    today[0] = '2026-10-19'
+    assert client.get('/analytics').get_json() == {'to': '2026-10-19'}
@@ -0,0 +1,30 @@
+import cascade
+
+
+class RecordingCursor:
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql.split()[0], params))
+
+
+def test_delete_house_moves_the_topics_before_the_house_goes():
+    cur = RecordingCursor(rowcount=3)
+    assert cascade.delete_house(cur, 'work') == 3
+    # Separate statements, in this order: deleting the house first would
+    # cascade to the topics it still holds.
+    assert cur.statements == [
+        ('UPDATE', (cascade.GENERAL_HOUSE, 'work')),
+        ('DELETE', ('work',)),
+    ]
+
+
+def test_renames_and_deletes_leave_the_dependents_to_the_foreign_keys():
+    cur = RecordingCursor(rowcount=0)
+    assert not cascade.rename_house(cur, 'a', 'b')
+    assert not cascade.delete_topic(cur, 7)
+    assert not cascade.delete_file(cur, 7, 'f')
+    assert not cascade.rename_file(cur, 7, 'f', 'g')
+    assert len(cur.statements) == 4
@@ -0,0 +1,70 @@
+import gzip
+import json
+
+import pytest
+from flask import Flask, g, jsonify
+
+import cache
+import compression
+import events
+from cache import ResponseCache
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(compression, 'MIN_SIZE', 0)
+    monkeypatch.setattr(compression, 'ENCODINGS', ['gzip'])
+    monkeypatch.setattr(cache, 'response_cache', ResponseCache(1 << 20))
+    monkeypatch.setattr(events, 'get_listener', lambda: None)
+    app = Flask(__name__)
+    app.after_request(compression.compress)
+
+    @app.before_request
+    def _tenant():
+        g.tenant_id = 1
+
+    @app.route('/houses')
+    @cache.cached('houses')
+    def houses():
+        return jsonify(['home', 'work'])
+
+    return app
+
+
+def test_tag_etag_appends_the_encoding():
+    assert compression.tag_etag('abc', 'gzip') == 'abc-gzip'
+    assert compression.tag_etag('abc', None) == 'abc'
+
+
+def test_compress_tags_the_etag_with_the_encoding(app):
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+        response = jsonify(['x'])
+        response.set_etag('abc')
+        response = compression.compress(response)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.get_etag() == ('abc-gzip', False)
+    assert json.loads(gzip.decompress(response.get_data())) == ['x']
+
+
+def test_compress_leaves_an_uncompressed_response_alone(app):
+    with app.test_request_context('/'):
+        response = jsonify(['x'])
+        response.set_etag('abc')
+        response = compression.compress(response)
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_etag() == ('abc', False)
+
+
+def test_a_cached_view_matches_the_tagged_etag_of_its_encoding(app):
+    client = app.test_client()
+    first = client.get('/houses', headers={'Accept-Encoding': 'gzip'})
+    etag = first.headers['ETag']
+    assert etag.endswith('-gzip"')
+
+    again = client.get('/houses', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304
+    # The identity representation is a different one.
+    plain = client.get('/houses', headers={'If-None-Match': etag})
+    assert plain.status_code == 200
+    assert plain.headers['ETag'] == etag.replace('-gzip', '')
+
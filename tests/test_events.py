@@ -0,0 +1,39 @@
+import events
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(' '.join(sql.split()))
+
+
+class PooledConnection:
+    def __init__(self):
+        self.before_commit = []
+
+
+class PlainConnection:
+    pass
+
+
+def test_publish_waits_for_the_commit_on_a_pooled_connection():
+    conn = PooledConnection()
+    cur = FakeCursor(conn)
+    events.publish(cur, 'change', {'tables': ['tasks']})
+    # Nothing locked or inserted while the transaction is still running.
+    assert cur.statements == []
+    assert len(conn.before_commit) == 1
+
+    at_commit = FakeCursor(conn)
+    conn.before_commit[0](at_commit)
+    assert at_commit.statements[0].startswith('SELECT pg_advisory_xact_lock')
+    assert 'INSERT INTO app_events' in at_commit.statements[1]
+
+
+def test_publish_inserts_at_once_on_a_plain_connection():
+    cur = FakeCursor(PlainConnection())
+    events.publish(cur, 'window_request', {'open': True})
+    assert len(cur.statements) == 2
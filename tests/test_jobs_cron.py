@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+from jobs import cron_matches, parse_cron
+
+
+def test_parse_cron_wildcards():
+    minutes, hours, days, months, weekdays, both = parse_cron('* * * * *')
+    assert minutes == set(range(60))
+    assert hours == set(range(24))
+    assert days == set(range(1, 32))
+    assert months == set(range(1, 13))
+    assert weekdays == set(range(8))
+    assert both
+
+
+def test_parse_cron_values_ranges_steps_and_lists():
+    minutes, hours, days, months, weekdays, _ = parse_cron('*/15 9-17/4 1,15 3 1-5')
+    assert minutes == {0, 15, 30, 45}
+    assert hours == {9, 13, 17}
+    assert days == {1, 15}
+    assert months == {3}
+    assert weekdays == {1, 2, 3, 4, 5}
+
+
+def test_parse_cron_step_from_a_value_runs_to_the_end():
+    assert parse_cron('5/20 * * * *')[0] == {5, 25, 45}
+
+
+def test_parse_cron_weekday_7_is_sunday():
+    assert parse_cron('0 0 * * 7')[4] == {0, 7}
+
+
+@pytest.mark.parametrize('expr', [
+    '* * * *',
+    '* * * * * *',
+    '60 * * * *',
+    '* 24 * * *',
+    '* * 0 * *',
+    '* * * 13 *',
+    '* * * * 8',
+    '5-1 * * * *',
+    'x * * * *',
+    '*/0 * * * *',
+])
+def test_parse_cron_rejects(expr):
+    with pytest.raises(ValueError):
+        parse_cron(expr)
+
+
+def test_cron_matches_minute_hour_and_month():
+    cron = parse_cron('30 4 * 6 *')
+    assert cron_matches(cron, datetime(2026, 6, 10, 4, 30))
+    assert not cron_matches(cron, datetime(2026, 6, 10, 4, 31))
+    assert not cron_matches(cron, datetime(2026, 6, 10, 5, 30))
+    assert not cron_matches(cron, datetime(2026, 7, 10, 4, 30))
+
+
+def test_cron_matches_weekday():
+    cron = parse_cron('0 0 * * 0')
+    assert cron_matches(cron, datetime(2026, 10, 18))  # a Sunday
+    assert not cron_matches(cron, datetime(2026, 10, 19))
+
+
+def test_cron_matches_day_or_weekday_when_both_are_restricted():
+    # The 1st of the month, or any Monday.
+    cron = parse_cron('0 0 1 * 1')
+    assert cron_matches(cron, datetime(2026, 10, 1))  # a Thursday
+    assert cron_matches(cron, datetime(2026, 10, 19))  # a Monday
+    assert not cron_matches(cron, datetime(2026, 10, 20))
+
+
+def test_cron_matches_day_and_weekday_when_one_is_a_wildcard():
+    cron = parse_cron('0 0 1 * *')
+    assert cron_matches(cron, datetime(2026, 10, 1))
+    assert not cron_matches(cron, datetime(2026, 10, 19))
@@ -0,0 +1,104 @@
+import math
+import random
+
+import pytest
+
+import ordering
+from ordering import MIN_GAP, STEP, crowded, key_between, plan_reorder
+
+
+def apply(keys, changes):
+    return [changes.get(i, key) for i, key in enumerate(keys)]
+
+
+def test_key_between_ends_of_the_list():
+    assert key_between(None, None) == STEP
+    assert key_between(None, 10.0) == 10.0 - STEP
+    assert key_between(10.0, None) == 10.0 + STEP
+
+
+def test_key_between_takes_the_midpoint():
+    assert key_between(1.0, 2.0) == 1.5
+
+
+def test_key_between_without_room():
+    assert key_between(1.0, math.nextafter(1.0, 2.0)) is None
+    assert key_between(1.0, 1.0) is None
+
+
+def test_crowded():
+    assert crowded(1.0, 1.0 + MIN_GAP / 2)
+    assert not crowded(1.0, 1.0 + MIN_GAP * 2)
+    assert not crowded(None, 1.0)
+    assert not crowded(1.0, None)
+
+
+def test_plan_reorder_keeps_a_sorted_list():
+    assert plan_reorder([1.0, 2.0, 3.0]) == ({}, False)
+
+
+def test_plan_reorder_moves_one_item_with_one_write():
+    # The last item dragged to the front.
+    keys = [3072.0, 1024.0, 2048.0]
+    changes, is_crowded = plan_reorder(keys)
+    assert changes == {0: 1024.0 - STEP}
+    assert not is_crowded
+
+
+def test_plan_reorder_moves_an_item_between_its_new_neighbours():
+    keys = [1024.0, 3072.0, 2048.0]
+    changes, _ = plan_reorder(keys)
+    assert len(changes) == 1
+    new = apply(keys, changes)
+    assert new == sorted(new)
+
+
+def test_plan_reorder_places_new_items():
+    keys = [None, 1024.0, None, 2048.0, None]
+    changes, is_crowded = plan_reorder(keys)
+    assert sorted(changes) == [0, 2, 4]
+    assert changes == {0: 0.0, 2: 1536.0, 4: 2048.0 + STEP}
+    assert not is_crowded
+
+
+def test_plan_reorder_of_new_list():
+    assert plan_reorder([None, None]) == ({0: STEP, 1: 2 * STEP}, False)
+
+
+def test_plan_reorder_flags_a_crowded_gap():
+    keys = [1.0, 3.0, 1.0 + MIN_GAP]
+    changes, is_crowded = plan_reorder(keys)
+    assert is_crowded
+    assert apply(keys, changes) == sorted(apply(keys, changes))
+
+
+def test_plan_reorder_without_room_asks_for_a_rebalance():
+    assert plan_reorder([1.0, 5.0, math.nextafter(1.0, 2.0)]) == (None, True)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_plan_reorder_writes_only_items_off_the_longest_run(seed):
+    rng = random.Random(seed)
+    keys = [STEP * (i + 1) for i in range(30)]
+    rng.shuffle(keys)
+    changes, _ = plan_reorder(keys)
+    new = apply(keys, changes)
+    assert all(a < b for a, b in zip(new, new[1:]))
+    assert len(changes) == len(keys) - len(ordering._increasing_subsequence(keys))
+
+
+def test_reorder_rebalances_when_a_gap_is_full(monkeypatch):
+    tight = math.nextafter(1.0, 2.0)
+    lists = [[1.0, 5.0, tight], [STEP, 3 * STEP, 2 * STEP]]
+    calls = []
+    monkeypatch.setattr(ordering, 'execute_values', lambda cur, sql, rows, page_size, fetch: [
+        (row[0], key) for row, key in zip(rows, lists[0])])
+    monkeypatch.setattr(ordering, 'rebalance', lambda cur, table, group: (calls.append(table), lists.pop(0)))
+    monkeypatch.setattr(ordering, 'bulk_update', lambda cur, table, key, columns, rows: calls.append(rows))
+
+    written, is_crowded, result = ordering.reorder(None, 'unclassified_tasks', (), [('a',), ('c',), ('b',)])
+
+    assert calls == ['unclassified_tasks', [('c', 1.5 * STEP)]]
+    assert written == 1
+    assert not is_crowded
+    assert result == [(('a',), STEP), (('c',), 1.5 * STEP), (('b',), 2 * STEP)]
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+from flask import Flask
+
+import db
+import pagination
+from pagination import InvalidCursor, KeysetList, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips_the_key_values():
+    values = ['tasks', 2.5, 7, 'קובץ']
+    cursor = encode_cursor(values)
+    assert '=' not in cursor
+    assert decode_cursor(cursor, (str, float, int, str)) == values
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', encode_cursor([1])[:-2] + '**', 'e30'])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, (int,))
+
+
+@pytest.mark.parametrize('values', [['7', 'a'], [7, 1], [True, 'a'], [None, 'a'], [[7], 'a']])
+def test_a_cursor_value_of_the_wrong_type_is_rejected(values):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(encode_cursor(values), (int, str))
+
+
+def test_a_float_key_accepts_an_integer():
+    assert decode_cursor(encode_cursor([2048, 'a']), (float, str)) == [2048, 'a']
+
+
+def test_a_cursor_of_another_width_is_rejected():
+    with pytest.raises(InvalidCursor):
+        decode_cursor(encode_cursor([1, 2]), (int, int, int))
+
+
+class RecordingCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = None
+
+    def execute(self, sql, params):
+        self.executed = (sql, params)
+
+    def fetchall(self):
+        return self.rows
+
+
+NUMBERS = KeysetList('numbers', ['n', 'label'], ['n'], lambda r: {'n': r[0], 'label': r[1]}, key_types=(int,))
+
+
+def test_page_fetches_one_extra_row_and_returns_the_next_cursor():
+    cur = RecordingCursor([(1, 'a'), (2, 'b'), (3, 'c')])
+    items, next_cursor = NUMBERS.page(cur, None, 2)
+    assert items == [{'n': 1, 'label': 'a'}, {'n': 2, 'label': 'b'}]
+    assert decode_cursor(next_cursor, (int,)) == [2]
+    assert cur.executed == ('SELECT n, label FROM numbers ORDER BY n LIMIT %s', (3,))
+
+    cur = RecordingCursor([(3, 'c')])
+    items, next_cursor = NUMBERS.page(cur, encode_cursor([2]), 2)
+    assert next_cursor is None
+    assert cur.executed == ('SELECT n, label FROM numbers WHERE ((n) > (%s)) ORDER BY n LIMIT %s', (2, 3))
+
+
+
+class StreamConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, name=None):
+        return StreamCursor(self.rows)
+
+
+class StreamCursor(RecordingCursor):
+    itersize = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.log = []
+
+    def getconn(self, tenant=None):
+        self.log.append('getconn')
+        return self.conn
+
+    def putconn(self, conn):
+        self.log.append('putconn')
+
+
+def test_stream_uses_the_request_connection_until_the_body_is_sent(monkeypatch):
+    pool = FakePool(StreamConnection([(1, 'a'), (2, 'b')]))
+    monkeypatch.setattr(db, 'get_pool', lambda: pool)
+    app = Flask(__name__)
+    app.teardown_appcontext(db.release_db_connection)
+
+    @app.route('/numbers')
+    def numbers():
+        return pagination.respond(NUMBERS)
+
+    response = app.test_client().get('/numbers?stream=ndjson', buffered=False)
+    assert pool.log == ['getconn']
+    lines = b''.join(response.response).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{'n': 1, 'label': 'a'}, {'n': 2, 'label': 'b'}]
+    response.close()
+    assert pool.log == ['getconn', 'putconn']
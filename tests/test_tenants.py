@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+
+import pytest
+
+import tenants
+
+
+class FakePool:
+    """Answers ``SELECT id FROM tenants WHERE token_hash = %s`` from a dict."""
+
+    def __init__(self, ids_by_hash):
+        self.ids_by_hash = ids_by_hash
+        self.lookups = 0
+
+    @contextmanager
+    def connection(self, tenant=None):
+        yield self
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, sql, params):
+        self.lookups += 1
+        tenant = self.ids_by_hash.get(params[0])
+        self.row = None if tenant is None else (tenant,)
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool({tenants.hash_token('secret'): 7})
+    monkeypatch.setattr(tenants, 'get_pool', lambda: pool)
+    monkeypatch.setattr(tenants, '_tokens', {})
+    return pool
+
+
+def test_no_token_is_the_default_tenant(pool):
+    assert tenants.ALLOW_ANONYMOUS
+    assert tenants.tenant_for(None) == tenants.DEFAULT_TENANT_ID
+    assert tenants.tenant_for('') == tenants.DEFAULT_TENANT_ID
+    assert pool.lookups == 0
+
+
+def test_no_token_is_refused_when_anonymous_requests_are_off(pool, monkeypatch):
+    monkeypatch.setattr(tenants, 'ALLOW_ANONYMOUS', False)
+    with pytest.raises(LookupError):
+        tenants.tenant_for(None)
+
+
+def test_bearer_token_names_its_tenant(pool):
+    assert tenants.tenant_for('Bearer secret') == 7
+    assert tenants.tenant_for('bearer  secret ') == 7
+    # Remembered for TOKEN_CACHE_SECONDS.
+    assert pool.lookups == 1
+
+
+@pytest.mark.parametrize('header', ['Bearer other', 'Basic secret', 'Bearer ', 'secret'])
+def test_unknown_or_malformed_tokens_are_refused(pool, header):
+    with pytest.raises(LookupError):
+        tenants.tenant_for(header)
+
+
+def test_scope_overrides_and_restores_the_tenant():
+    assert tenants.current() is None
+    with tenants.scope(3):
+        assert tenants.current() == 3
+        with tenants.scope(4):
+            assert tenants.current() == 4
+        assert tenants.current() == 3
+    assert tenants.current() is None
@@ -0,0 +1,133 @@
+from contextlib import contextmanager
+
+import pytest
+
+import cache
+import tenants
+import writebehind
+from writebehind import WriteBehind, last_wins
+
+
+class FakeConnection:
+    def __init__(self, log, tenant):
+        self.log = log
+        self.tenant = tenant
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def commit(self):
+        self.log.append(('commit', self.tenant))
+
+    def rollback(self):
+        self.log.append(('rollback', self.tenant))
+
+
+class FakePool:
+    def __init__(self):
+        self.log = []
+
+    @contextmanager
+    def connection(self, tenant=None):
+        yield FakeConnection(self.log, tenant)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(writebehind, 'get_pool', lambda: pool)
+    monkeypatch.setattr(writebehind.events, 'publish_change', lambda cur, *tables: None)
+    # No background thread: the tests flush explicitly.
+    monkeypatch.setattr(WriteBehind, '_start', lambda self: None)
+    monkeypatch.setattr(cache, 'response_cache', cache.ResponseCache(1 << 20))
+    return pool
+
+
+def writer(name):
+    return lambda cur, value: cur.log.append((name, cur.tenant, value))
+
+
+def test_writes_to_one_key_coalesce(pool):
+    buffer = WriteBehind(window=60, max_pending=10)
+    with tenants.scope(1):
+        for value in (1, 2, 3):
+            assert buffer.submit(('files', 7, 'a'), value, last_wins, writer('a'), ['files'])
+        assert buffer.stats()['pending'] == 1
+        assert buffer.stats()['coalesced'] == 2
+        buffer.flush_key(('files', 7, 'a'))
+    assert pool.log == [('a', 1, 3), ('commit', 1)]
+    assert buffer.stats()['pending'] == 0
+
+
+def test_merge_combines_values(pool):
+    buffer = WriteBehind(window=60, max_pending=10)
+    with tenants.scope(1):
+        buffer.submit(('tracking', 'x'), {'a': 1}, lambda old, new: {**old, **new}, writer('t'), ['tracking'])
+        buffer.submit(('tracking', 'x'), {'b': 2}, lambda old, new: {**old, **new}, writer('t'), ['tracking'])
+        buffer.flush()
+    assert pool.log == [('t', 1, {'a': 1, 'b': 2}), ('commit', 1)]
+
+
+def test_flush_prefix_writes_only_matching_keys(pool):
+    buffer = WriteBehind(window=60, max_pending=10)
+    with tenants.scope(1):
+        buffer.submit(('files', 7, 'a'), 'fa', last_wins, writer('fa'), ['files'])
+        buffer.submit(('tracking', 'x'), 'tx', last_wins, writer('tx'), ['tracking'])
+        buffer.flush_prefix(('files',))
+    assert pool.log == [('fa', 1, 'fa'), ('commit', 1)]
+    assert buffer.stats()['pending'] == 1
+
+
+def test_keys_are_per_tenant(pool):
+    buffer = WriteBehind(window=60, max_pending=10)
+    for tenant in (1, 2):
+        with tenants.scope(tenant):
+            buffer.submit(('tracking', 'x'), tenant, last_wins, writer('t'), ['tracking'])
+    assert buffer.stats()['pending'] == 2
+    with tenants.scope(1):
+        buffer.flush_prefix(())
+    assert pool.log == [('t', 1, 1), ('commit', 1)]
+
+    buffer.flush()
+    assert pool.log[2:] == [('t', 2, 2), ('commit', 2)]
+
+
+def test_a_failing_write_is_dropped_and_the_rest_lands(pool):
+    buffer = WriteBehind(window=60, max_pending=10)
+
+    def fail(cur, value):
+        raise RuntimeError('bad row')
+
+    with tenants.scope(1):
+        buffer.submit(('files', 1, 'bad'), None, last_wins, fail, ['files'])
+        buffer.submit(('files', 1, 'good'), 'ok', last_wins, writer('good'), ['files'])
+        buffer.flush()
+    assert ('good', 1, 'ok') in pool.log
+    assert buffer.stats()['failed'] == 1
+    assert buffer.stats()['pending'] == 0
+
+
+def test_submit_gives_up_when_the_buffer_stays_full(pool):
+    buffer = WriteBehind(window=60, max_pending=1, submit_timeout=0.01)
+    with tenants.scope(1):
+        assert buffer.submit(('tracking', 'x'), 1, last_wins, writer('t'), ['tracking'])
+        # The buffered key itself still coalesces.
+        assert buffer.submit(('tracking', 'x'), 2, last_wins, writer('t'), ['tracking'])
+        assert not buffer.submit(('tracking', 'y'), 3, last_wins, writer('t'), ['tracking'])
+    assert buffer.stats()['rejected'] == 1
+
+
+def test_submit_drops_the_cached_reads_of_its_tables(pool):
+    rc = cache.response_cache
+    for key, tag in (('analytics', (1, 'tracking')), ('other', (2, 'tracking')), ('files', (1, 'files'))):
+        rc.put(key, (b'x', 'etag', 'application/json', [tag]), rc.generation([tag]))
+    buffer = WriteBehind(window=60, max_pending=10)
+    with tenants.scope(1):
+        assert buffer.submit(('tracking', 'x'), 1, last_wins, writer('t'), ['tracking'])
+    # The tap is still buffered, but the tenant's cached /analytics is gone
+    # and the next read misses and flushes.
+    assert buffer.stats()['pending'] == 1
+    assert rc.get('analytics') is None
+    assert rc.get('other') is not None
+    assert rc.get('files') is not None
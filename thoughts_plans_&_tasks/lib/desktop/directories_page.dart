@@ -39,7 +39,8 @@ class _DirectoriesPageState extends State<DirectoriesPage> {
                 'id': e['id'],
                 'name': e['name'],
                 'color': Color(e['color']),
-                'order': e['order'],
+                // A sparse ordering key (e.g. 1536.0), not an index.
+                'order': e['order'] as num,
               }),
             )
         };
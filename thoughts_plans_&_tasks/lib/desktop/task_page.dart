@@ -128,6 +128,7 @@ class _TaskPageState extends State<TaskPage> {
       .map((entry) => {
         'topic_id': entry.value['topic_id'],
         'file_name': entry.value['file_name'],
+        // The position in this list; the server turns it into a stored key.
         'order': entry.key,
         'section': toSection,
       })
@@ -153,6 +154,7 @@ class _TaskPageState extends State<TaskPage> {
       .entries
       .map((entry) => {
         'content': entry.value['content'],
+        // The position in this list; the server turns it into a stored key.
         'order': entry.key,
       })
       .toList();
@@ -195,7 +197,8 @@ class _TaskPageState extends State<TaskPage> {
           headers: {'Content-Type': 'application/json'},
           body: jsonEncode({
             'content': task['content'],
-            'order': task['order'],
+            // The stored key exactly as loaded (a double), which names the row.
+            'order': task['order'] as num,
           }),
         );
       }
@@ -0,0 +1,250 @@
+"""Optional write-behind buffer for the autosave-style endpoints.
+
+With ``WRITE_BEHIND_MS`` set, repeated writes to the same key within that
+window are merged in memory and committed in batches by a background
+thread, so those requests no longer wait for a Postgres commit.
+
+Guarantees:
+
+* reads of a key call ``flush_key`` / ``flush_prefix`` first and so see
+  every write this process accepted for it; ``submit`` drops the cached
+  responses (see cache.py) of the write's tables at once, so a cached
+  read cannot skip that flush;
+* ``flush()`` runs at interpreter exit and from the server's shutdown hook;
+* at most ``WRITE_BEHIND_MAX_PENDING`` keys are buffered; beyond that
+  ``submit`` waits for the worker, and if it is still full the caller
+  writes synchronously.
+
+The buffer is per process: another worker only sees the write after it
+has been flushed. A read that had to flush or wait for a write runs on the
+primary, not on a read replica.
+
+Keys are per tenant: ``submit`` and the flushes prefix them with the
+current tenant (see tenants.py), and each tenant's writes are committed on
+a connection scoped to that tenant.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_request_context
+
+import cache
+import events
+import tenants
+from db import get_pool, use_primary
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    def __init__(self, window, max_pending, submit_timeout=1.0):
+        self.window = window
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._pending = {}  # (tenant,) + key -> [value, merge, apply, tables, first_queued_at]
+        self._inflight = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats = {'submitted': 0, 'coalesced': 0, 'flushed': 0, 'batches': 0, 'failed': 0, 'rejected': 0}
+
+    @property
+    def enabled(self):
+        # A /batch writes inside its own transaction instead.
+        return self.window > 0 and not (has_request_context() and 'batch' in g)
+
+    def submit(self, key, value, merge, apply, tables):
+        """Buffer a write. ``apply(cur, value)`` performs it; ``merge(old, new)`` coalesces two values.
+
+        Returns False when the buffer stayed full, in which case the caller
+        must perform the write itself.
+        """
+        key = (tenants.current(),) + tuple(key)
+        deadline = time.monotonic() + self.submit_timeout
+        with self._cond:
+            self._start()
+            while key not in self._pending and len(self._pending) >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['rejected'] += 1
+                    return False
+                self._cond.notify_all()  # wake the worker early
+                self._cond.wait(remaining)
+            self._stats['submitted'] += 1
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [value, merge, apply, tables, time.monotonic()]
+            else:
+                entry[0] = merge(entry[0], value)
+                self._stats['coalesced'] += 1
+            self._cond.notify_all()
+        # The next cached read must miss, and flush, rather than answer
+        # from before this write until the flush's change event comes back.
+        cache.invalidate(tables, key[0])
+        return True
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _take(self, keys):
+        """Move ``keys`` from pending to in-flight; caller holds the lock."""
+        batch = {}
+        for key in keys:
+            batch[key] = self._pending.pop(key)
+            self._inflight.add(key)
+        return batch
+
+    def _write(self, batch):
+        groups = {}
+        for key, entry in batch.items():
+            groups.setdefault(key[0], {})[key] = entry
+        groups = list(groups.items())
+        for i, (tenant, group) in enumerate(groups):
+            try:
+                self._write_tenant(tenant, group)
+            except Exception:
+                for _, rest in groups[i + 1:]:
+                    self._requeue(rest)
+                raise
+
+    def _requeue(self, batch):
+        """Put an unwritten batch back, merged under anything newer."""
+        with self._cond:
+            for key, entry in batch.items():
+                newer = self._pending.get(key)
+                if newer is not None:
+                    entry[0] = entry[1](entry[0], newer[0])
+                self._pending[key] = entry
+            self._inflight.difference_update(batch)
+            self._cond.notify_all()
+
+    def _write_tenant(self, tenant, batch):
+        try:
+            with get_pool().connection(tenant) as conn, tenants.scope(tenant):
+                try:
+                    self._apply(conn, batch.values())
+                except Exception:
+                    conn.rollback()
+                    # Isolate the bad write so the rest still lands.
+                    log.exception('Write-behind batch failed, retrying one by one')
+                    for key, entry in batch.items():
+                        try:
+                            self._apply(conn, [entry])
+                        except Exception:
+                            conn.rollback()
+                            log.exception('Dropping buffered write for %r', key)
+                            with self._cond:
+                                self._stats['failed'] += 1
+            with self._cond:
+                self._stats['flushed'] += len(batch)
+                self._stats['batches'] += 1
+        except Exception:
+            # No connection: put the batch back.
+            self._requeue(batch)
+            raise
+        finally:
+            with self._cond:
+                self._inflight.difference_update(batch)
+                self._cond.notify_all()
+
+    def _apply(self, conn, entries):
+        tables = set()
+        with conn.cursor() as cur:
+            for value, _, apply, entry_tables, _ in entries:
+                apply(cur, value)
+                tables.update(entry_tables)
+            events.publish_change(cur, *sorted(tables))
+        conn.commit()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                oldest = min(entry[4] for entry in self._pending.values())
+                full = len(self._pending) >= self.max_pending
+                if not full and now - oldest < self.window:
+                    self._cond.wait(self.window - (now - oldest))
+                    continue
+                batch = self._take([k for k in self._pending if k not in self._inflight])
+                if not batch:
+                    # Only keys still being written by a reader's flush: wait for it.
+                    self._cond.wait()
+                    continue
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    log.exception('Write-behind flush failed')
+                    time.sleep(1)
+
+    def flush_key(self, key):
+        """Write ``key`` now if it is buffered, and wait for any in-flight write of it."""
+        self.flush_prefix(key, exact=True)
+
+    def flush_prefix(self, prefix, exact=False):
+        """Like ``flush_key`` for every key equal to (or starting with) the ``prefix`` tuple."""
+        prefix = (tenants.current(),) + tuple(prefix)
+
+        def matches(key):
+            return key == prefix if exact else key[:len(prefix)] == prefix
+
+        waited = False
+        with self._cond:
+            while any(matches(k) for k in self._inflight):
+                waited = True
+                self._cond.wait()
+            batch = self._take([k for k in self._pending if matches(k)])
+        if batch:
+            self._write(batch)
+        if batch or waited:
+            self._read_from_primary()
+
+    def flush(self):
+        """Write everything that is buffered and wait for in-flight batches."""
+        waited = False
+        with self._cond:
+            while self._inflight:
+                waited = True
+                self._cond.wait()
+            batch = self._take(list(self._pending))
+        if batch:
+            self._write(batch)
+        if batch or waited:
+            self._read_from_primary()
+
+    @staticmethod
+    def _read_from_primary():
+        # A read routed to a replica (see replicas.py) may not have the
+        # writes just committed yet.
+        if has_request_context():
+            use_primary()
+
+    def reset_after_fork(self):
+        """Forget the parent's worker thread and buffered writes (the parent flushes those itself)."""
+        self._pending = {}
+        self._inflight = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=len(self._pending), inflight=len(self._inflight),
+                        window_ms=self.window * 1000)
+
+
+def last_wins(old, new):
+    return new
+
+
+buffer = WriteBehind(
+    window=float(os.environ.get('WRITE_BEHIND_MS', 0)) / 1000,
+    max_pending=int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 1000)),
+)
+atexit.register(buffer.flush)
+os.register_at_fork(after_in_child=buffer.reset_after_fork)